@@ -1,4 +1,8 @@
 from experiments import *
+from ensemble import *
+from parallel import *
+from storage import *
+from gaussfit import *
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
@@ -36,27 +40,36 @@ def summarize(results):
     return all_results
 
 # Returns current trial response associated with previous trial info
+# results: TrialTable, list of trial dicts or summarized trials; leads are codes (see trialtable.py)
+# Within a single run the columns are views into the trial table
 def shift_results(results):
+    if isinstance(results, dict):
+        results = TrialTable.from_columns(
+            [LEAD_CODES[lead] for lead in results["lead"]], results["soa"], results["response"]
+        )
+    table = as_table(results)
+    lead, run = table["lead"], table["run"]
+
+    # Pair each trial with the one before it in the same run
+    current, previous = slice(1, None), slice(None, -1)
+    if table.runs() > 1:
+        current = np.flatnonzero(run[1:] == run[:-1]) + 1
+        previous = current - 1
+
     prev_results = {}
-    num_trials = len(results["lead"]) - 1
-    prev_results["response"] = np.array(results["response"][1:])
-    prev_results["lead"] = np.array(results["lead"][1:])
-    # prev_results["lead"][0] = "Null"
-    prev_results["prev_lead"] = np.array(results["lead"][:-1])
-    prev_results["soa"] = np.array(results["soa"][1:])
-    prev_results["repeat"] = np.zeros((num_trials, 1))
-
-    for i in range(num_trials):  # range(len(prev_results["prev_lead"])):
-        prev_lead = prev_results["prev_lead"][i]
-        curr_lead = prev_results["lead"][i]
-        repeat = None
-
-        if prev_lead == "visual":
-            repeat = V_repeat if curr_lead == "visual" else V_nonrepeat
-        elif prev_lead == "audio":
-            repeat = A_repeat if curr_lead == "audio" else A_nonrepeat
-
-        prev_results["repeat"][i] = repeat
+    prev_results["response"] = table["response"][current]
+    prev_results["lead"] = lead[current]
+    prev_results["prev_lead"] = lead[previous]
+    prev_results["soa"] = table["soa"][current]
+    prev_results["run"] = run[current]
+
+    prev_lead, curr_lead = prev_results["prev_lead"], prev_results["lead"]
+    repeat = np.full((len(curr_lead), 1), np.nan)
+    repeat[(prev_lead == VISUAL) & (curr_lead == VISUAL)] = V_repeat
+    repeat[(prev_lead == VISUAL) & (curr_lead != VISUAL)] = V_nonrepeat
+    repeat[(prev_lead == AUDIO) & (curr_lead == AUDIO)] = A_repeat
+    repeat[(prev_lead == AUDIO) & (curr_lead != AUDIO)] = A_nonrepeat
+    prev_results["repeat"] = repeat
 
     return prev_results
 
@@ -83,6 +96,39 @@ def get_soa_synchrony(soa, trials):
     return pc
 
 
+# Synchronous and asynchronous response counts per (run, previous lead, SOA) in one pass
+# prev: output of shift_results; runs: number of runs in it (taken from its run column if None)
+# Returns the sorted SOAs of all runs, with arrays indexed [run, SOA] for trial counts ("freq")
+# and percent synchronous after any trial ("percent"), audio- ("percent_a") and visual-leading
+# ("percent_v") trials, and counts indexed [run, lead code, SOA] ("sync", "async")
+def soa_synchrony(prev, runs=None):
+    soas, soa_codes = np.unique(prev["soa"], return_inverse=True)
+    if runs is None:
+        runs = int(prev["run"].max()) + 1 if len(prev["run"]) else 0
+    shape = (runs, len(LEADS), len(soas))
+    codes = (prev["run"].astype(np.int64) * len(LEADS) + prev["prev_lead"]) * len(soas) + soa_codes
+    size = np.prod(shape)
+
+    response = prev["response"]
+    sync = np.bincount(codes, weights=response == 1, minlength=size).reshape(shape)
+    a_sync = np.bincount(codes, weights=response == -1, minlength=size).reshape(shape)
+    freq = np.bincount(codes, minlength=size).reshape(shape).sum(axis=1)
+
+    def percent(sync, a_sync):
+        total = sync + a_sync
+        return np.divide(sync, total, out=np.zeros(total.shape), where=total > 0)
+
+    return {
+        "soa": soas,
+        "freq": freq,
+        "sync": sync,
+        "async": a_sync,
+        "percent": percent(sync.sum(axis=1), a_sync.sum(axis=1)),
+        "percent_a": percent(sync[:, AUDIO], a_sync[:, AUDIO]),
+        "percent_v": percent(sync[:, VISUAL], a_sync[:, VISUAL]),
+    }
+
+
 # Define the Gaussian function
 def gauss(x, amp, mu, sigma):
     y = amp * np.exp(-((x - mu) ** 2) / (2 * sigma ** 2))
@@ -106,6 +152,11 @@ def fit_gauss(xdata, ydata):
     ydata = np.asarray(ydata)
 
     fit_params = gauss_params(xdata, ydata)
+    return gauss_curve(xdata, fit_params)
+
+
+# Fitted Gaussian evaluated over the range of xdata
+def gauss_curve(xdata, fit_params):
     x_test = np.linspace(min(xdata), max(xdata), 1000)
     y_test = gauss(x_test, *fit_params)
     return x_test, y_test
@@ -117,105 +168,174 @@ def get_mode(x, y):
     mode = x[peak_loc]
     return mode, peak_value
 
+# Stands in for a recalibration whose Gaussian fits did not converge
+class FitError(Exception):
+    pass
+
+
+def fit_error(fit):
+    return FitError(f"Gaussian fit did not converge after {fit['trials']} trials")
+
+
 # Analyze results of multisensory experiment: returns amount of temporal recalibration
 def analyze(results, plot=False):
-    summ = summarize(results)
-    prev = shift_results(summ)
-
-    unique_soa = list(set(prev["soa"]))
-    unique_soa.sort()
-    percent_sync_a = []
-    percent_sync_v = []
-    percent_sync = []
-
-    # Filter based on previous trial asynchrony condition
-    prev_a_idx = np.where(prev["prev_lead"] == "audio")
-    prev_a = {k: v[prev_a_idx] for k, v in prev.items()}
-    prev_v_idx = np.where(prev["prev_lead"] == "visual")
-    prev_v = {k: v[prev_v_idx] for k, v in prev.items()}
-
-    # Histogram - how many of each unique SOAs
-    soa_freq = []
-
-    # Calculate percentage synchronous responses for each possible SOA
-    for soa in unique_soa:
-        soa_freq.append(len(np.where(prev["soa"] == soa)[0]))
-        percent_sync.append(get_soa_synchrony(soa, prev))
-        percent_sync_a.append(get_soa_synchrony(soa, prev_a))
-        percent_sync_v.append(get_soa_synchrony(soa, prev_v))
-
-    # Fit Gaussians to response data
-    x_a, y_a = fit_gauss(unique_soa, percent_sync_a)
-    x_v, y_v = fit_gauss(unique_soa, percent_sync_v)
-
-    a_mode, a_mode_y = get_mode(x_a, y_a)
-    v_mode, v_mode_y = get_mode(x_v, y_v)
-    tr = v_mode - a_mode
-
-    # Visualize
+    return recalibration(results, plot)["tr"]
+
+
+# Temporal recalibration with the Gaussians fitted after audio- (a_) and visual-leading (v_) trials
+# Fit diagnostics are included; a fit that did not converge gives NaN parameters and tr
+def recalibration(results, plot=False):
+    synchrony = soa_synchrony(shift_results(as_table(results)), runs=1)
+    fit = fit_synchrony(synchrony, [len(results)])[0]
     if plot:
-        plt.figure()
-        plt.plot(
-            unique_soa, np.multiply(percent_sync_a, 100), ".", label="t-1:A", color="blue"
-        )
-        plt.plot(x_a, np.multiply(y_a, 100), "-", color="blue")
+        plot_recalibration(synchrony, fit)
+    return fit
+
+
+# Recalibration of many runs' trials, counted together in one pass and fitted in one batch
+def recalibrations(tables):
+    tables = [as_table(table) for table in tables]
+    synchrony = soa_synchrony(shift_results(TrialTable.concatenate(tables)), runs=len(tables))
+    return fit_synchrony(synchrony, [len(table) for table in tables])
+
+
+# Fits Gaussians to the synchrony curves of every run (see soa_synchrony and gaussfit.py),
+# each over the SOAs it presented; the modes are read from the fitted centres. Noisy curves
+# can come out differently than with gauss_params (see gaussfit.py); check "converged" and
+# the residuals before comparing recalibration across the two
+def fit_synchrony(synchrony, num_trials):
+    runs = len(num_trials)
+    present = synchrony["freq"] > 0
+    curves = np.concatenate([synchrony["percent_a"], synchrony["percent_v"]])
+    gauss_fit = fit_gaussians(synchrony["soa"], curves, np.concatenate([present, present]))
+
+    fits = []
+    for run in range(runs):
+        a, v = run, runs + run
+        fit = {
+            "tr": gauss_fit.mode[v] - gauss_fit.mode[a],
+            "a_mode": gauss_fit.mode[a],
+            "v_mode": gauss_fit.mode[v],
+            "trials": num_trials[run],
+            "converged": bool(gauss_fit.converged[a] and gauss_fit.converged[v]),
+        }
+        for prefix, curve in [("a_", a), ("v_", v)]:
+            for name in ["amp", "mu", "sigma", "residual", "iterations"]:
+                fit[prefix + name] = getattr(gauss_fit, name)[curve]
+        fits.append(fit)
+    return fits
+
+
+# Synchrony after audio- and visual-leading trials of a single run, with the fitted Gaussians
+def plot_recalibration(synchrony, fit):
+    present = synchrony["freq"][0] > 0
+    unique_soa = synchrony["soa"][present]
+    percent_sync_a = synchrony["percent_a"][0, present]
+    percent_sync_v = synchrony["percent_v"][0, present]
+    x_a, y_a = gauss_curve(unique_soa, [fit["a_amp"], fit["a_mu"], fit["a_sigma"]])
+    x_v, y_v = gauss_curve(unique_soa, [fit["v_amp"], fit["v_mu"], fit["v_sigma"]])
+    a_mode, v_mode, tr = fit["a_mode"], fit["v_mode"], fit["tr"]
+    a_mode_y = gauss(a_mode, fit["a_amp"], fit["a_mu"], fit["a_sigma"])
+    v_mode_y = gauss(v_mode, fit["v_amp"], fit["v_mu"], fit["v_sigma"])
 
-        plt.plot(
-            unique_soa, np.multiply(percent_sync_v, 100), ".", label="t-1:V", color="red"
-        )
-        plt.plot(x_v, np.multiply(y_v, 100), "-", color="red")
-
-        plt.ylabel("percent synchronous responses (%)")
-        plt.xlabel("SOA (ms)")
-        # plt.legend(
-        #     [
-        #         "t-1:A (data)",
-        #         "t-1:A (fit)",
-        #         "t-1:V (data)",
-        #         "t-1:V (fit)",
-        #     ]
-        # )
-        plt.legend()
-
-        plt.vlines(a_mode, ymin=0, ymax=100 * a_mode_y, color="blue", linestyles="dashed")
-        plt.vlines(v_mode, ymin=0, ymax=100 * v_mode_y, color="red", linestyles="dashed")
-        plt.ylim([-5, 105])
-        plt.title(f"temporal recalibration = {round(tr,2)} ms")
-
-        plt.show(block=False)
-        print("temporal recalibration =", round(tr, 5))
-
-    return tr
+    plt.figure()
+    plt.plot(
+        unique_soa, np.multiply(percent_sync_a, 100), ".", label="t-1:A", color="blue"
+    )
+    plt.plot(x_a, np.multiply(y_a, 100), "-", color="blue")
+
+    plt.plot(
+        unique_soa, np.multiply(percent_sync_v, 100), ".", label="t-1:V", color="red"
+    )
+    plt.plot(x_v, np.multiply(y_v, 100), "-", color="red")
+
+    plt.ylabel("percent synchronous responses (%)")
+    plt.xlabel("SOA (ms)")
+    # plt.legend(
+    #     [
+    #         "t-1:A (data)",
+    #         "t-1:A (fit)",
+    #         "t-1:V (data)",
+    #         "t-1:V (fit)",
+    #     ]
+    # )
+    plt.legend()
+
+    plt.vlines(a_mode, ymin=0, ymax=100 * a_mode_y, color="blue", linestyles="dashed")
+    plt.vlines(v_mode, ymin=0, ymax=100 * v_mode_y, color="red", linestyles="dashed")
+    plt.ylim([-5, 105])
+    plt.title(f"temporal recalibration = {round(tr,2)} ms")
+
+    plt.show(block=False)
+    print("temporal recalibration =", round(tr, 5))
+
+# Analyze the trials of a finished run saved in a results directory (see storage.py)
+def analyze_saved(directory, plot=False):
+    return analyze(open_results(directory).get_trials(), plot)
 
 # Run a multisensory experiment and extract behavioural data (temporal recalibration)
-def run_experiment(fA, num_min=10, runs=5):
-    trs = []
-    num_ms = num_min * 60 * 1000  # in ms
-    for i in range(runs):
-        print("Run", i + 1)
-        try:
-            exp = Experiment(duration=num_ms)
-            exp.initialize_multisensory(high_freq=fA)
-            exp.run_multisensory()
-            tr = analyze(exp.get_trials(), plot=False)
-            trs.append(tr)
-        except:
-            print("Could not complete run")
-
-    if len(trs) == 0:
-        trs = [0] * runs
-    return trs
+# cache: runcache.RunCache keeping the trials of every run, so only new runs are simulated
+def run_experiment(fA, num_min=10, runs=5, seed=None, workers=None, chunksize=None, cache=None):
+    return run_experiments([fA], num_min, runs, seed, workers, chunksize, cache)[0]
+
+# Simulate a chunk of tasks as the lanes of one batched simulation; returns the trials of each task
+def simulate_trials(tasks):
+    num_ms = tasks[0].num_min * 60 * 1000  # in ms
+    assert all(task.num_min == tasks[0].num_min for task in tasks), "Tasks in a chunk must share num_min"
+
+    exp = EnsembleExperiment(duration=num_ms, n=len(tasks), seeds=[task.seed for task in tasks])
+    exp.initialize_multisensory(high_freq=[task.fA for task in tasks])
+    exp.run_multisensory(record=False)
+    return [exp.get_trials(lane) for lane in range(len(tasks))]
+
+# Simulate a chunk of tasks as the lanes of one batched simulation
+# Returns the temporal recalibration of each task, or a TaskFailure if its fit did not converge
+def simulate_recalibration(tasks):
+    return fit_tasks(tasks, simulate_trials(tasks))
+
+# Temporal recalibration of each task from its trials, fitted together
+def fit_tasks(tasks, tables):
+    done = [t for t, table in enumerate(tables) if not isinstance(table, TaskFailure)]
+    results = list(tables)
+    for t, fit in zip(done, recalibrations([tables[t] for t in done])):
+        results[t] = fit["tr"] if fit["converged"] else TaskFailure(tasks[t], fit_error(fit))
+    return results
+
+# Run every (fA, run) combination across worker processes (see parallel.py)
+# Returns one list of temporal recalibration values per fA, in run order
+def run_experiments(freqs, num_min=10, runs=5, seed=None, workers=None, chunksize=None, cache=None):
+    tasks = make_tasks(freqs, num_min, runs, seed)
+    if cache is None:
+        results = run_parallel(simulate_recalibration, tasks, workers, chunksize)
+    else:
+        simulate = lambda missing: run_parallel(simulate_trials, missing, workers, chunksize)
+        results = fit_tasks(tasks, cache.task_trials(tasks, simulate))
+
+    all_trs = []
+    for f in range(len(freqs)):
+        trs = []
+        for i, result in enumerate(results[f * runs : (f + 1) * runs]):
+            print("Run", i + 1)
+            if isinstance(result, TaskFailure):
+                print("Could not complete run:", repr(result.error))
+            else:
+                trs.append(result)
+
+        if len(trs) == 0:
+            trs = [0] * runs
+        all_trs.append(trs)
+    return all_trs
 
 # Compare influence of fA on amount of temporal recalibration
-def compare_freqs(freqs=[15,20,25,30]):
+def compare_freqs(freqs=[15,20,25,30], seed=None, workers=None, cache=None):
     freq_obs = []
     freq_mean = []
     freq_sd = []
 
-    for freq in freqs:
+    all_trs = run_experiments(freqs, seed=seed, workers=workers, cache=cache)
+    for freq, trs in zip(freqs, all_trs):
         print("-----\nFreq:", freq)
 
-        trs = run_experiment(fA=freq)
         freq_mean.append(np.mean(trs))
         freq_sd.append(np.std(trs))
         freq_obs.append(freq)
@@ -0,0 +1,59 @@
+import numpy as np
+from analysis import *
+
+""" Bootstrap confidence intervals of temporal recalibration from the trials of one run """
+
+# A resample draws, with replacement, as many trials as the run has from its pairs of
+# (previous lead, SOA, response), so each keeps the lead of the trial before it. All the
+# resamples of a batch are counted together by soa_synchrony, each as its own run, and
+# their synchrony curves fitted in one call to fit_gaussians.
+
+
+# Temporal recalibration of every resample
+# prev: output of shift_results for one run; draws: (resamples, trials) indices into it
+def resampled_tr(prev, draws):
+    resamples, trials = draws.shape
+    resampled = {name: prev[name][draws].ravel() for name in ["soa", "prev_lead", "response"]}
+    resampled["run"] = np.repeat(np.arange(resamples), trials)
+
+    synchrony = soa_synchrony(resampled, runs=resamples)
+    return synchrony_tr(synchrony["soa"], synchrony["sync"], synchrony["async"], synchrony["freq"])
+
+
+# Temporal recalibration of every run from its response counts (see soa_synchrony)
+# sync, a_sync: (runs, lead code, SOA) counts; freq: (runs, SOA) trials at each SOA
+def synchrony_tr(soas, sync, a_sync, freq):
+    runs = len(sync)
+    sync = np.concatenate([sync[:, AUDIO], sync[:, VISUAL]])
+    total = sync + np.concatenate([a_sync[:, AUDIO], a_sync[:, VISUAL]])
+    curves = np.divide(sync, total, out=np.zeros(total.shape), where=total > 0)
+    present = np.concatenate([freq > 0, freq > 0])
+    fit = fit_gaussians(soas, curves, present)
+    return fit.mode[runs:] - fit.mode[:runs]
+
+
+# Bootstrap distribution and percentile confidence interval of a run's temporal recalibration
+# results: trials of one run; level: coverage of the interval
+# batch: resamples fitted together (bounds memory to about batch x trials values)
+# Resamples whose fits did not converge are left out of the interval
+def bootstrap_recalibration(results, resamples=1000, level=0.95, rng=None, batch=250):
+    rng = np.random.default_rng(rng)
+    prev = shift_results(as_table(results))
+    trials = len(prev["soa"])
+
+    samples = np.full(resamples, np.nan)
+    for start in range(0, resamples if trials else 0, batch):
+        size = min(batch, resamples - start)
+        samples[start : start + size] = resampled_tr(prev, rng.integers(0, trials, (size, trials)))
+
+    valid = samples[np.isfinite(samples)]
+    tail = 100 * (1 - level) / 2
+    low, high = np.percentile(valid, [tail, 100 - tail]) if len(valid) else (np.nan, np.nan)
+    return {
+        "tr": recalibration(results)["tr"],
+        "low": low,
+        "high": high,
+        "level": level,
+        "samples": samples,
+        "converged": len(valid) / resamples,
+    }
@@ -0,0 +1,156 @@
+import os
+import gzip
+import copy
+import pickle
+import hashlib
+import numpy as np
+from experiments import *
+
+""" Checkpoints of runs partway through: save to disk, resume, and fork into branches """
+
+# A checkpoint holds an experiment between two steps: its modules, stimulus (with its
+# cursors), event schedule, cost accounting, trials and random generator, together with
+# the series simulated so far. Saved checkpoints are pickled and gzip-compressed, keeping
+# only the steps already simulated of each series.
+
+
+class Checkpoint:
+    # exp: experiment at step, started with start_multisensory or start_entrainment
+    # series: full-length series being filled, as run or run_multisensory create them
+    # key: run_key of exp before the run started
+    def __init__(self, exp, step, series, multisensory=False, key=None):
+        self.experiment = exp
+        self.step = step
+        self.series = series
+        self.multisensory = multisensory
+        self.key = key
+
+    # Checkpoint at step 0 of a new run of exp
+    @classmethod
+    def start(cls, exp, multisensory=False):
+        assert exp.recording is None, "Checkpointed runs keep full series; use no Recording"
+        key = run_key(exp, multisensory)
+        if multisensory:
+            exp.start_multisensory()
+            series = exp.initialize_timeseries(6)
+        else:
+            exp.start_entrainment()
+            series = exp.entrainment_series(exp.initialize_timeseries(6))
+        return cls(exp, 0, series, multisensory, key)
+
+    def done(self):
+        exp = self.experiment
+        return self.step >= exp.duration or (self.multisensory and exp.finished)
+
+    # Runs the experiment on to step stop (the end of the session by default)
+    def advance(self, stop=None, skip_ahead=False):
+        exp = self.experiment
+        stop = exp.duration if stop is None else min(stop, exp.duration)
+        if stop <= self.step or self.done():
+            return
+        views = [values[self.step : stop] for values in self.series]
+
+        if self.multisensory:
+            stop = exp.advance_multisensory(self.step, stop, views, skip_ahead)
+        else:
+            x, cost, total_cost, y, ym1, ym1a, ym1b, ym2 = views
+            exp.costs.record_into(cost, total_cost, self.step)
+            exp.advance(self.step, stop, (x, cost, total_cost, y, ym1, ym1a, ym1b, ym2), skip_ahead)
+        self.step = stop
+
+    # Stores the results of a finished run in the experiment, as run or run_multisensory would
+    def finish(self):
+        exp = self.experiment
+        if self.multisensory:
+            exp.add_multisensory_results(self.series)
+        else:
+            x, cost, total_cost = self.series[:3]
+            exp.costs.record_into(cost, total_cost, 0)
+            exp.add_entrainment_results(self.series)
+        return exp
+
+    # Independent copies of this checkpoint, one per change; each change is called with
+    # its copy's experiment to set up that branch, e.g. a different fA for the rest of a run:
+    # lambda exp: [mod.set_burst_frequency(15) for mod in (exp.audio, exp.visual)]
+    def fork(self, changes):
+        branches = []
+        for change in changes:
+            branch = copy.deepcopy(self)
+            change(branch.experiment)
+            branches.append(branch)
+        return branches
+
+    def save(self, path):
+        # Written next to the old checkpoint first, so a crash while saving keeps it intact
+        with gzip.open(path + ".tmp", "wb", compresslevel=6) as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    # Only the simulated steps of the series are saved, and the time axis is rebuilt on loading
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["series"] = [values[: self.step].copy() for values in self.series]
+        state["time"] = hasattr(self.experiment, "time")
+
+        if state["time"]:
+            exp = state["experiment"] = copy.copy(self.experiment)
+            del exp.time
+            results = getattr(exp.result, "results", {})
+            if results.get("time") is self.experiment.time:
+                exp.result = copy.copy(exp.result)
+                exp.result.results = dict(results, time=None)
+        return state
+
+    def __setstate__(self, state):
+        exp = state["experiment"]
+        series = []
+        for values in state.pop("series"):
+            full = np.zeros((exp.duration,), dtype=values.dtype)
+            full[: len(values)] = values
+            series.append(full)
+        self.series = series
+
+        if state.pop("time"):
+            exp.time = np.linspace(0, exp.duration, exp.duration, endpoint=False)
+            results = getattr(exp.result, "results", {})
+            if "time" in results and results["time"] is None:
+                results["time"] = exp.time
+        self.__dict__.update(state)
+
+
+# Identifies a run by what determines it: the kind of run, its duration and end, the
+# stimulus, the state of the random generator stimuli are drawn from and the modules
+def run_key(exp, multisensory=False):
+    names = ["audio", "visual", "integrator"] if multisensory else ["m0", "m1", "m2"]
+    parts = [
+        multisensory,
+        exp.duration,
+        getattr(exp, "end_time", None),
+        getattr(exp, "stim", None),
+        exp.rng.bit_generator.state,
+        [getattr(exp, name, None) for name in names],
+    ]
+    return hashlib.sha256(pickle.dumps(parts)).hexdigest()
+
+
+def load_checkpoint(path):
+    with gzip.open(path) as file:
+        return pickle.load(file)
+
+
+# Runs exp to the end, saving a checkpoint at path every `every` steps
+# A run interrupted (e.g. by a crash) picks up from the checkpoint at path when called again
+# with the same experiment; a checkpoint of any other run at path raises ValueError
+# Returns the experiment that finished, holding the results
+def run_checkpointed(exp, path, every=60000, multisensory=False, skip_ahead=False):
+    if os.path.exists(path):
+        checkpoint = load_checkpoint(path)
+        if getattr(checkpoint, "key", None) != run_key(exp, multisensory):
+            raise ValueError(f"Checkpoint at {path} belongs to a different run")
+    else:
+        checkpoint = Checkpoint.start(exp, multisensory)
+
+    while not checkpoint.done():
+        checkpoint.advance(checkpoint.step + every, skip_ahead)
+        checkpoint.save(path)
+    return checkpoint.finish()
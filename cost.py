@@ -0,0 +1,93 @@
+import numpy as np
+
+""" Streaming cost accounting for entrainment experiments """
+
+# Sources of cost, in the order they are summed each step
+SOURCES = ["prediction", "m1-A", "m1-B", "m0"]
+
+
+class CostAccumulator:
+    # window: number of most recent steps covered by the rolling statistics
+    # record: keep the cost of every step; otherwise only steps given to record_into
+    def __init__(self, duration, window=1000, record=True):
+        self.duration = duration
+        self.window = window
+        self.cost = np.zeros((duration,) if record else (0,))
+        self.total_cost = np.zeros((duration,) if record else (0,))
+        self.offset = 0  # step held at index 0 of cost and total_cost
+        self.steps = 0
+
+        # Running totals: overall, then one per source
+        self.totals = np.zeros(len(SOURCES) + 1)
+        # Running totals as they were after each of the last window + 1 steps
+        self.history = np.zeros((window + 1, len(SOURCES) + 1))
+
+    # Record the cost of step i, given the cost from each source
+    # err_m0: M0 output when it signalled an error, 0 otherwise
+    def add(self, i, err_pred, err_m1a, err_m1b, err_m0):
+        cost = err_pred + err_m1a + err_m1b
+        if err_m0 != 0:
+            cost += err_m0
+
+        self.totals += (cost, err_pred, err_m1a, err_m1b, err_m0)
+        self.cost[i - self.offset] = cost
+        self.total_cost[i - self.offset] = self.totals[0]
+        self.history[i % (self.window + 1)] = self.totals
+        self.steps = i + 1
+
+    # Record steps i, ..., i + steps - 1 as free of cost
+    def skip(self, i, steps):
+        self.total_cost[i - self.offset : i - self.offset + steps] = self.totals[0]
+        recent = np.arange(max(i, i + steps - self.window - 1), i + steps)
+        self.history[recent % (self.window + 1)] = self.totals
+        self.steps = max(self.steps, i + steps)
+
+    # Record steps i, ..., stop - 1 (whole periods) as repeats of the `period` steps before
+    # them, over which the running totals grew by delta. Per-step and total costs come out
+    # as if simulated; the rolling statistics cover the repeated steps (with the totals
+    # per source only up to rounding) until window more steps are recorded
+    def repeat(self, i, stop, period, delta):
+        assert (stop - i) % period == 0, "Repeat whole periods"
+        lo, hi = i - self.offset, stop - self.offset
+        cycles = (stop - i) // period
+        self.cost[lo:hi] = np.tile(self.cost[lo - period : lo], cycles)
+        # Added up one step after the other, as add does
+        self.total_cost[lo:hi] = np.cumsum(np.concatenate(([self.totals[0]], self.cost[lo:hi])))[1:]
+
+        self.totals[1:] += cycles * delta[1:]
+        self.totals[0] = self.total_cost[hi - 1]
+        recent = np.arange(max(i, stop - self.window - 1), stop)
+        self.history[recent % (self.window + 1)] = self.totals
+        self.steps = max(self.steps, stop)
+
+    # Record the cost of the following steps, from step offset on, into the given arrays
+    def record_into(self, cost, total_cost, offset):
+        self.cost = cost
+        self.total_cost = total_cost
+        self.offset = offset
+
+    def get_total(self):
+        return self.totals[0]
+
+    # Totals accumulated by each source so far
+    def get_breakdown(self):
+        return dict(zip(SOURCES, self.totals[1:]))
+
+    # Totals accumulated over the last window steps, overall then per source
+    def window_totals(self):
+        if self.steps <= self.window:
+            return self.totals.copy()
+        return self.totals - self.history[self.steps % (self.window + 1)]
+
+    # Rolling statistics that can be read while the experiment runs
+    def stats(self):
+        span = min(self.steps, self.window)
+        window = self.window_totals()
+        return {
+            "steps": self.steps,
+            "total": self.totals[0],
+            "window sum": window[0],
+            "window mean": window[0] / span if span else 0,
+            "breakdown": self.get_breakdown(),
+            "window breakdown": dict(zip(SOURCES, window[1:])),
+        }
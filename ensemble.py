@@ -0,0 +1,741 @@
+import numpy as np
+from inputs import *
+from modules import *
+from experiments import Results
+from trialtable import TrialTable
+
+""" Vectorized ensembles: N independent copies of a module advanced in lockstep """
+
+
+# Broadcast a scalar or per-lane parameter to one value per lane
+def lane_values(value, n, dtype=float):
+    return np.broadcast_to(np.asarray(value, dtype=dtype), (n,)).copy()
+
+
+# Select all lanes, or only those flagged in a boolean mask
+def lane_mask(active, n):
+    return np.ones(n, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+
+
+# Base oscillator ensemble, mirrors modules.Module
+class ModuleEnsemble:
+    # frequency: in Hertz (cycles/sec), scalar or one value per lane
+    def __init__(self, name, n, frequency, phase=0, amplitude=1):
+        self.name = name
+        self.n = n
+        self.initial_freq = lane_values(frequency, n)
+        self.freq_hertz = self.initial_freq.copy()
+        self.amplitude = lane_values(amplitude, n)
+        self.phase = lane_values(phase, n)
+        self.period = np.full(n, 360.0)
+        self.phase_shifts = np.zeros(n, dtype=int)
+        self.angle = np.zeros(n)
+        self.inhibition = np.full(n, -1.0)
+
+    def get_name(self):
+        return self.name
+
+    def get_angle(self):
+        return self.angle
+
+    def set_angle(self, angle):
+        self.angle = lane_values(angle, self.n)
+
+    def get_amplitude(self):
+        return self.amplitude
+
+    # Resets oscillators of the given lanes to minimum inhibition
+    def reset(self, active=None):
+        self.angle[lane_mask(active, self.n)] = 270
+
+    def is_min(self):
+        return np.rint(self.angle) == 270
+
+    # Rectified sine output of the current angle, per lane
+    def output(self):
+        return waveforms.rectified(self.angle, self.amplitude)
+
+    # Update oscillators by 1 time step; lanes outside active are left untouched
+    def pulse(self, active=None):
+        y = self.output()
+        angle = (self.angle + self.freq_hertz) % 360
+        if active is None:
+            self.angle = angle
+            self.inhibition = y
+        else:
+            self.angle = np.where(active, angle, self.angle)
+            self.inhibition = np.where(active, y, self.inhibition)
+        return y, self.angle
+
+    def reset_initial(self, active=None):
+        active = lane_mask(active, self.n)
+        self.freq_hertz[active] = self.initial_freq[active]
+        self.period[active] = 360
+        self.phase_shifts[active] = 0
+
+
+class SensoryEnsemble(ModuleEnsemble):
+    def __init__(self, name, n, frequency, phase=0, amplitude=1, fA=12, fP=270):
+        super().__init__(name, n, frequency, phase, amplitude)
+
+        self.bursting = np.zeros(n, dtype=bool)
+        self.current_burst = np.zeros(n, dtype=int)
+        self.slot_count = np.zeros(n, dtype=int)
+
+        # Define sensory registration slots
+        self.burst_phase = lane_values(fP, n)
+        self.burst_freq = lane_values(fA, n)
+        self.max_slots = np.full(n, 5)
+        self.burst_duration = np.round(360 // self.burst_freq)
+
+        self.burster = ModuleEnsemble(
+            "burst", n, frequency=self.burst_freq, amplitude=0.5, phase=180
+        )
+        self.burster.set_angle(180)
+
+    # Shifts preferred phase of bursts by sign cycles of fast bursts, per lane
+    def adjust_phase(self, sign, active=None):
+        shift = lane_mask(active, self.n) & (sign != 0)
+        ratio = (self.burst_duration / self.period) * 360
+        burst_phase = (self.burst_phase + ratio * sign) % 360
+        self.burst_phase[shift] = np.round(burst_phase[shift])
+
+    def reset_fastphase(self, active=None):
+        active = lane_mask(active, self.n)
+        cycle_degrees = (self.burst_duration / self.period) * 360
+        burst_phase = self.angle - np.round(self.max_slots * cycle_degrees / 2, 0)
+        self.burst_phase[active] = burst_phase[active]
+
+    # Resets slot counter (exit burst mode)
+    def reset_slots(self, active=None):
+        active = lane_mask(active, self.n)
+        self.bursting[active] = False
+        self.slot_count[active] = 1
+        self.current_burst[active] = 0
+
+    def pulse(self, stimulus):
+        y, _ = super().pulse()
+
+        # enter bursting mode
+        enter = np.rint(self.angle) == self.burst_phase
+        enter &= ~self.bursting
+        if enter.any():
+            self.bursting |= enter
+            self.slot_count[enter] = 1
+            self.current_burst[enter] = 0
+
+        # get rank number
+        reg = self.slot_count * (self.bursting & (stimulus != 0))
+
+        # move on to the next slot, leaving burst mode after the last one
+        rollover = self.bursting & (self.current_burst == self.burst_duration)
+        if rollover.any():
+            self.current_burst[rollover] = 0
+            self.slot_count[rollover] += 1
+            self.reset_slots(rollover & (self.slot_count > self.max_slots))
+
+        if self.bursting.any():
+            b_y, _ = self.burster.pulse(self.bursting)
+            b_y = b_y - self.burster.get_amplitude() / 2
+            y = np.where(self.bursting, y + b_y, y)
+            self.current_burst += self.bursting
+
+        return y, reg  # amplitude and slot in which input was registered, if at all
+
+
+# Integrator
+class M3Ensemble(ModuleEnsemble):
+    def __init__(self, name, n, frequency=10, phase=0, amplitude=1):
+        super().__init__(name, n, frequency, phase, amplitude)
+        self.calibrating = np.zeros(n, dtype=bool)
+        self.calibBegin = np.full(n, np.nan)
+        self.recal = np.full(n, np.nan)
+
+    def pulse(self, reg1, reg2, active=None):
+        y, x = super().pulse(active)
+        y = y - self.amplitude / 2  # oscillate around 0
+
+        # Attempt to bind inputs
+        sync = np.where((reg1 == reg2) & (reg1 != 0), 1, -1)
+
+        # Determine if (and how much) recalibration is required
+        recal = reg1 - reg2
+
+        # Begin recalibration pulse
+        begin = recal != 0
+        if active is not None:
+            begin &= active
+        if begin.any():
+            self.calibrating[begin] = True
+            self.calibBegin[begin] = np.rint(self.angle[begin])
+            self.recal[begin] = recal[begin] * 2
+
+        if self.calibrating.any():
+            listening = self.calibrating & ~begin
+            if active is not None:
+                listening &= active
+
+            # Amplitude modulated by magnitude of recalibration
+            y = np.where(listening, y * np.abs(self.recal), y)
+
+            # End recalibration pulse after 1 cycle
+            end = listening & (np.rint(self.angle) == self.calibBegin)
+            self.calibrating[end] = False
+            self.calibBegin[end] = np.nan
+            self.recal[end] = np.nan
+
+        return y, x, sync, recal
+
+
+class M0Ensemble(ModuleEnsemble):
+    def __init__(self, name, n, frequency, phase=0, amplitude=1):
+        super().__init__(name, n, frequency, phase, amplitude)
+        self.missed_inputs = np.zeros(n, dtype=int)
+
+    def pulse(self, feedback_m2=0):
+        y = self.output()
+        angle = (self.angle + self.freq_hertz) % 360
+        self.angle = np.where(feedback_m2 != 1, angle, self.angle)
+        return y, self.angle
+
+    # two possible sources of error:
+    # (+1) unexpected input
+    # (-1) expectation unmet
+    def error(self, stimulus, x):
+        at_min = np.rint(x) == 270
+        present = stimulus == 1
+        return np.where(present & ~at_min, 1, np.where(at_min & ~present, -1, 0))
+
+    def receive_pulse(self, stimulus, feedback_m2):
+        y, x = self.pulse(feedback_m2)
+        err = self.error(stimulus, x)
+        self.missed_inputs[stimulus == 1] = 0
+        return y, x, err, stimulus
+
+    def receive_feedback(self, feedback):
+        # if unexpected input
+        unexpected = feedback == 1
+        if unexpected.any():
+            self.phase_shifts += unexpected
+            adjust = unexpected & (self.phase_shifts > 1)
+            new_period = (90 + self.angle + self.missed_inputs * 360) / self.freq_hertz
+            self.freq_hertz = np.where(adjust, 360 / new_period, self.freq_hertz)
+            self.period = np.where(adjust, new_period, self.period)
+
+            self.reset(unexpected)
+
+        # if expectation unmet
+        self.missed_inputs += feedback == -1
+
+    def reset_initial(self, active=None):
+        super().reset_initial(active)
+        self.missed_inputs[lane_mask(active, self.n)] = 0
+
+
+class M0NestedEnsemble(M0Ensemble):
+    nested_amplitude = 0.3
+
+    def __init__(self, name, n, frequency, phase=0, amplitude=1, high_freq=12):
+        super().__init__(name, n, frequency, phase, amplitude)
+
+        # to add bursts
+        self.high_freq = lane_values(high_freq, n)
+        self.nested = ModuleEnsemble(
+            "burst", n, self.high_freq, amplitude=self.nested_amplitude
+        )
+        self.burst_pos = np.zeros(n, dtype=int)
+
+    def pulse(self, feedback_m2=0):
+        y, x = super().pulse(feedback_m2)
+
+        b_y, b_x = self.nested.pulse()
+        b_y = b_y - (self.nested.amplitude / 2)
+
+        y = y + b_y
+        self.burst_pos += 1
+
+        return y, x
+
+    # Nested variants keep counting missed inputs across stimuli
+    def receive_pulse(self, stimulus, feedback_m2):
+        y, x = self.pulse(feedback_m2)
+        return y, x, self.error(stimulus, x), stimulus
+
+
+class M0NestedPhasemodEnsemble(M0NestedEnsemble):
+    nested_amplitude = 0.5
+    # preferred phase: when nested oscillation will have peak amplitude
+    pref_phase = 90
+
+    def pulse(self, feedback_m2=0):
+        y, x = M0Ensemble.pulse(self, feedback_m2)
+
+        b_y, b_x = self.nested.pulse()
+        b_y = b_y - (self.nested.amplitude / 2)
+
+        scale = 1 - (np.abs(self.pref_phase - self.angle) / 180)
+
+        b_y = b_y * scale
+
+        y = y - np.abs(b_y)
+        self.burst_pos += 1
+
+        return y, x
+
+
+class subM1Ensemble(ModuleEnsemble):
+    def __init__(self, name, n, frequency, phase=0, amplitude=1):
+        super().__init__(name, n, frequency, phase=phase, amplitude=amplitude)
+        self.entrained = np.zeros(n, dtype=bool)
+        self.missed_inputs = np.zeros(n, dtype=int)
+
+    def reset_initial(self, active=None):
+        super().reset_initial(active)
+        active = lane_mask(active, self.n)
+        self.entrained[active] = False
+        self.missed_inputs[active] = 0
+
+    def calc_error(self):
+        return 0.25 * self.output()
+
+    def pulse(self, stimulus):
+        present = stimulus != 0
+        err = np.where(present, self.calc_error(), 0)
+        self.reset(present)
+
+        y, x = super().pulse()
+        return y, err
+
+
+# Pulses a burster in the lanes that are bursting and adds it to their output y
+def add_bursts(module, y):
+    burst = module.bursting & (module.burst_pos < module.burst_duration)
+    if burst.any():
+        b_y, b_x = module.burster.pulse(burst)
+        b_y = b_y - (module.burster.amplitude / 2)
+        y = np.where(burst, y + b_y, y)
+        module.burst_pos += burst
+
+    done = module.burst_pos >= module.burst_duration
+    module.burst_pos[done] = 0
+    module.bursting[done] = False
+    return y
+
+
+class M1Ensemble(ModuleEnsemble):
+    def __init__(
+        self, name, n, frequency, phase=0, amplitude=1, burst_freq=12, burst_duration=50
+    ):
+        super().__init__(name, n, frequency, phase, amplitude)
+        self.subm1a = subM1Ensemble("m1-A", n, frequency)
+        self.subm1b = subM1Ensemble("m1-B", n, frequency)
+        self.missed_inputs = np.zeros(n, dtype=int)
+
+        # to add bursts
+        self.burst_freq = lane_values(burst_freq, n)
+        self.burster = ModuleEnsemble("burst", n, self.burst_freq, amplitude=0.5)
+        self.burst_duration = lane_values(burst_duration, n, dtype=int)
+        self.burst_pos = np.zeros(n, dtype=int)
+        self.bursting = np.zeros(n, dtype=bool)
+
+    def receive_error(self, err, stimulus, m0_angle, m0frequency):
+        feedback = err
+        y, x = super().pulse()
+
+        # positive error, unexpected input
+        unexpected = feedback == 1
+        if unexpected.any():
+            self.bursting |= unexpected
+            # equivalent to phase_shifts of M0
+            self.phase_shifts += unexpected
+            adjust = unexpected & (self.phase_shifts > 1)
+            new_period = (90 + m0_angle + (self.missed_inputs * 360)) / m0frequency
+            new_freq = 360 / new_period
+
+            # if new frequency appeared in inputs, entrain subM1A, if it's not already
+            # if subM1A is entrained but new frequency in inputs, entrain subM1B
+            entrain_a = adjust & ~self.subm1a.entrained
+            entrain_b = adjust & self.subm1a.entrained & ~self.subm1b.entrained
+            for sub, retune in [(self.subm1a, entrain_a), (self.subm1b, entrain_a | entrain_b)]:
+                sub.period[retune] = new_period[retune]
+                sub.freq_hertz[retune] = new_freq[retune]
+            self.subm1a.entrained |= entrain_a
+            self.subm1b.entrained |= entrain_b
+
+            self.missed_inputs[unexpected] = 0
+
+        # expected input, found none. keep track but otherwise change nothing
+        self.missed_inputs += feedback == -1
+
+        # take care of bursting
+        y = add_bursts(self, y)
+
+        return y, x, feedback, stimulus
+
+    def reset_initial(self, active=None):
+        super().reset_initial(active)
+        self.missed_inputs[lane_mask(active, self.n)] = 0
+
+
+# M2's pattern/time lists are stored as padded (lanes, capacity) arrays with a length per lane
+class M2Ensemble(ModuleEnsemble):
+    def __init__(
+        self,
+        name,
+        n,
+        frequency,
+        m0,
+        m1,
+        submodules,
+        phase=0,
+        amplitude=1,
+        burst_freq=12,
+        burst_duration=50,
+    ):
+        super().__init__(name, n, frequency, phase, amplitude)
+        self.lanes = np.arange(n)
+        self.value = np.zeros(n, dtype=int)
+        self.duration = self.period.copy()
+        self.Aduration = np.zeros(n)
+        self.Bduration = np.zeros(n)
+        self.threshold = np.full(n, 3)
+        self.m0 = m0
+        self.m1 = m1
+        self.subA, self.subB = submodules
+        self.pattern = np.zeros((n, 4), dtype=int)
+        self.time = np.zeros((n, 4))
+        self.time[:, 0] = self.period
+        self.length = np.ones(n, dtype=int)
+        self.negatives = np.zeros(n, dtype=int)  # occurrences of -1 in pattern
+        self.i = np.zeros(n, dtype=int)
+
+        # Take care of bursting
+        self.burst_freq = lane_values(burst_freq, n)
+        self.burster = ModuleEnsemble("burst", n, self.burst_freq, amplitude=0.5)
+        self.burst_duration = lane_values(burst_duration, n, dtype=int)
+        self.burst_pos = np.zeros(n, dtype=int)
+        self.bursting = np.zeros(n, dtype=bool)
+
+    def get_pattern(self, lane):
+        return list(self.pattern[lane, : self.length[lane]])
+
+    def get_time(self, lane):
+        return list(self.time[lane, : self.length[lane]])
+
+    # Appends value to the pattern of the given lanes, one slot of step_duration later
+    def append(self, active, value, step_duration):
+        if not active.any():
+            return
+        if self.length.max() == self.pattern.shape[1]:  # double capacity
+            self.pattern = np.concatenate([self.pattern, np.zeros_like(self.pattern)], axis=1)
+            self.time = np.concatenate([self.time, np.zeros_like(self.time)], axis=1)
+
+        lanes = self.lanes[active]
+        end = self.length[lanes]
+        self.duration[lanes] += step_duration[lanes]
+        self.pattern[lanes, end] = value
+        self.time[lanes, end] = self.time[lanes, end - 1] + step_duration[lanes]
+        self.length[lanes] += 1
+        self.negatives[lanes] += value == -1
+        self.angle[lanes] = 0
+        self.i[lanes] = 0
+
+    def pulse(self):
+        y = self.pattern[self.lanes, self.i]
+        self.value = y.copy()
+        self.angle = self.angle + self.freq_hertz
+
+        advance = self.angle > np.rint(self.time[self.lanes, self.i])
+        if advance.any():
+            self.i = np.where(advance, (self.i + 1) % self.length, self.i)
+            self.angle = np.where(advance, self.angle % self.duration, self.angle)
+        return y, self.angle
+
+    def send_feedback(self):
+        # output 1 if m0 should reset i.e. if the submodule it's listening to is at / nearing a minimum
+        # output 0 otherwise
+        listening_a = (self.value == 1) & self.subA.is_min()
+        listening_b = (self.value == -1) & self.subB.is_min()
+        feedback = listening_a | listening_b
+        self.m0.reset(feedback)
+        return feedback.astype(int)
+
+    def receive_feedback(self, feedback, stimulus):
+        y, x = self.pulse()
+        present = stimulus == 1
+
+        # When subM1a first becomes entrained
+        first = present & (self.value == 0) & self.subA.entrained
+        if first.any():
+            self.value[first] = 1
+            self.Aduration[first] = 360 / self.subA.freq_hertz[first]
+            self.duration[first] = self.Aduration[first]
+            self.pattern[first, 0] = 1
+            self.time[first, 0] = self.Aduration[first]
+            self.length[first] = 1
+            self.negatives[first] = 0
+
+        # When subM1b becomes entrained
+        b_ready = (self.Bduration == 0) & self.subB.entrained
+        self.Bduration[b_ready] = 360 / self.subB.freq_hertz[b_ready]
+
+        # Build the pattern: add another M1A if it is at a minimum, else add M1B
+        listening_a = present & (self.value == 1)
+        if listening_a.any():
+            a_min = self.subA.is_min()
+            add_a = listening_a & a_min & (self.negatives == 0)
+            add_b = listening_a & ~a_min & self.subB.entrained
+            self.append(add_a, 1, self.Aduration)
+            self.append(add_b, -1, self.Bduration)
+
+        # Check missed inputs subM1a, subM1b
+        for sub, value in [(self.subA, 1), (self.subB, -1)]:
+            check = (self.value == value) & sub.is_min()
+            self.bursting |= check
+            sub.missed_inputs[check & (stimulus == 0)] += 1
+            sub.missed_inputs[check & present] = 0
+
+        # If # of missed inputs exceeds threshold, reset all modules
+        exceeded = (self.subA.missed_inputs >= self.threshold) | (
+            self.subB.missed_inputs >= self.threshold
+        )
+        if exceeded.any():
+            self.m1.reset_initial(exceeded)
+            self.subA.reset_initial(exceeded)
+            self.subB.reset_initial(exceeded)
+            self.reset_initial(exceeded)
+            self.m0.reset_initial(exceeded)
+
+        # take care of bursting
+        y = add_bursts(self, y)
+
+        return y, x
+
+    def reset_initial(self, active=None):
+        active = lane_mask(active, self.n)
+        self.pattern[active, 0] = 0
+        self.time[active, 0] = 360
+        self.length[active] = 1
+        self.negatives[active] = 0
+        self.i[active] = 0
+        self.value[active] = 0
+        self.duration[active] = 360
+        self.Aduration[active] = 0
+        self.Bduration[active] = 0
+
+
+# Ensemble counterpart of each M0 class accepted by Experiment.initialize_modules
+m0_ensembles = {
+    M0: M0Ensemble,
+    M0_nested: M0NestedEnsemble,
+    M0_nested_phasemod: M0NestedPhasemodEnsemble,
+}
+
+
+# Runs N independent experiments in lockstep; each lane reproduces one Experiment
+class EnsembleExperiment:
+    # seeds: seed, SeedSequence or Generator per lane; lane i then matches Experiment(seed=seeds[i])
+    # Without seeds, each lane gets its own child stream of a fresh SeedSequence
+    def __init__(self, duration, n, seeds=None):
+        self.duration = duration
+        self.n = n
+        if seeds is None:
+            seeds = np.random.SeedSequence().spawn(n)
+        assert len(seeds) == n, "Need one seed per lane"
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+        self.results = [Results() for _ in range(n)]
+        self.trials = [TrialTable() for _ in range(n)]
+
+    # stim_intervals: one list of inter-stimulus intervals per lane, or a single list for all lanes
+    def create_stimuli(self, stim_intervals):
+        if np.ndim(stim_intervals[0]) == 0:
+            stim_intervals = [stim_intervals] * self.n
+        assert len(stim_intervals) == self.n, "Need one interval pattern per lane"
+
+        self.time, stim = pattern_batch(self.duration, stim_intervals, self.rngs, dtype=bool)
+        self.stim = np.ascontiguousarray(stim.T)
+        for result in self.results:
+            result.add(self.time, "time")
+
+    def end(self, end_time=1000):
+        self.stim[end_time:] = 0
+
+    # interval: ms between trials; asynchronies: SOAs to draw from (see inputs.py)
+    def create_multisensory_stim(self, modalities=2, interval=720, asynchronies=None):
+        stimuli, self.trial_start, self.trial_end, self.leads, self.soas = multisensory_batch(
+            self.duration, modalities, self.rngs, 0, interval, asynchronies, dtype=bool
+        )
+        self.stim = np.ascontiguousarray(stimuli.transpose(2, 1, 0))
+        self.time = np.arange(self.duration, dtype=float)
+        for result in self.results:
+            result.add(self.time, "time")
+
+    def initialize_modules(self, m0_class=M0):
+        self.m0 = m0_ensembles[m0_class]("m0", self.n, frequency=1)
+        self.m1 = M1Ensemble("m1", self.n, frequency=1)
+        self.m2 = M2Ensemble(
+            "m2",
+            self.n,
+            frequency=1,
+            m0=self.m0,
+            m1=self.m1,
+            submodules=[self.m1.subm1a, self.m1.subm1b],
+        )
+
+    # low_freq, high_freq, max_slots: scalar or one value per lane
+    # Audio and visual modules share one ensemble: lanes [0, n) are audio, [n, 2n) visual
+    def initialize_multisensory(self, low_freq=1, high_freq=12, max_slots=5):
+        low_freq = lane_values(low_freq, self.n)
+        high_freq = lane_values(high_freq, self.n)
+        self.sensory = SensoryEnsemble(
+            "sensory", 2 * self.n, frequency=np.tile(low_freq, 2), fA=np.tile(high_freq, 2)
+        )
+        self.sensory.max_slots = np.tile(lane_values(max_slots, self.n, int), 2)
+        self.integrator = M3Ensemble("integrator", self.n, frequency=low_freq * 4)
+
+    def get_results(self, lane):
+        return self.results[lane]
+
+    def get_trials(self, lane):
+        return self.trials[lane]
+
+    # Trial end times padded with -1 (never reached) so every lane has the same length
+    def padded_trial_end(self):
+        num_trials = max(len(end) for end in self.trial_end) + 1
+        padded = np.full((self.n, num_trials), -1)
+        for lane, end in enumerate(self.trial_end):
+            padded[lane, : len(end)] = end
+        return padded
+
+    # Returns error incurred by m2 prediction, per lane
+    def calculate_error(self, m2_feedback):
+        return np.where(m2_feedback == 1, 0.5 * self.m0.output(), 0)
+
+    def register_trial(self, lane, trial_lead, trial_soa, trial_sync):
+        self.trials[lane].append(trial_lead, trial_soa, trial_sync)
+
+    # Run experiment (temporal recalibration) in every lane
+    # record: keep module traces; without it only trials are collected
+    def run_multisensory(self, record=True):
+        assert hasattr(self, "sensory"), "Must initialize multisensory modules"
+        assert hasattr(self, "integrator"), "Must initialize multisensory modules"
+
+        # Stimuli created beforehand (e.g. with another trial interval) are used as they are
+        if not hasattr(self, "trial_start"):
+            self.create_multisensory_stim()
+        n = self.n
+        lanes = np.arange(n)
+        no_reg = np.zeros(n, dtype=int)
+        audio_only = np.zeros(n, dtype=bool)
+
+        if record:
+            y_s = np.zeros((self.duration, 2 * n))
+            y_i, recal, sync = [np.zeros((self.duration, n)) for _ in range(3)]
+
+        trial_end = self.padded_trial_end()
+        trial_num = np.zeros(n, dtype=int)
+        next_end = trial_end[:, 0]
+
+        # first registered slot of the trial, audio lanes then visual lanes
+        last = np.zeros(2 * n, dtype=int)
+
+        for i in range(self.duration):
+            s0, reg = self.sensory.pulse(self.stim[i].reshape(-1))
+            i0, _, _, _ = self.integrator.pulse(no_reg, no_reg)
+
+            last = np.where(last == 0, reg, last)
+
+            ending = next_end == i
+            if ending.any():  # reset "counter
+                last_a, last_v = last[:n], last[n:]
+                i_end, _, syncInt, recalInt = self.integrator.pulse(last_a, last_v, ending)
+                i0 = np.where(ending, i_end, i0)
+
+                # ! Input missed by both modules
+                # * Solution: Shift slow phase (reset to 0) and adjust fast burst to center minimum
+                missed = np.tile(ending & (last_a == 0) & (last_v == 0), 2)
+                self.sensory.reset(missed)
+                self.sensory.reset_fastphase(missed)
+
+                last[np.tile(ending, 2)] = 0
+
+                # Record trial info
+                sync_i = syncInt.astype(float)
+                recal_i = recalInt.astype(float)
+                for lane in lanes[ending]:
+                    t = trial_num[lane]
+                    self.register_trial(
+                        lane, self.leads[lane][t], self.soas[lane][t], sync_i[lane]
+                    )
+                if record:
+                    recal[i, ending] = recal_i[ending]
+                    sync[i, ending] = sync_i[ending]
+
+                # Recalibrate audio lanes only
+                self.sensory.adjust_phase(
+                    np.concatenate([recal_i, recal_i]), np.concatenate([ending, audio_only])
+                )
+
+                trial_num += ending
+                next_end = trial_end[lanes, trial_num]
+
+            if record:
+                y_s[i] = s0
+                y_i[i] = i0
+
+        if record:
+            for lane, result in enumerate(self.results):
+                stim_a, stim_v = self.stim[:, :, lane].T.astype(float)
+                result.add(stim_a, "audio")
+                result.add(stim_v, "visual")
+                result.add(y_i[:, lane].copy(), self.integrator.name)
+                result.add(y_s[:, lane].copy(), "audio module")
+                result.add(y_s[:, n + lane].copy(), "visual module")
+                result.add(recal[:, lane].copy(), "recalibration")
+                result.add(sync[:, lane].copy(), "synchrony")
+
+    # Run regular experiment (neural entrainment) in every lane
+    def run(self):
+        if not hasattr(self, "stim"):
+            raise Exception("Must create stimulus before running experiment")
+
+        if not (hasattr(self, "m0") and hasattr(self, "m1") and hasattr(self, "m2")):
+            raise Exception("Must initialize modules before running experiment")
+
+        x, cost, y, ym1, ym1a, ym1b, ym2 = [
+            np.zeros((self.duration, self.n)) for _ in range(7)
+        ]
+
+        for i in range(self.duration):
+            feedback_m2 = self.m2.send_feedback()
+            err_pred = self.calculate_error(feedback_m2)
+
+            y[i], x[i], err0, stimulus = self.m0.receive_pulse(self.stim[i], feedback_m2)
+            ym1[i], _, feedback, stimulus = self.m1.receive_error(
+                err0, stimulus, self.m0.angle, self.m0.freq_hertz
+            )
+
+            self.m0.receive_feedback(feedback)
+
+            ym2[i], _ = self.m2.receive_feedback(feedback, stimulus)
+
+            ym1a[i], err_m1a = self.m1.subm1a.pulse(stimulus)
+            ym1b[i], err_m1b = self.m1.subm1b.pulse(stimulus)
+
+            cost[i] = err_pred + err_m1a + err_m1b
+            cost[i] = np.where(err0 != 0, cost[i] + y[i], cost[i])
+
+        total_cost = np.cumsum(cost, axis=0)
+
+        for lane, result in enumerate(self.results):
+            result.add(self.stim[:, lane].astype(float), "stim")
+            for series, name in [
+                (y, self.m0.name),
+                (ym1, self.m1.name),
+                (ym1a, self.m1.subm1a.name),
+                (ym1b, self.m1.subm1b.name),
+                (ym2, self.m2.name),
+                (cost, "cost"),
+                (total_cost, "total cost"),
+            ]:
+                result.add(series[:, lane].copy(), name)
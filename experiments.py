@@ -1,5 +1,13 @@
 from inputs import *
+from sparse import *
+from trialtable import *
 from modules import *
+from scheduler import *
+from cost import *
+from skipahead import *
+from recording import *
+import kernels
+import steadystate
 
 """ Functions to create different types of inputs """
 
@@ -16,176 +24,308 @@ class Results:
     
     def list_results(self):
         return self.results.keys()
+
+    # Zeroed series for a run to fill before adding it
+    def buffer(self, duration):
+        return np.zeros((duration,))
+
+    # Trials of a multisensory run (TrialTable)
+    def add_trials(self, trials):
+        self.trials = trials
+
+    def get_trials(self):
+        return self.trials
     
 class Experiment:
     # Initialize necessary modules
-    def __init__(self, duration):
+    # seed: seed, SeedSequence or numpy Generator for stimulus generation
+    # stimulus: optional prepared stimulus (dense array, SparseSeries or SparseStimulus)
+    # results: where to store results, e.g. a storage.DiskResults (in memory by default)
+    # recording: Recording of which series to keep and at what resolution (all, by default)
+    # analyzer: online.OnlineAnalyzer given every trial of multisensory runs, which end
+    # as soon as it is done (series stay zero from the step they ended at, end_step)
+    # cache: runcache.RunCache to reuse the results of identical runs made before
+    def __init__(self, duration, seed=None, stimulus=None, results=None, recording=None, analyzer=None, cache=None):
         self.duration = duration
-        self.result = Results()
-        self.trials = list()
-
-    def create_stimuli(self, stim_intervals):
-        self.time, self.stim, _ = pattern(self.duration, stim_intervals)
-        self.result.add(self.time, "time")
+        self.rng = np.random.default_rng(seed)
+        self.result = Results() if results is None else results
+        self.recording = recording
+        self.analyzer = analyzer
+        self.cache = cache
+        self.trials = TrialTable()
+        if stimulus is not None:
+            self.set_stimulus(stimulus)
+
+    # sparse: keep only the onset steps (see sparse.py)
+    def create_stimuli(self, stim_intervals, sparse=False):
+        self.stim_intervals = list(stim_intervals)
+        if sparse:
+            self.time = np.linspace(0, self.duration, self.duration, endpoint=False)
+            self.stim = sparse_pattern(self.duration, stim_intervals, self.rng)
+        else:
+            self.time, self.stim, _ = pattern(self.duration, stim_intervals, self.rng)
+        self.add_time()
+
+    # Uses a prepared stimulus; a SparseStimulus with trial metadata sets up multisensory trials
+    def set_stimulus(self, stimulus):
+        if isinstance(stimulus, SparseStimulus) and not stimulus.has_trials() and len(stimulus) == 1:
+            stimulus = stimulus[0]
+        self.stim = stimulus
+        if isinstance(stimulus, SparseStimulus) and stimulus.has_trials():
+            self.set_trials(stimulus.trial_start, stimulus.trial_end, stimulus.leads, stimulus.soas)
+        self.time = np.linspace(0, self.duration, self.duration, endpoint=False)
+        self.add_time()
 
     def end(self, end_time=1000):
-        self.stim[end_time:] = 0
-
-    def create_multisensory_stim(self,modalities=2):
-        stimuli, trial_start, trial_end, leads, soas = multisensory_stimuli(self.duration, modalities)
+        if isinstance(self.stim, (SparseSeries, SparseStimulus)):
+            self.stim.end(end_time)
+        else:
+            self.stim[end_time:] = 0
+        self.end_time = end_time
+
+    # sparse: keep only the onset steps of each modality (see sparse.py)
+    # interval: ms between trials; asynchronies: SOAs to draw from (see inputs.py)
+    def create_multisensory_stim(self, modalities=2, sparse=False, interval=720, asynchronies=None):
+        if sparse:
+            self.set_stimulus(
+                sparse_multisensory(self.duration, modalities, self.rng, 0, interval, asynchronies)
+            )
+            return
+        stimuli, trial_start, trial_end, leads, soas = multisensory_stimuli(
+            self.duration, modalities, self.rng, 0, interval, asynchronies
+        )
         self.stim = stimuli
+        self.set_trials(trial_start, trial_end, leads, soas)
+        self.time = np.linspace(0, self.duration, self.duration, endpoint=False)
+        self.add_time()
+
+    def set_trials(self, trial_start, trial_end, leads, soas):
         self.trial_start = trial_start
         self.trial_end = trial_end
         self.leads = leads
         self.soas = soas
-        self.time = np.linspace(0, self.duration, self.duration, endpoint=False)
-        self.result.add(self.time, "time")
+        self.schedule = stimulus_schedule(self.duration, *self.stim)
+        self.schedule.add_trials(trial_start, trial_end, leads, soas)
 
-    def initialize_modules(self, m0_class = M0):
+    # warm_start: a warmstart.WarmStartCache to start from modules already entrained to the
+    # pattern given to create_stimuli
+    def initialize_modules(self, m0_class = M0, warm_start=None):
         self.m0 = m0_class("m0", frequency=1)
         self.m1 = M1("m1", frequency=1)
         self.m2 = M2("m2", frequency=1, m0=self.m0, m1=self.m1, submodules=[self.m1.subm1a, self.m1.subm1b])
+        if warm_start is not None:
+            warm_start.entrain(self)
 
-    def initialize_multisensory(self, low_freq = 1, high_freq = 12):
+    # max_slots: registration slots per burst of the sensory modules
+    def initialize_multisensory(self, low_freq = 1, high_freq = 12, max_slots = 5):
         self.audio = Sensory("audio", frequency = low_freq, fA=high_freq)
         self.visual = Sensory("visual", frequency = low_freq, fA=high_freq)
+        self.audio.max_slots = self.visual.max_slots = max_slots
         self.integrator = M3("integrator", frequency = low_freq * 4)
 
 
     def get_results(self):
         return self.result
+
+    # With a Recording, time is recorded along with the series it keeps
+    def add_time(self):
+        if self.recording is None:
+            self.result.add(self.time, "time")
     
     def get_trials(self):
         return self.trials
+
+    # Cost accounting of the entrainment run, readable while it runs
+    def get_costs(self):
+        return self.costs
     
+    # Series of a run, allocated where the results are stored (e.g. on disk by DiskResults)
     def initialize_timeseries(self, num_series):
-        return [np.zeros((self.duration,)) for _ in range(num_series)]
+        return [self.result.buffer(self.duration) for _ in range(num_series)]
 
     # Returns error incurred by m2 prediction
     def calculate_error(self, m2_feedback):
         err_pred = 0
         if m2_feedback == 1:
-            err_pred = 0.5 * (
-                (
-                    self.m0.amplitude * (np.sin(2 * np.pi * Module.CONSTANT * self.m0.angle))
-                    + self.m0.amplitude
-                )
-                / 2
-            )
+            err_pred = 0.5 * waveforms.rectified(self.m0.angle, self.m0.amplitude)
         return err_pred
     
     def register_trial(self, trial_lead, trial_soa, trial_sync):
-        self.trials.append({"lead": trial_lead, "soa": trial_soa, "response": trial_sync})
+        self.trials.append(trial_lead, trial_soa, trial_sync)
+        if self.analyzer is not None and self.analyzer.add(trial_lead, trial_soa, trial_sync):
+            self.finished = True
  
     # Run experiment (temporal recalibration)
-    def run_multisensory(self):
+    # skip_ahead: jump over the quiet steps between events in closed form (see skipahead.py)
+    # compiled: run the whole loop as a Numba kernel when Numba is installed (see kernels.py)
+    def run_multisensory(self, skip_ahead=False, compiled=False):
+        if self.recording is not None:
+            assert not compiled, "Compiled runs keep full series; use no Recording"
+            assert self.cache is None, "Cached runs keep full series; use no Recording"
+            return self.run_recorded(multisensory=True, skip_ahead=skip_ahead)
+        self.start_multisensory()
+
+        # Runs ended early by an analyzer are not cached
+        key = None
+        stimuli = {self.audio.name: self.stim[0], self.visual.name: self.stim[1]}
+        if self.cache is not None and self.analyzer is None:
+            key = self.cache.run_key(self, "multisensory")
+            if self.cache.restore(self, key, "multisensory", stimuli):
+                return
+        series = self.initialize_timeseries(6)
+
+        # The kernel runs to the end of the session, so cannot stop early
+        if compiled and self.analyzer is None and kernels.supports_multisensory(self):
+            kernels.run_multisensory(self, series)
+        else:
+            self.advance_multisensory(0, self.duration, series, skip_ahead)
+        self.add_multisensory_results(series)
+        if key is not None:
+            self.cache.store(self, key, "multisensory", stimuli)
+
+    # Store the full-length series and trials of a multisensory run
+    def add_multisensory_results(self, series):
+        y_a, y_v, y_i, recal, sync, cost = series
+        stim_a, stim_v = self.stim
+        self.result.add(stim_a, self.audio.name)
+        self.result.add(stim_v, self.visual.name)
+        self.result.add(y_i, self.integrator.name)
+        self.result.add(y_a, "audio module")
+        self.result.add(y_v, "visual module")
+        self.result.add(recal, "recalibration")
+        self.result.add(sync, "synchrony")
+        self.result.add_trials(self.trials)
+
+    # Check modules and set up stimuli and trials of a multisensory run
+    def start_multisensory(self, sparse=False):
         assert hasattr(self, "audio"), "Must initialize multisensory modules"
         assert hasattr(self, "visual"), "Must initialize multisensory modules"
         assert hasattr(self, "integrator"), "Must initialize multisensory modules"
 
-        series = self.initialize_timeseries(6)
+        # Stimuli set up beforehand (e.g. a SparseStimulus) are used as they are
+        if not hasattr(self, "trial_start"):
+            self.create_multisensory_stim(sparse=sparse)
+        self.schedule.rewind()
+
+        self.last_a = 0
+        self.last_v = 0
+
+        self.finished = False
+        self.end_step = self.duration
+        if self.analyzer is not None:
+            self.analyzer.start(self.duration)
+
+    # Advance the multisensory modules over steps start, ..., stop - 1
+    # series hold those steps, starting from index 0 at step start
+    # Returns the step reached: before stop if the analyzer ended the session
+    def advance_multisensory(self, start, stop, series, skip_ahead=False):
+        self.offset = start
+        self.stop = stop
+        i = start
+        while i < stop and not self.finished:
+            if skip_ahead:
+                i += skip_multisensory(self, i, series)
+                if i == stop:
+                    break
+            self.step_multisensory(i, series)
+            i += 1
+
+        if self.finished:
+            self.end_step = i
+            self.analyzer.finish(i)
+        return i
+
+    # Advance the multisensory modules by time step i
+    def step_multisensory(self, i, series):
         y_a, y_v, y_i, recal, sync, cost = series
-
-
-        self.create_multisensory_stim()
         stim_a, stim_v = self.stim
-      
-        stim_a_reg = np.zeros(stim_a.shape)
-        stim_v_reg = np.zeros(stim_v.shape)
+        k = i - self.offset
 
-        stim_a_reg = stim_a
-        stim_v_reg = stim_v
+        # Trial ending at this step, if any
+        trial_num = None
+        for kind, trial in self.schedule.pop(i):
+            if kind == TRIAL_END and trial_num is None:
+                trial_num = trial
 
-        last_a = 0
-        last_v = 0
+        a0, reg_a = self.audio.pulse(stim_a[i])
 
-        for i in range(self.duration):
-            if i in self.trial_start:  # beginning of trial
-                trial_num = np.where(self.trial_start == i)[0][0]
+        v0, reg_v = self.visual.pulse(stim_v[i])
+        # i0, _, recalInt = self.integrator.pulse(reg_a, reg_v)
+        i0, _, _, recalInt = self.integrator.pulse(0,0)
+        if recalInt != 0:
+            print("Recal returned by M3", recalInt)
 
-            a0, reg_a = self.audio.pulse(stim_a_reg[i])
+        if self.last_a == 0 and reg_a != 0:
+            self.last_a = reg_a
+        if self.last_v == 0 and reg_v != 0:
+            self.last_v = reg_v
 
-            v0, reg_v = self.visual.pulse(stim_v_reg[i])
-            # i0, _, recalInt = self.integrator.pulse(reg_a, reg_v)
-            i0, _, _, recalInt = self.integrator.pulse(0,0)
-            if recalInt != 0:
-                print("Recal returned by M3", recalInt)
+        if trial_num is not None:  # reset "counter
+            i0, _, syncInt, recalInt = self.integrator.pulse(self.last_a, self.last_v)
 
-            if last_a == 0 and reg_a != 0:
-                last_a = reg_a
-            if last_v == 0 and reg_v != 0:
-                last_v = reg_v
+            recal[k] = recalInt
+            sync[k] = syncInt
 
-            if i in self.trial_end:  # reset "counter
-                i0, _, syncInt, recalInt = self.integrator.pulse(last_a, last_v)
-        
-                trial_num = np.where(self.trial_end == i)[0][0]
-                recal[i] = recalInt
-                sync[i] = syncInt
+            if self.last_a == 0 and self.last_v == 0: 
+                # ! Input missed by both modules
+                # * Solution: Shift slow phase (reset to 0) and adjust fast burst to center minimum
+                for mod in [self.audio, self.visual]:
+                    mod.reset()
+                    mod.reset_fastphase()
 
-                if last_a == 0 and last_v == 0: 
-                    # ! Input missed by both modules
-                    # * Solution: Shift slow phase (reset to 0) and adjust fast burst to center minimum
-                    for mod in [self.audio, self.visual]:
-                        mod.reset()
-                        mod.reset_fastphase()
 
+            self.last_a = 0
+            self.last_v = 0
 
-                last_a = 0
-                last_v = 0
+            # Record trial info
+            lead, soa = self.schedule.get_trial(trial_num)
+            self.register_trial(lead, soa, sync[k])
 
-                # Record trial info
-                self.register_trial(self.leads[trial_num], self.soas[trial_num], sync[i])
+            # Recalibrate
+            self.audio.adjust_phase(recal[k])
 
-                # Recalibrate
-                self.audio.adjust_phase(recal[i])
-               
-            y_a[i] = a0
-            y_v[i] = v0
-            y_i[i] = i0
-
-        self.result.add(stim_a, self.audio.name)
-        self.result.add(stim_v, self.visual.name)
-        self.result.add(y_i, self.integrator.name)
-        self.result.add(y_a, "audio module")
-        self.result.add(y_v, "visual module")
-        self.result.add(recal, "recalibration")
-        self.result.add(sync, "synchrony")
+        y_a[k] = a0
+        y_v[k] = v0
+        y_i[k] = i0
 
 
     # Run regular experiment (neural entrainment)
-    def run(self):
-        if (not hasattr(self, "stim") and hasattr(self, "time")):
-            raise Exception("Must create stimulus before running experiment")
-
-
-        if not( hasattr(self, 'm0') and hasattr(self, 'm1') and hasattr(self, 'm2')):
-            raise Exception("Must initialize modules before running experiment")
-
-        series = self.initialize_timeseries(8)
+    # skip_ahead: jump over the quiet steps between events in closed form (see skipahead.py)
+    # compiled: run the whole loop as a Numba kernel when Numba is installed (see kernels.py)
+    # steady_state: with periodic inputs, repeat the limit cycle of the modules to the end of
+    # the run once it is reached instead of simulating it (see steadystate.py); the cycle
+    # found is reported in self.steady_state
+    def run(self, skip_ahead=False, compiled=False, steady_state=False):
+        if self.recording is not None:
+            assert not steady_state, "Steady-state runs keep full series; use no Recording"
+            assert not compiled, "Compiled runs keep full series; use no Recording"
+            assert self.cache is None, "Cached runs keep full series; use no Recording"
+            return self.run_recorded(skip_ahead=skip_ahead)
+        self.start_entrainment()
+        self.steady_state = None
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.run_key(self, "entrainment")
+            if self.cache.restore(self, key, "entrainment", {"stim": self.stim}):
+                return
+        cost, total_cost = self.initialize_timeseries(2)
+        self.costs.record_into(cost, total_cost, 0)
+        series = self.entrainment_series(self.initialize_timeseries(6))
+
+        if steady_state:
+            self.steady_state = steadystate.run_steady_state(self, series, skip_ahead)
+        elif compiled and kernels.supports_entrainment(self):
+            kernels.run_entrainment(self, series)
+        else:
+            self.advance(0, self.duration, series, skip_ahead)
+        self.add_entrainment_results(series)
+        if key is not None:
+            self.cache.store(self, key, "entrainment", ["stim"])
+
+    # Store the full-length series of an entrainment run (as given by entrainment_series)
+    def add_entrainment_results(self, series):
         x, cost, total_cost, y, ym1, ym1a, ym1b, ym2 = series
-
-        for i in range(self.duration):
-            feedback_m2 = self.m2.send_feedback()
-            err_pred = self.calculate_error(feedback_m2)
-        
-            y[i], x[i], err0, stimulus = self.m0.receive_pulse(self.stim[i], feedback_m2)
-            ym1[i], _, feedback, stimulus = self.m1.receive_error(
-                err0, stimulus, self.m0.angle, self.m0.freq_hertz
-            )
-
-            self.m0.receive_feedback(feedback)
-
-            ym2[i], _ = self.m2.receive_feedback(feedback, stimulus)
-
-            ym1a[i], err_m1a = self.m1.subm1a.pulse(stimulus)
-            ym1b[i], err_m1b = self.m1.subm1b.pulse(stimulus)
-
-            cost[i] = err_pred + err_m1a + err_m1b
-            if err0 != 0:
-                cost[i] += y[i]
-            total_cost[i:] += cost[i]
-  
         self.result.add(self.stim, "stim")
         self.result.add(y, self.m0.name)
         self.result.add(ym1, self.m1.name)
@@ -193,4 +333,125 @@ class Experiment:
         self.result.add(ym1b, self.m1.subm1b.name)
         self.result.add(ym2, self.m2.name)
         self.result.add(cost, "cost")
-        self.result.add(total_cost, "total cost")
\ No newline at end of file
+        self.result.add(total_cost, "total cost")
+
+    # Check stimuli and modules and set up cost accounting and the event schedule
+    # record: keep the per-step cost of the whole run in the CostAccumulator
+    def start_entrainment(self, record=True):
+        if (not hasattr(self, "stim") and hasattr(self, "time")):
+            raise Exception("Must create stimulus before running experiment")
+
+
+        if not( hasattr(self, 'm0') and hasattr(self, 'm1') and hasattr(self, 'm2')):
+            raise Exception("Must initialize modules before running experiment")
+
+        self.costs = CostAccumulator(self.duration, record=record)
+
+        # Stimulus onsets and the end of the trial, if set
+        self.schedule = stimulus_schedule(self.duration, self.stim)
+        if hasattr(self, "end_time"):
+            self.schedule.add([self.end_time], TRIAL_END)
+
+    # Series written by step, given the M0 angle and module output series
+    def entrainment_series(self, series):
+        x, y, ym1, ym1a, ym1b, ym2 = series
+        return x, self.costs.cost, self.costs.total_cost, y, ym1, ym1a, ym1b, ym2
+
+    # Advance the entrainment modules over steps start, ..., stop - 1
+    # series hold those steps, starting from index 0 at step start
+    def advance(self, start, stop, series, skip_ahead=False):
+        self.offset = start
+        self.stop = stop
+        i = start
+        while i < stop:
+            if skip_ahead:
+                skipped = skip_entrainment(self, i, series)
+                self.costs.skip(i, skipped)
+                i += skipped
+                if i == stop:
+                    break
+            self.step(i, series)
+            i += 1
+
+    # Advance the entrainment modules by time step i
+    def step(self, i, series):
+        x, cost, total_cost, y, ym1, ym1a, ym1b, ym2 = series
+        k = i - self.offset
+
+        feedback_m2 = self.m2.send_feedback()
+        err_pred = self.calculate_error(feedback_m2)
+
+        y[k], x[k], err0, stimulus = self.m0.receive_pulse(self.stim[i], feedback_m2)
+        ym1[k], _, feedback, stimulus = self.m1.receive_error(
+            err0, stimulus, self.m0.angle, self.m0.freq_hertz
+        )
+
+        self.m0.receive_feedback(feedback)
+
+        ym2[k], _ = self.m2.receive_feedback(feedback, stimulus)
+
+        ym1a[k], err_m1a = self.m1.subm1a.pulse(stimulus)
+        ym1b[k], err_m1b = self.m1.subm1b.pulse(stimulus)
+
+        self.costs.add(i, err_pred, err_m1a, err_m1b, y[k] if err0 != 0 else 0)
+
+    # Run the experiment in chunks, yielding each chunk of results as soon as it is simulated
+    # Only one chunk is held at a time; use sparse stimuli (see sparse.py) to keep memory
+    # bounded for long sessions. Yields dicts of series over steps start, ..., stop - 1,
+    # plus the trials completed within the chunk. A multisensory stream ends with the
+    # chunk in which its analyzer (if any) is done.
+    # multisensory: run the temporal recalibration experiment instead of entrainment
+    # series: names of the series to yield (all if None); the others are not kept at all
+    def stream(self, chunk=10000, multisensory=False, skip_ahead=False, series=None):
+        if multisensory:
+            self.start_multisensory(sparse=True)
+            # Series in the order advance_multisensory takes them; recalibration and
+            # synchrony are read back within a step
+            names = ["audio module", "visual module", self.integrator.name, "recalibration", "synchrony", None]
+            needed = ["recalibration", "synchrony"]
+            stimuli = {self.audio.name: self.stim[0], self.visual.name: self.stim[1]}
+            order = [self.integrator.name, "audio module", "visual module", "recalibration", "synchrony"]
+        else:
+            self.start_entrainment(record=False)
+            # Series in the order of initialize_timeseries, then the costs; the M0 output
+            # is read back within a step
+            names = [None, self.m0.name, self.m1.name, self.m1.subm1a.name, self.m1.subm1b.name, self.m2.name]
+            names += ["cost", "total cost"]
+            needed = [self.m0.name]
+            stimuli = {"stim": self.stim}
+            order = names[1:]
+        kept = [name is not None and (series is None or name in series or name in needed) for name in names]
+
+        for start in range(0, self.duration, chunk):
+            stop = min(start + chunk, self.duration)
+            buffers = [np.zeros((stop - start,)) if keep else DISCARD for keep in kept]
+            first_trial = len(self.trials)
+
+            if multisensory:
+                if self.finished:
+                    break
+                stop = self.advance_multisensory(start, stop, buffers, skip_ahead)
+            else:
+                x, y, ym1, ym1a, ym1b, ym2, cost, total_cost = buffers
+                self.costs.record_into(cost, total_cost, start)
+                self.advance(start, stop, (x, cost, total_cost, y, ym1, ym1a, ym1b, ym2), skip_ahead)
+
+            out = {name: values[start:stop] for name, values in stimuli.items() if series is None or name in series}
+            filled = dict(zip(names, buffers))
+            for name in order:
+                if series is None or name in series:
+                    out[name] = filled[name][: stop - start]
+
+            out["time"] = np.arange(start, stop, dtype=float)
+            out["start"] = start
+            out["stop"] = stop
+            out["trials"] = self.trials[first_trial:]
+            yield out
+
+    # Run with a Recording: keep only the requested series, decimated (see recording.py)
+    def run_recorded(self, multisensory=False, skip_ahead=False):
+        for chunk in self.stream(self.recording.chunk, multisensory, skip_ahead, self.recording.names()):
+            self.recording.add(chunk)
+        self.recording.finish(self.result)
+        if multisensory:
+            self.result.add_trials(self.trials)
@@ -0,0 +1,168 @@
+import numpy as np
+from collections import namedtuple
+
+""" Batched least-squares fits of Gaussians to many synchrony curves at once """
+
+# Curves share one x axis (e.g. every SOA of a sweep) and a mask of the points each curve
+# has. All curves are fitted together by Levenberg-Marquardt with the analytic Jacobian of
+# gauss(x, amp, mu, sigma), starting from a log-parabola fit. A curve that cannot be fitted
+# is reported as not converged with NaN parameters; fitting never raises. Sums over points
+# run in a fixed order, so a curve gets the same fit whatever else is in its batch.
+#
+# On curves with a clear peak this finds the optimum curve_fit finds. Noisy or flat curves
+# can have several local optima, though, and as the fit starts from the log-parabola rather
+# than from the moment estimate gauss_params gives curve_fit (see analysis.py), it may settle
+# in a different one there, so the modes of such curves can differ widely between the two.
+
+# Fitted parameters of every curve, with the mode over its x range and fit diagnostics:
+# converged: fit reached tolerance; residual: sum of squared residuals; points: points fitted
+GaussFit = namedtuple(
+    "GaussFit", ["amp", "mu", "sigma", "mode", "converged", "residual", "iterations", "points"]
+)
+
+MAX_ITERATIONS = 200
+TOLERANCE = 1e-10
+
+
+# Sum over the points (axis 1) of every curve, adding them one after the other
+def sum_points(values):
+    total = np.zeros(values.shape[:1] + values.shape[2:])
+    for point in range(values.shape[1]):
+        total += values[:, point]
+    return total
+
+
+# Solves the 3x3 normal equations of every curve; singular systems get a least-squares step
+def solve(lhs, rhs):
+    return (np.linalg.pinv(lhs) * rhs[:, None, :]).sum(axis=2)
+
+
+# Gaussian of every curve over x; params has shape (curves, 3)
+def gaussians(x, params):
+    amp, mu, sigma = (params[:, i, None] for i in range(3))
+    return amp * np.exp(-((x - mu) ** 2) / (2 * sigma**2))
+
+
+# Values and Jacobian (curves, points, 3) with respect to amp, mu and sigma
+def gaussians_jacobian(x, params):
+    amp, mu, sigma = (params[:, i, None] for i in range(3))
+    shape = np.exp(-((x - mu) ** 2) / (2 * sigma**2))
+    y = amp * shape
+    d_mu = y * (x - mu) / sigma**2
+    d_sigma = y * (x - mu) ** 2 / sigma**3
+    return y, np.stack([shape, d_mu, d_sigma], axis=-1)
+
+
+# Initial parameters from a parabola fitted to log(y), weighted by y^2 so that points near
+# zero (where the log is noisy) count little. Curves with no peak fall back to the largest point
+def log_parabola(x, y, mask):
+    positive = mask & (y > 0)
+    w = np.where(positive, y, 0) ** 2
+    log_y = np.log(np.where(positive, y, 1))
+
+    powers = x[:, None] ** np.arange(3)
+    lhs = sum_points(w[:, :, None, None] * (powers[:, :, None] * powers[:, None, :]))
+    rhs = sum_points((w * log_y)[:, :, None] * powers)
+    a, b, c = solve(lhs, rhs).T
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        mu = -b / (2 * c)
+        sigma = np.sqrt(-1 / (2 * c))
+        amp = np.exp(a - b**2 / (4 * c))
+
+    masked = np.where(mask, y, -np.inf)
+    peak = np.argmax(masked, axis=1)
+    fallback = ~((c < 0) & np.isfinite(mu) & np.isfinite(sigma) & np.isfinite(amp))
+    fallback |= positive.sum(axis=1) < 3
+    lo, hi = x_range(x, mask)
+    amp = np.where(fallback, masked[np.arange(len(y)), peak], amp)
+    mu = np.where(fallback, x[peak], mu)
+    sigma = np.where(fallback, (hi - lo) / 4, sigma)
+    return np.stack([amp, mu, sigma], axis=1)
+
+
+# Smallest and largest x of every curve
+def x_range(x, mask):
+    lo = np.where(mask, x, np.inf).min(axis=1)
+    hi = np.where(mask, x, -np.inf).max(axis=1)
+    return lo, hi
+
+
+# Location of the maximum of every fitted Gaussian within the x range of its curve
+def gaussian_modes(params, lo, hi):
+    amp, mu = params[:, 0], params[:, 1]
+    # An inverted Gaussian peaks at the end of the range furthest from its centre
+    far_end = np.where(np.abs(lo - mu) > np.abs(hi - mu), lo, hi)
+    return np.where(amp > 0, np.clip(mu, lo, hi), far_end)
+
+
+# Fits gauss(x, amp, mu, sigma) to every row of y
+# x: (points,) shared axis; y: (curves, points); mask: points each curve has (all if None)
+# Returns a GaussFit of arrays with one entry per curve
+def fit_gaussians(x, y, mask=None, max_iterations=MAX_ITERATIONS, tol=TOLERANCE):
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    mask = np.ones(y.shape, dtype=bool) if mask is None else np.atleast_2d(np.asarray(mask, dtype=bool))
+    mask = mask & np.isfinite(y)
+    y = np.where(mask, y, 0)
+    curves = len(y)
+    points = mask.sum(axis=1)
+    if y.shape[1] == 0:
+        nan = np.full(curves, np.nan)
+        return GaussFit(nan, nan, nan, nan, np.zeros(curves, dtype=bool), nan, np.zeros(curves, dtype=int), points)
+
+    with np.errstate(all="ignore"):
+        params = log_parabola(x, y, mask)
+        damping = np.full(curves, 1e-3)
+        converged = np.zeros(curves, dtype=bool)
+        iterations = np.zeros(curves, dtype=int)
+
+        fitted, jacobian = gaussians_jacobian(x, params)
+        residual = np.where(mask, y - fitted, 0)
+        cost = sum_points(residual**2)
+        # Three parameters need three points, and a usable start
+        active = (points >= 3) & np.isfinite(params).all(axis=1) & np.isfinite(cost)
+
+        for _ in range(max_iterations):
+            # Only curves still being fitted take part in an iteration
+            c = np.flatnonzero(active)
+            if len(c) == 0:
+                break
+            iterations[c] += 1
+
+            # Damped normal equations
+            J = np.where(mask[c, :, None], jacobian[c], 0)
+            JTJ = sum_points(J[:, :, :, None] * J[:, :, None, :])
+            JTr = sum_points(J * residual[c, :, None])
+            diagonal = np.diagonal(JTJ, axis1=1, axis2=2)
+            lhs = JTJ + (damping[c, None] * np.maximum(diagonal, 1e-12))[:, :, None] * np.eye(3)
+            step = solve(lhs, JTr)
+
+            trial = params[c] + step
+            trial_fitted, trial_jacobian = gaussians_jacobian(x, trial)
+            trial_residual = np.where(mask[c], y[c] - trial_fitted, 0)
+            trial_cost = sum_points(trial_residual**2)
+
+            better = np.isfinite(trial_cost) & (trial_cost <= cost[c])
+            small = np.abs(cost[c] - trial_cost) <= tol * np.maximum(cost[c], tol)
+            small |= (np.abs(step) <= tol * (np.abs(params[c]) + tol)).all(axis=1)
+
+            b = c[better]
+            params[b] = trial[better]
+            jacobian[b] = trial_jacobian[better]
+            residual[b] = trial_residual[better]
+            cost[b] = trial_cost[better]
+            damping[c] = np.where(better, damping[c] / 10, damping[c] * 10)
+
+            done = small | (cost[c] == 0)
+            converged[c[done]] = True
+            active[c] = ~done & (damping[c] < 1e16)
+
+    params[:, 2] = np.abs(params[:, 2])
+    converged &= np.isfinite(params).all(axis=1) & (params[:, 2] > 0)
+    params[~converged] = np.nan
+    cost = np.where(converged, cost, np.nan)
+
+    lo, hi = x_range(x, mask)
+    modes = np.where(converged, gaussian_modes(params, lo, hi), np.nan)
+    return GaussFit(*params.T, modes, converged, cost, iterations, points)
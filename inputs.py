@@ -1,95 +1,175 @@
 import numpy as np
-import random
 
 """ Functions to create different types of inputs """
 
-def pattern(duration, intervals):
+# Onset times are computed all at once: the gaps between consecutive stimuli are laid
+# out in one array and summed cumulatively, so no Python loop runs per stimulus.
+
+
+def pattern_onsets(duration, intervals, start):
+    """Onset times and pattern indices of stimuli repeating intervals from start """
+    if start >= duration:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    # enough whole repetitions of the pattern to run past the end of the session
+    reps = (duration - start) // sum(intervals) + 1
+    gaps = np.tile(np.asarray(intervals, dtype=int), reps)
+    times = start + np.concatenate(([0], np.cumsum(gaps)))
+    index = np.arange(len(times)) % len(intervals)
+
+    keep = times < duration
+    return times[keep], index[keep]
+
+
+def pattern(duration, intervals, rng=None):
     """Creates inputs of given duration according to pattern defined by intervals """
     # intervals: list of inter-stimulus intervals < 360ms in ordered sequence
+    # rng: numpy Generator, or seed / SeedSequence to create one from
+    rng = np.random.default_rng(rng)
 
-    x = np.linspace(0, duration, duration, endpoint=False)
-    stim = np.zeros(np.shape(x))
-    stim_pattern = np.empty(np.shape(x))
+    x = np.arange(duration, dtype=float)
+    stim = np.zeros(duration)
+    stim_pattern = np.zeros(duration)
 
     # determine initial stimulus occurence
-    stim_time = random.randint(0, intervals[0])
-
-    i = 0 # index of current ISI in intervals to use
+    stim_time = int(rng.integers(0, intervals[0], endpoint=True))
 
-    # add next stimuli after ISI determined by intervals
-    while stim_time < duration:
-        stim[stim_time] = 1
-        stim_pattern[stim_time] = i
-        stim_time += intervals[i]
-        i = (i + 1) % len(intervals)
+    times, index = pattern_onsets(duration, intervals, stim_time)
+    stim[times] = 1
+    stim_pattern[times] = index
     return x, stim, stim_pattern
 
 
-def drop_stim(self, duration, interval, drop_rate=0.5):
+def pattern_batch(duration, intervals, rngs, dtype=float):
+    """Creates pattern inputs for many sessions at once, one rng per session """
+    # intervals: one list of intervals shared by all sessions, or one list per session
+    # returns time axis and stimuli of shape (sessions, duration)
+    if not isinstance(intervals[0], (list, tuple, np.ndarray)):
+        intervals = [intervals] * len(rngs)
+
+    session_times = []
+    for session_intervals, rng in zip(intervals, rngs):
+        rng = np.random.default_rng(rng)
+        stim_time = int(rng.integers(0, session_intervals[0], endpoint=True))
+        session_times.append(pattern_onsets(duration, session_intervals, stim_time)[0])
+
+    stimuli = np.zeros((len(rngs), duration), dtype=dtype)
+    sessions = np.repeat(np.arange(len(rngs)), [len(t) for t in session_times])
+    stimuli[sessions, np.concatenate(session_times).astype(int)] = 1
+    return np.arange(duration, dtype=float), stimuli
+
+
+def drop_stim(self, duration, interval, drop_rate=0.5, rng=None):
     """ Creates inputs at constant interval where some inputs are randomly missing """
-    x, stim, _ = pattern(duration, [interval])
+    rng = np.random.default_rng(rng)
+    x, stim, _ = pattern(duration, [interval], rng)
 
     stim_present = np.where(stim == 1)[0]
     drop_num = round(drop_rate * len(stim_present))
-    drop = np.random.choice(stim_present, drop_num)
+    drop = rng.choice(stim_present, drop_num)
     stim_present = np.setdiff1d(stim_present, drop)
     new_stim = np.zeros(stim.shape)
     new_stim[stim_present] = 1
     self.stim = new_stim
 
-def multisensory_stimuli(duration, modalities):
-    stimuli = np.zeros((modalities, duration))
 
-    interval = 720
-    stim_time = 300
+# asynchronies = np.arange(-150, 175, 25)
+# asynchronies = np.arange(-75, 75, 5)
+ASYNCHRONIES = np.arange(-100,125, 5)
 
-    soas = []
-    trials = []  # trial begin
-    trial_end = []
-    leads = []
 
-    
+def multisensory_onsets(duration, rng, jitter=0, interval=720, asynchronies=None):
+    """ Draws the reference onset and SOA of every audio-visual trial in a session """
+    # jitter: trials are spaced by the interval plus a random jitter of up to +-jitter ms
+    # asynchronies: SOAs to draw from (ASYNCHRONIES by default)
+    stim_time = 300
+    if asynchronies is None:
+        asynchronies = ASYNCHRONIES
+
+    # a trial spans from its first to its last onset, so it reaches from up to -min(SOA)
+    # before its reference onset to max(SOA) after it; the shortest gap must exceed that
+    # for trials not to overlap (trial ends must follow one another)
+    span = max(0, np.max(asynchronies)) - min(0, np.min(asynchronies))
+    if jitter < 0 or interval - jitter <= span:
+        raise ValueError(
+            f"Jitter must be at least 0 and interval - jitter more than the trial span {span}, "
+            f"got jitter={jitter}, interval={interval}"
+        )
+
+    # at most this many trials fit into the session
+    num_trials = max(0, -(-(duration - stim_time) // (interval - jitter)))
+
+    soas = rng.choice(asynchronies, num_trials)
+    gaps = np.full(num_trials, interval)
+    if jitter:
+        gaps = gaps + rng.integers(-jitter, jitter, num_trials, endpoint=True)
+    times = stim_time + np.concatenate(([0], np.cumsum(gaps)))[:num_trials].astype(int)
+
+    keep = times < duration
+    return times[keep], soas[keep]
+
+
+def multisensory_trials(times, soas):
+    """ Trial begin, trial end and leading modality of trials with the given onsets and SOAs """
+    ### Procedure:
+    #  If SOA negative, audio is placed first
+    # If positive, visual first
+    # If 0, both at same time
+    leads = ["audio" if SOA < 0 else "visual" if SOA > 0 else None for SOA in soas]
+    trials = np.minimum(times, times + soas)  # trial begin
+    trial_end = np.maximum(times, times + soas)
+    return trials, trial_end, leads
+
+
+def multisensory_onset_lists(duration, modalities, times, soas):
+    """ Onset steps of each modality; audio is offset from the trial onset by the SOA """
     audio_index = 0
-    # asynchronies = np.arange(-150, 175, 25)
-    # asynchronies = np.arange(-75, 75, 5)
-    asynchronies = np.arange(-100,125, 5)
-
-    while stim_time < duration:
-        ### Procedure:
-        #  Generate random SOA (positive or negative)
-        # If negative, place audio first
-        # If positive, place visual first
-        # If 0, place at same time
-
-        SOA = random.choice(asynchronies)
-
-        if SOA < 0:
-            lead = "audio"
-        elif SOA > 0:
-            lead = "visual"
-        elif SOA == 0:
-            lead = None
-
-        soas.append(SOA)
-        leads.append(lead)
-        trials.append(min(stim_time, stim_time + SOA))
-        trial_end.append(max(stim_time, stim_time + SOA))
-
-        for i in range(modalities):
-            stim = stimuli[i]
-            if i == audio_index:
-                try:
-                    stim[stim_time + SOA] = 1
-                except:
-                    print("Desired stimulus onset outside of session duration")
-            else:
-                stim[stim_time] = 1
-
-        jitter = random.randint(-250, 250)
-        jitter = 0
-        stim_time += interval + jitter
-        
-
-    trials = np.array(trials)
-    trial_end = np.array(trial_end)
-    return stimuli, trials, trial_end, leads, soas
\ No newline at end of file
+
+    audio = times + soas
+    for _ in range(np.count_nonzero(audio >= duration)):
+        print("Desired stimulus onset outside of session duration")
+
+    return [audio[audio < duration] if i == audio_index else times for i in range(modalities)]
+
+
+def place_multisensory(stimuli, times, soas):
+    """ Marks trial onsets in stimuli (modalities, duration) """
+    modalities, duration = stimuli.shape
+    for stim, onsets in zip(stimuli, multisensory_onset_lists(duration, modalities, times, soas)):
+        stim[onsets] = 1
+
+
+def multisensory_stimuli(
+    duration, modalities, rng=None, jitter=0, interval=720, asynchronies=None, dtype=float
+):
+    """ Creates audio-visual trials with random stimulus onset asynchronies (SOAs) """
+    # rng: numpy Generator, or seed / SeedSequence to create one from
+    rng = np.random.default_rng(rng)
+    stimuli = np.zeros((modalities, duration), dtype=dtype)
+
+    times, soas = multisensory_onsets(duration, rng, jitter, interval, asynchronies)
+    place_multisensory(stimuli, times, soas)
+    trials, trial_end, leads = multisensory_trials(times, soas)
+    return stimuli, trials, trial_end, leads, list(soas)
+
+
+def multisensory_batch(
+    duration, modalities, rngs, jitter=0, interval=720, asynchronies=None, dtype=float
+):
+    """ Creates audio-visual trials for many sessions at once, one rng per session """
+    # returns stimuli of shape (sessions, modalities, duration) and, for every
+    # session, its trial begins, trial ends, leads and SOAs
+    stimuli = np.zeros((len(rngs), modalities, duration), dtype=dtype)
+    trials, trial_end, leads, soas = [], [], [], []
+
+    for session, rng in enumerate(rngs):
+        times, session_soas = multisensory_onsets(
+            duration, np.random.default_rng(rng), jitter, interval, asynchronies
+        )
+        place_multisensory(stimuli[session], times, session_soas)
+        begin, end, session_leads = multisensory_trials(times, session_soas)
+        trials.append(begin)
+        trial_end.append(end)
+        leads.append(session_leads)
+        soas.append(list(session_soas))
+    return stimuli, trials, trial_end, leads, soas
@@ -0,0 +1,463 @@
+import numpy as np
+from modules import *
+from scheduler import *
+
+try:
+    from numba import njit
+
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+""" Compiled simulation loops: the run and run_multisensory steps over plain state arrays """
+
+# Each module's state is packed into a float64 vector (Module.get_state), the whole loop runs
+# over those vectors, and the final state is written back to the module objects. The
+# kernels are plain Python written in the subset Numba compiles; with Numba installed they
+# are compiled on first use, otherwise Experiment keeps using the module classes.
+# They cover the default setup: M0 (not the nested variants) and exact waveforms.
+
+CONSTANT = Module.CONSTANT
+
+
+######## Packing module objects into state vectors ########
+
+
+# M2 pattern and element end times as arrays with room to grow
+def pack_pattern(m2):
+    capacity = max(16, 2 * len(m2.pattern))
+    pattern = np.zeros(capacity)
+    times = np.zeros(capacity)
+    pattern[: len(m2.pattern)] = m2.pattern
+    times[: len(m2.time)] = m2.time
+    return pattern, times
+
+
+def unpack_pattern(m2, state, pattern, times):
+    length = int(state[LENGTH])
+    m2.pattern = [int(value) for value in pattern[:length]]
+    m2.time = [float(time) for time in times[:length]]
+
+
+######## Kernels ########
+
+
+def wave(angle, amplitude):
+    return (amplitude * (np.sin(2 * np.pi * CONSTANT * angle)) + amplitude) / 2
+
+
+# Module.pulse
+def oscillator_pulse(state):
+    y = wave(state[ANGLE], state[AMP])
+    state[ANGLE] = (state[ANGLE] + state[FREQ]) % 360
+    state[INHIBITION] = y
+    return y
+
+
+# Adds one step of an M1/M2 burst to y
+def burst_pulse(state, burster, y):
+    if state[BURSTING] and state[BURST_POS] < state[BURST_DUR]:
+        y += oscillator_pulse(burster) - (burster[AMP] / 2)
+        state[BURST_POS] += 1
+
+    if state[BURST_POS] >= state[BURST_DUR]:
+        state[BURST_POS] = 0
+        state[BURSTING] = 0
+    return y
+
+
+def reset_initial(state):
+    state[FREQ] = state[INITIAL]
+    state[PERIOD] = 360
+    state[SHIFTS] = 0
+    state[MISSED] = 0
+
+
+# subM1.pulse; returns output and error
+def sub_pulse(state, stimulus):
+    err = 0.0
+    if stimulus:
+        err = 0.25 * wave(state[ANGLE], state[AMP])
+        state[ANGLE] = 270
+    return oscillator_pulse(state), err
+
+
+# M1.receive_error
+def m1_receive_error(m1, burster, sub_a, sub_b, err, m0_angle, m0_freq):
+    y = oscillator_pulse(m1)
+
+    if err == 1:
+        m1[BURSTING] = 1
+        m1[SHIFTS] += 1
+        if m1[SHIFTS] > 1:
+            new_period = (90 + m0_angle + (m1[MISSED] * 360)) / m0_freq
+            new_freq = 360 / new_period
+            if not sub_a[ENTRAINED]:
+                sub_a[PERIOD] = new_period
+                sub_a[FREQ] = new_freq
+                sub_a[ENTRAINED] = 1
+                sub_b[PERIOD] = new_period
+                sub_b[FREQ] = new_freq
+            elif not sub_b[ENTRAINED]:
+                sub_b[PERIOD] = new_period
+                sub_b[FREQ] = new_freq
+                sub_b[ENTRAINED] = 1
+        m1[MISSED] = 0
+    elif err == -1:
+        m1[MISSED] += 1
+
+    return burst_pulse(m1, burster, y)
+
+
+# Appends an element to the M2 pattern, growing the arrays when full
+def append_pattern(state, pattern, times, value, duration):
+    length = int(state[LENGTH])
+    if length == len(pattern):
+        pattern = np.concatenate((pattern, np.zeros(length)))
+        times = np.concatenate((times, np.zeros(length)))
+    pattern[length] = value
+    times[length] = times[length - 1] + duration
+    state[LENGTH] = length + 1
+    if value == -1:
+        state[NEGATIVES] += 1
+    state[ANGLE] = 0
+    state[INDEX] = 0
+    return pattern, times
+
+
+# Missed inputs of the subM1 M2 listens to while its pattern element is value
+def count_missed(m2, sub, value, stimulus):
+    if m2[VALUE] == value and np.rint(sub[ANGLE]) == 270:
+        m2[BURSTING] = 1
+        if stimulus == 0:
+            sub[MISSED] += 1
+        elif stimulus == 1:
+            sub[MISSED] = 0
+
+
+# M2.receive_feedback; returns output and the (possibly grown) pattern arrays
+def m2_receive_feedback(m2, burster, pattern, times, m0, m1, sub_a, sub_b, stimulus):
+    # M2.pulse
+    i = int(m2[INDEX])
+    y = pattern[i]
+    m2[VALUE] = pattern[i]
+    m2[ANGLE] += m2[FREQ]
+    if m2[ANGLE] > np.rint(times[i]):
+        m2[INDEX] = (i + 1) % int(m2[LENGTH])
+        m2[ANGLE] = m2[ANGLE] % m2[DURATION]
+
+    if stimulus == 1 and m2[VALUE] == 0 and sub_a[ENTRAINED]:
+        m2[VALUE] = 1
+        m2[ADUR] = 360 / sub_a[FREQ]
+        m2[DURATION] = m2[ADUR]
+        pattern[0] = 1
+        times[0] = m2[ADUR]
+        m2[LENGTH] = 1
+        m2[NEGATIVES] = 0
+
+    if m2[BDUR] == 0 and sub_b[ENTRAINED]:
+        m2[BDUR] = 360 / sub_b[FREQ]
+
+    if stimulus == 1 and m2[VALUE] == 1:
+        a_min = np.rint(sub_a[ANGLE]) == 270
+        if a_min and m2[NEGATIVES] == 0:
+            m2[DURATION] += m2[ADUR]
+            pattern, times = append_pattern(m2, pattern, times, 1, m2[ADUR])
+        elif not a_min and sub_b[ENTRAINED]:
+            m2[DURATION] += m2[BDUR]
+            pattern, times = append_pattern(m2, pattern, times, -1, m2[BDUR])
+
+    count_missed(m2, sub_a, 1, stimulus)
+    count_missed(m2, sub_b, -1, stimulus)
+
+    if sub_a[MISSED] >= m2[THRESHOLD] or sub_b[MISSED] >= m2[THRESHOLD]:
+        reset_initial(m1)
+        reset_initial(sub_a)
+        sub_a[ENTRAINED] = 0
+        reset_initial(sub_b)
+        sub_b[ENTRAINED] = 0
+        pattern[0] = 0
+        times[0] = 360
+        m2[LENGTH] = 1
+        m2[NEGATIVES] = 0
+        m2[INDEX] = 0
+        m2[VALUE] = 0
+        m2[DURATION] = 360
+        m2[ADUR] = 0
+        m2[BDUR] = 0
+        reset_initial(m0)
+
+    return burst_pulse(m2, burster, y), pattern, times
+
+
+# Experiment.run over steps 0, ..., duration - 1 (stimuli of value 1 at onsets)
+def entrainment_kernel(
+    onsets, duration, m0, m1, m1_burst, sub_a, sub_b, m2, m2_burst, pattern, times,
+    x, y, ym1, ym1a, ym1b, ym2, cost, total_cost, totals, history,
+):
+    window = history.shape[0]
+    cursor = 0
+    for i in range(duration):
+        stimulus = 0.0
+        while cursor < len(onsets) and onsets[cursor] < i:
+            cursor += 1
+        if cursor < len(onsets) and onsets[cursor] == i:
+            stimulus = 1.0
+
+        # M2.send_feedback and Experiment.calculate_error
+        feedback_m2 = 0
+        if m2[VALUE] == 1 and np.rint(sub_a[ANGLE]) == 270:
+            feedback_m2 = 1
+            m0[ANGLE] = 270
+        if m2[VALUE] == -1 and np.rint(sub_b[ANGLE]) == 270:
+            feedback_m2 = 1
+            m0[ANGLE] = 270
+        err_pred = 0.0
+        if feedback_m2 == 1:
+            err_pred = 0.5 * wave(m0[ANGLE], m0[AMP])
+
+        # M0.receive_pulse
+        y[i] = wave(m0[ANGLE], m0[AMP])
+        if feedback_m2 != 1:
+            m0[ANGLE] = (m0[ANGLE] + m0[FREQ]) % 360
+        x[i] = m0[ANGLE]
+        err0 = 0
+        if stimulus == 1 and np.rint(x[i]) != 270:
+            err0 = 1
+        elif np.rint(x[i]) == 270 and stimulus != 1:
+            err0 = -1
+        if stimulus == 1:
+            m0[MISSED] = 0
+
+        ym1[i] = m1_receive_error(m1, m1_burst, sub_a, sub_b, err0, m0[ANGLE], m0[FREQ])
+
+        # M0.receive_feedback
+        if err0 == 1:
+            m0[SHIFTS] += 1
+            if m0[SHIFTS] > 1:
+                new_period = (90 + m0[ANGLE] + m0[MISSED] * 360) / m0[FREQ]
+                m0[FREQ] = 360 / new_period
+                m0[PERIOD] = new_period
+            m0[ANGLE] = 270
+        elif err0 == -1:
+            m0[MISSED] += 1
+
+        ym2[i], pattern, times = m2_receive_feedback(
+            m2, m2_burst, pattern, times, m0, m1, sub_a, sub_b, stimulus
+        )
+
+        ym1a[i], err_m1a = sub_pulse(sub_a, stimulus)
+        ym1b[i], err_m1b = sub_pulse(sub_b, stimulus)
+
+        # CostAccumulator.add
+        err_m0 = y[i] if err0 != 0 else 0.0
+        step_cost = err_pred + err_m1a + err_m1b
+        if err_m0 != 0:
+            step_cost += err_m0
+        totals[0] += step_cost
+        totals[1] += err_pred
+        totals[2] += err_m1a
+        totals[3] += err_m1b
+        totals[4] += err_m0
+        cost[i] = step_cost
+        total_cost[i] = totals[0]
+        history[i % window] = totals
+    return pattern, times
+
+
+# Sensory.pulse; returns output and registration slot
+def sensory_pulse(state, burster, stimulus):
+    y = oscillator_pulse(state)
+    reg = 0
+
+    if not state[BURSTING] and np.rint(state[ANGLE]) == state[BURST_PHASE]:
+        state[BURSTING] = 1
+        state[SLOT] = 1
+        state[CURRENT] = 0
+
+    if stimulus and state[BURSTING]:
+        reg = int(state[SLOT])
+
+    if state[BURSTING]:
+        if state[CURRENT] == state[SENSORY_DUR]:
+            state[CURRENT] = 0
+            state[SLOT] += 1
+            if state[SLOT] > state[MAX_SLOTS]:
+                state[BURSTING] = 0
+                state[SLOT] = 1
+                state[CURRENT] = 0
+                return y, reg
+
+        y += oscillator_pulse(burster) - burster[AMP] / 2
+        state[CURRENT] += 1
+    return y, reg
+
+
+# Sensory.adjust_phase
+def adjust_phase(state, sign):
+    if sign != 0:
+        ratio = (state[SENSORY_DUR] / state[PERIOD]) * 360
+        state[BURST_PHASE] += ratio * sign
+        state[BURST_PHASE] %= 360
+        state[BURST_PHASE] = np.rint(state[BURST_PHASE])
+
+
+# Sensory.reset and Sensory.reset_fastphase
+def reset_sensory(state):
+    state[ANGLE] = 270
+    cycle_degrees = (state[SENSORY_DUR] / state[PERIOD]) * 360
+    state[BURST_PHASE] = state[ANGLE] - np.rint(state[MAX_SLOTS] * cycle_degrees / 2)
+
+
+# M3.pulse; returns output, synchrony and recalibration
+def integrator_pulse(state, reg1, reg2):
+    y = oscillator_pulse(state)
+    y -= state[AMP] / 2
+
+    sync = -1
+    if reg1 == reg2 and reg1 != 0:
+        sync = 1
+    recal = reg1 - reg2
+
+    if recal != 0:
+        state[CALIBRATING] = 1
+        state[CALIB_BEGIN] = np.rint(state[ANGLE])
+        state[RECAL] = recal * 2
+        return y, sync, recal
+
+    if state[CALIBRATING]:
+        y *= abs(state[RECAL])
+        if np.rint(state[ANGLE]) == state[CALIB_BEGIN]:
+            state[CALIBRATING] = 0
+    return y, sync, recal
+
+
+# Experiment.run_multisensory over steps 0, ..., duration - 1
+# trial_ends: steps at which a trial ends, in increasing order
+def multisensory_kernel(
+    onsets_a, onsets_v, trial_ends, duration, audio, audio_burst, visual, visual_burst,
+    integrator, y_a, y_v, y_i, recal, sync,
+):
+    cursor_a = 0
+    cursor_v = 0
+    cursor_end = 0
+    last_a = 0
+    last_v = 0
+    for i in range(duration):
+        while cursor_a < len(onsets_a) and onsets_a[cursor_a] < i:
+            cursor_a += 1
+        while cursor_v < len(onsets_v) and onsets_v[cursor_v] < i:
+            cursor_v += 1
+        stim_a = 1.0 if cursor_a < len(onsets_a) and onsets_a[cursor_a] == i else 0.0
+        stim_v = 1.0 if cursor_v < len(onsets_v) and onsets_v[cursor_v] == i else 0.0
+
+        a0, reg_a = sensory_pulse(audio, audio_burst, stim_a)
+        v0, reg_v = sensory_pulse(visual, visual_burst, stim_v)
+        i0, _, _ = integrator_pulse(integrator, 0, 0)
+
+        if last_a == 0 and reg_a != 0:
+            last_a = reg_a
+        if last_v == 0 and reg_v != 0:
+            last_v = reg_v
+
+        if cursor_end < len(trial_ends) and trial_ends[cursor_end] == i:
+            cursor_end += 1
+            i0, trial_sync, trial_recal = integrator_pulse(integrator, last_a, last_v)
+            sync[i] = trial_sync
+            recal[i] = trial_recal
+
+            if last_a == 0 and last_v == 0:
+                reset_sensory(audio)
+                reset_sensory(visual)
+
+            last_a = 0
+            last_v = 0
+            adjust_phase(audio, recal[i])
+
+        y_a[i] = a0
+        y_v[i] = v0
+        y_i[i] = i0
+    return last_a, last_v
+
+
+if NUMBA:
+    wave = njit(cache=True)(wave)
+    oscillator_pulse = njit(cache=True)(oscillator_pulse)
+    burst_pulse = njit(cache=True)(burst_pulse)
+    reset_initial = njit(cache=True)(reset_initial)
+    sub_pulse = njit(cache=True)(sub_pulse)
+    m1_receive_error = njit(cache=True)(m1_receive_error)
+    append_pattern = njit(cache=True)(append_pattern)
+    count_missed = njit(cache=True)(count_missed)
+    m2_receive_feedback = njit(cache=True)(m2_receive_feedback)
+    entrainment_kernel = njit(cache=True)(entrainment_kernel)
+    sensory_pulse = njit(cache=True)(sensory_pulse)
+    adjust_phase = njit(cache=True)(adjust_phase)
+    reset_sensory = njit(cache=True)(reset_sensory)
+    integrator_pulse = njit(cache=True)(integrator_pulse)
+    multisensory_kernel = njit(cache=True)(multisensory_kernel)
+
+
+######## Running an Experiment through the kernels ########
+
+
+def onset_steps(stim):
+    return np.asarray(stim.onsets if isinstance(stim, SparseSeries) else np.flatnonzero(stim), dtype=np.int64)
+
+
+# Whether the kernels reproduce this experiment; compiled: also require Numba
+def supports_entrainment(exp, compiled=True):
+    return (
+        (NUMBA or not compiled)
+        and type(exp.m0) is M0
+        and waveforms.rectified == waveforms.exact
+        and (isinstance(exp.stim, SparseSeries) or np.all(exp.stim[np.flatnonzero(exp.stim)] == 1))
+    )
+
+
+def supports_multisensory(exp, compiled=True):
+    return (NUMBA or not compiled) and waveforms.rectified == waveforms.exact
+
+
+# Experiment.run after start_entrainment, filling the full-length series
+def run_entrainment(exp, series):
+    x, cost, total_cost, y, ym1, ym1a, ym1b, ym2 = series
+    m0, m1, m2 = exp.m0, exp.m1, exp.m2
+    mods = [m0, m1, m1.burster, m1.subm1a, m1.subm1b, m2, m2.burster]
+    states = stack_states(mods)
+    pattern, times = pack_pattern(m2)
+
+    costs = exp.costs
+    pattern, times = entrainment_kernel(
+        onset_steps(exp.stim), exp.duration, *states, pattern, times,
+        x, y, ym1, ym1a, ym1b, ym2, cost, total_cost, costs.totals, costs.history,
+    )
+    costs.steps = exp.duration
+
+    unstack_states(mods, states)
+    unpack_pattern(m2, states[5], pattern, times)
+
+
+# Experiment.run_multisensory after start_multisensory, filling the full-length series
+def run_multisensory(exp, series):
+    y_a, y_v, y_i, recal, sync, cost = series
+    mods = [exp.audio, exp.audio.burster, exp.visual, exp.visual.burster, exp.integrator]
+    states = stack_states(mods)
+
+    # First trial ending at each step, as Experiment.step_multisensory reads them
+    ends = {}
+    for time, kind, trial in exp.schedule.events:
+        if kind == TRIAL_END and time < exp.duration:
+            ends.setdefault(time, trial)
+    trial_ends = np.array(sorted(ends), dtype=np.int64)
+
+    stim_a, stim_v = exp.stim
+    exp.last_a, exp.last_v = multisensory_kernel(
+        onset_steps(stim_a), onset_steps(stim_v), trial_ends, exp.duration, *states,
+        y_a, y_v, y_i, recal, sync,
+    )
+
+    unstack_states(mods, states)
+    for time in trial_ends:
+        lead, soa = exp.schedule.get_trial(ends[time])
+        exp.register_trial(lead, soa, sync[time])
@@ -1,8 +1,110 @@
 import numpy as np
 
+# Rectified sine shared by all modules: (amplitude * sin(angle) + amplitude) / 2
+# mode "exact": evaluate np.sin on every call
+# mode "table": look up a cached table of the waveform at the given angle resolution
+#   (degrees). Angles on the grid give exactly the same values as "exact"; angles between
+#   grid points are linearly interpolated, off by at most
+#   amplitude * (2 * pi * resolution / 360) ** 2 / 16  (about 1.9e-5 * amplitude at 1 degree)
+class WaveformTable:
+    def __init__(self, mode="exact", resolution=1):
+        self.tables = {}
+        self.set_mode(mode, resolution)
+
+    def set_mode(self, mode, resolution=1):
+        assert mode in ["exact", "table"], "Waveform mode must be 'exact' or 'table'"
+        # The table needs a grid point at 360 degrees to interpolate up to it
+        if mode == "table" and not (resolution > 0 and np.isclose(360 / resolution, round(360 / resolution))):
+            raise ValueError(f"Table resolution must divide 360 degrees evenly, got {resolution}")
+        self.mode = mode
+        self.resolution = resolution
+        self.steps_per_degree = 1 / resolution
+        self.current = {}  # amplitude -> table as a list, at the current resolution
+        self.rectified = self.exact if mode == "exact" else self.lookup
+
+    # Largest difference between "table" and "exact" output for the given amplitude
+    def max_error(self, amplitude=1):
+        return amplitude * (2 * np.pi * self.resolution / 360) ** 2 / 16
+
+    # Cached waveform at every grid angle from 0 to 360 inclusive
+    def get_table(self, amplitude):
+        key = (amplitude, self.resolution)
+        if key not in self.tables:
+            grid = np.arange(round(360 / self.resolution) + 1) * self.resolution
+            self.tables[key] = self.exact(grid, amplitude)
+        # Also when the resolution changed back to one tabulated before
+        if amplitude not in self.current:
+            self.current[amplitude] = self.tables[key].tolist()
+        return self.tables[key]
+
+    def exact(self, angle, amplitude):
+        return (
+            amplitude * (np.sin(2 * np.pi * Module.CONSTANT * angle)) + amplitude
+        ) / 2
+
+    # Waveform value at angle (degrees); angle may be a scalar or an array
+    # rectified is bound to exact or lookup by set_mode
+    def lookup(self, angle, amplitude):
+        if isinstance(angle, np.ndarray):
+            if np.ndim(amplitude) > 0:
+                if not np.all(amplitude == amplitude[0]):
+                    return self.exact(angle, amplitude)
+                amplitude = amplitude[0]
+            values = self.get_table(amplitude)
+            pos = (angle % 360) * self.steps_per_degree
+            return np.interp(pos, np.arange(len(values)), values)
+
+        values = self.current.get(amplitude)
+        if values is None:
+            self.get_table(amplitude)
+            values = self.current[amplitude]
+        pos = (angle % 360) * self.steps_per_degree
+        j = int(pos)
+        if j == pos:
+            return values[j]
+        return values[j] + (pos - j) * (values[j + 1] - values[j])
+
+
+waveforms = WaveformTable()
+
+
+# Layout of module state as a float64 vector (Module.get_state), shared by all modules so
+# that the states of a hierarchy stack into one array (see stack_states and kernels.py)
+# Oscillator state shared by all modules
+ANGLE, FREQ, AMP, PERIOD, SHIFTS, INITIAL = range(6)
+INHIBITION = 18
+# M0 and subM1
+MISSED, ENTRAINED = 6, 7
+# M1 and M2 bursts
+BURSTING, BURST_POS, BURST_DUR = 7, 8, 9
+# M2 (its pattern and element end times are kept apart, see M2.get_state)
+VALUE, DURATION, ADUR, BDUR, THRESHOLD, INDEX, LENGTH, NEGATIVES = range(10, 18)
+# Sensory
+CURRENT, SLOT, BURST_PHASE, MAX_SLOTS, SENSORY_DUR, BURST_FREQ = range(8, 14)
+# M3
+CALIBRATING, CALIB_BEGIN, RECAL = 6, 7, 8
+
+STATE_SIZE = 19
+
+
+# States of several modules as one (modules, STATE_SIZE) array
+def stack_states(modules):
+    return np.stack([mod.get_state() for mod in modules])
+
+
+# Restores the states given by stack_states
+def unstack_states(modules, states):
+    for mod, state in zip(modules, states):
+        mod.set_state(state)
+
+
 # Base oscillator
 class Module:
     CONSTANT = 1 / 360
+    __slots__ = (
+        "name", "initial_freq", "freq_hertz", "amplitude", "phase", "period",
+        "phase_shifts", "angle", "inhibition",
+    )
 
     # frequency: in Hertz (cycles/sec)
     def __init__(self, name, frequency, phase=0, amplitude=1):
@@ -50,10 +152,7 @@ class Module:
 
     # Update oscillator by 1 time step
     def pulse(self):
-        y = (
-            self.amplitude * (np.sin(2 * np.pi * Module.CONSTANT * self.angle))
-            + self.amplitude
-        ) / 2
+        y = waveforms.rectified(self.angle, self.amplitude)
         self.angle += self.freq_hertz
         self.angle = self.angle % 360
 
@@ -66,17 +165,35 @@ class Module:
         self.period = 360
         self.phase_shifts = 0
 
+    # State as a float64 vector (layout above); submodules have states of their own
+    def get_state(self):
+        state = np.zeros(STATE_SIZE)
+        state[[ANGLE, FREQ, AMP, PERIOD, SHIFTS, INITIAL, INHIBITION]] = [
+            self.angle, self.freq_hertz, self.amplitude, self.period, self.phase_shifts,
+            self.initial_freq, self.inhibition,
+        ]
+        return state
+
+    # Restores the state given by get_state
+    def set_state(self, state):
+        self.angle = float(state[ANGLE])
+        self.freq_hertz = float(state[FREQ])
+        self.amplitude = float(state[AMP])
+        self.period = float(state[PERIOD])
+        self.phase_shifts = int(state[SHIFTS])
+        self.initial_freq = float(state[INITIAL])
+        self.inhibition = float(state[INHIBITION])
+
 
 class M0(Module):
+    __slots__ = ("missed_inputs",)
+
     def __init__(self, name, frequency, phase=0, amplitude=1):
         super().__init__(name, frequency, phase, amplitude)
         self.missed_inputs = 0
 
     def pulse(self, feedback_m2=0):
-        y = (
-            self.amplitude * (np.sin(2 * np.pi * Module.CONSTANT * self.angle))
-            + self.amplitude
-        ) / 2
+        y = waveforms.rectified(self.angle, self.amplitude)
         if feedback_m2 != 1:
             self.angle += self.freq_hertz
             self.angle = self.angle % 360
@@ -124,8 +241,19 @@ class M0(Module):
         super().reset_initial()
         self.missed_inputs = 0
 
+    def get_state(self):
+        state = super().get_state()
+        state[MISSED] = self.missed_inputs
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.missed_inputs = int(state[MISSED])
+
 
 class M0_nested(Module):
+    __slots__ = ("missed_inputs", "high_freq", "nested", "burst_pos")
+
     def __init__(self, name, frequency, phase=0, amplitude=1, high_freq=12):
         super().__init__(name, frequency, phase, amplitude)
         self.missed_inputs = 0
@@ -136,10 +264,7 @@ class M0_nested(Module):
         self.burst_pos = 0
 
     def pulse(self, feedback_m2=0):
-        y = (
-            self.amplitude * (np.sin(2 * np.pi * Module.CONSTANT * self.angle))
-            + self.amplitude
-        ) / 2
+        y = waveforms.rectified(self.angle, self.amplitude)
         if feedback_m2 != 1:
             self.angle += self.freq_hertz
             self.angle = self.angle % 360
@@ -189,8 +314,20 @@ class M0_nested(Module):
         super().reset_initial()
         self.missed_inputs = 0
 
+    def get_state(self):
+        state = super().get_state()
+        state[[MISSED, BURST_POS]] = [self.missed_inputs, self.burst_pos]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.missed_inputs = int(state[MISSED])
+        self.burst_pos = int(state[BURST_POS])
+
 
 class M0_nested_phasemod(Module):
+    __slots__ = ("missed_inputs", "high_freq", "nested", "burst_pos", "pref_phase")
+
     def __init__(self, name, frequency, phase=0, amplitude=1, high_freq=12):
         super().__init__(name, frequency, phase, amplitude)
         self.missed_inputs = 0
@@ -204,10 +341,7 @@ class M0_nested_phasemod(Module):
         self.pref_phase = 90
 
     def pulse(self, feedback_m2=0):
-        y = (
-            self.amplitude * (np.sin(2 * np.pi * Module.CONSTANT * self.angle))
-            + self.amplitude
-        ) / 2
+        y = waveforms.rectified(self.angle, self.amplitude)
         if feedback_m2 != 1:
             self.angle += self.freq_hertz
             self.angle = self.angle % 360
@@ -262,7 +396,19 @@ class M0_nested_phasemod(Module):
         super().reset_initial()
         self.missed_inputs = 0
 
+    def get_state(self):
+        state = super().get_state()
+        state[[MISSED, BURST_POS]] = [self.missed_inputs, self.burst_pos]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.missed_inputs = int(state[MISSED])
+        self.burst_pos = int(state[BURST_POS])
+
 class subM1(Module):
+    __slots__ = ("entrained", "missed_inputs")
+
     def __init__(self, name, frequency, phase=0, amplitude=1):
         super().__init__(name, frequency, phase=phase, amplitude=amplitude)
         self.entrained = False
@@ -273,15 +419,18 @@ class subM1(Module):
         self.entrained = False
         self.missed_inputs = 0
 
+    def get_state(self):
+        state = super().get_state()
+        state[[MISSED, ENTRAINED]] = [self.missed_inputs, self.entrained]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.missed_inputs = int(state[MISSED])
+        self.entrained = bool(state[ENTRAINED])
+
     def calc_error(self):
-        error = 0.25 * (
-                (
-                    self.amplitude
-                    * (np.sin(2 * np.pi * Module.CONSTANT * self.angle))
-                    + self.amplitude
-                )
-                / 2
-        )
+        error = 0.25 * waveforms.rectified(self.angle, self.amplitude)
         return error
     
     def pulse(self, stimulus):
@@ -295,6 +444,11 @@ class subM1(Module):
 
 
 class M1(Module):
+    __slots__ = (
+        "subm1a", "subm1b", "missed_inputs", "burst_freq", "burster", "burst_duration",
+        "burst_pos", "bursting",
+    )
+
     def __init__(
         self, name, frequency, phase=0, amplitude=1, burst_freq=12, burst_duration=50
     ):
@@ -359,8 +513,28 @@ class M1(Module):
         super().reset_initial()
         self.missed_inputs = 0
 
+    def get_state(self):
+        state = super().get_state()
+        state[[MISSED, BURSTING, BURST_POS, BURST_DUR]] = [
+            self.missed_inputs, self.bursting, self.burst_pos, self.burst_duration,
+        ]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.missed_inputs = int(state[MISSED])
+        self.bursting = bool(state[BURSTING])
+        self.burst_pos = int(state[BURST_POS])
+        self.burst_duration = int(state[BURST_DUR])
+
 
 class M2(Module):
+    __slots__ = (
+        "value", "duration", "Aduration", "Bduration", "threshold", "m0", "m1", "subA",
+        "subB", "pattern", "time", "negatives", "i", "burster", "burst_duration",
+        "burst_pos", "bursting",
+    )
+
     def __init__(
         self,
         name,
@@ -384,6 +558,7 @@ class M2(Module):
         self.subA, self.subB = submodules
         self.pattern = [0]
         self.time = [self.period]
+        self.negatives = 0  # occurrences of -1 in pattern
         self.i = 0
 
         # Take care of bursting
@@ -403,6 +578,14 @@ class M2(Module):
             self.angle = self.angle % self.duration
         return y, self.angle
 
+    # Appends value to the pattern, one element of step_duration after the last
+    def append(self, value, step_duration):
+        self.duration += step_duration
+        self.pattern.append(value)
+        self.time.append(self.time[-1] + step_duration)
+        if value == -1:
+            self.negatives += 1
+
     def send_feedback(self):
         # output 1 if m0 should reset i.e. if the submodule it's listening to is at / nearing a minimum
         # output 0 otherwise
@@ -430,6 +613,7 @@ class M2(Module):
             self.duration = self.Aduration
             self.pattern = [1]
             self.time = [self.Aduration]
+            self.negatives = 0
 
         # When subM1b becomes entrained
         if self.Bduration == 0 and self.subB.entrained:
@@ -440,18 +624,14 @@ class M2(Module):
             # If listening to M1A
             if self.value == 1:
                 # If M1A is at a minimum, at another M1A to the pattern
-                if self.subA.is_min() and self.pattern.count(-1) == 0:
-                    self.duration += self.Aduration
-                    self.pattern.append(1)
-                    self.time.append(self.time[-1] + self.Aduration)
+                if self.subA.is_min() and self.negatives == 0:
+                    self.append(1, self.Aduration)
                     self.angle = 0
                     self.i = 0
 
                 # Else, add M1B
                 elif not self.subA.is_min() and self.subB.entrained:
-                    self.duration += self.Bduration
-                    self.pattern.append(-1)
-                    self.time.append(self.time[-1] + self.Bduration)
+                    self.append(-1, self.Bduration)
                     self.angle = 0
                     self.i = 0
 
@@ -498,15 +678,45 @@ class M2(Module):
     def reset_initial(self):
         self.pattern = [0]
         self.time = [360]
+        self.negatives = 0
         self.i = 0
         self.value = 0
         self.duration = 360
         self.Aduration = 0
         self.Bduration = 0
 
+    # The pattern and its element end times are not part of the state vector, which only
+    # holds their length (see kernels.pack_pattern)
+    def get_state(self):
+        state = super().get_state()
+        state[[BURSTING, BURST_POS, BURST_DUR]] = [self.bursting, self.burst_pos, self.burst_duration]
+        state[[VALUE, DURATION, ADUR, BDUR, THRESHOLD, INDEX, LENGTH, NEGATIVES]] = [
+            self.value, self.duration, self.Aduration, self.Bduration, self.threshold,
+            self.i, len(self.pattern), self.negatives,
+        ]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.bursting = bool(state[BURSTING])
+        self.burst_pos = int(state[BURST_POS])
+        self.burst_duration = int(state[BURST_DUR])
+        self.value = int(state[VALUE])
+        self.duration = float(state[DURATION])
+        self.Aduration = float(state[ADUR])
+        self.Bduration = float(state[BDUR])
+        self.threshold = int(state[THRESHOLD])
+        self.i = int(state[INDEX])
+        self.negatives = int(state[NEGATIVES])
+
 
 
 class Sensory(Module):
+    __slots__ = (
+        "bursting", "current_burst", "slot_count", "burst_phase", "burst_freq", "max_slots",
+        "burst_duration", "burster",
+    )
+
     def __init__(self, name, frequency, phase=0, amplitude=1, fA=12, fP=270):
         super().__init__(name, frequency, phase, amplitude)
 
@@ -525,6 +735,13 @@ class Sensory(Module):
         )
         self.burster.set_angle(180)
 
+    # Changes the frequency of the fast bursts (fA), e.g. in a run forked from a checkpoint
+    def set_burst_frequency(self, fA):
+        self.burst_freq = fA
+        self.burst_duration = round(360 // fA)
+        self.burster.initial_freq = fA
+        self.burster.set_frequency(fA)
+
     # Shifts preferred phase of bursts along slow wave cycle by sign cycles of fast bursts
     def adjust_phase(self, sign):
         if sign != 0:
@@ -575,8 +792,28 @@ class Sensory(Module):
 
         return y, reg  # amplitude and slot in which input was registered, if at all
 
+    def get_state(self):
+        state = super().get_state()
+        state[[BURSTING, CURRENT, SLOT, BURST_PHASE, MAX_SLOTS, SENSORY_DUR, BURST_FREQ]] = [
+            self.bursting, self.current_burst, self.slot_count, self.burst_phase,
+            self.max_slots, self.burst_duration, self.burst_freq,
+        ]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.bursting = bool(state[BURSTING])
+        self.current_burst = int(state[CURRENT])
+        self.slot_count = int(state[SLOT])
+        self.burst_phase = float(state[BURST_PHASE])
+        self.max_slots = int(state[MAX_SLOTS])
+        self.burst_duration = int(state[SENSORY_DUR])
+        self.burst_freq = float(state[BURST_FREQ])
+
 # Integrator
 class M3(Module):
+    __slots__ = ("calibrating", "calibBegin", "recal")
+
     def __init__(self, name, frequency=10, phase=0, amplitude=1):
         super().__init__(name, frequency, phase, amplitude)
         self.calibrating = False
@@ -614,4 +851,17 @@ class M3(Module):
             self.calibBegin = None
             self.recal = None
 
-        return y, x, sync, recal
\ No newline at end of file
+        return y, x, sync, recal
+
+    def get_state(self):
+        state = super().get_state()
+        state[CALIBRATING] = self.calibrating
+        if self.calibrating:
+            state[[CALIB_BEGIN, RECAL]] = [self.calibBegin, self.recal]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.calibrating = bool(state[CALIBRATING])
+        self.calibBegin = int(state[CALIB_BEGIN]) if self.calibrating else None
+        self.recal = int(state[RECAL]) if self.calibrating else None
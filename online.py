@@ -0,0 +1,79 @@
+import numpy as np
+from bootstrap import *
+
+""" Online analysis of a multisensory session, ending it once recalibration is known well enough """
+
+# Each registered trial is counted in a (previous lead, SOA, response) cell as it arrives,
+# so refitting never rescans the trials. A bootstrap of the trial pairs is a multinomial
+# draw over these cells, which keeps every refit independent of the session length.
+
+# Response outcomes counted per cell
+SYNC, ASYNC, OTHER = range(3)
+
+
+class OnlineAnalyzer:
+    # width: end the session once the confidence interval of TR is narrower than this (ms)
+    # level: coverage of the interval; every: trials between refits, from min_trials on
+    # resamples: bootstrap resamples per refit; rng: seed or Generator of the resampling
+    def __init__(self, width, level=0.95, every=25, min_trials=100, resamples=200, rng=None):
+        self.width = width
+        self.level = level
+        self.every = every
+        self.min_trials = min_trials
+        self.resamples = resamples
+        self.rng = np.random.default_rng(rng)
+        self.start(None)
+
+    # Clears the counts for a session of the given duration
+    def start(self, duration):
+        self.duration = duration
+        self.end = duration
+        self.soas = []
+        self.codes = {}
+        self.counts = np.zeros((len(LEADS), 0, 3), dtype=np.int64)
+        self.trials = 0
+        self.prev_lead = None
+        self.estimates = []
+        self.done = False
+
+    # Counts a trial; returns True once the session can end
+    def add(self, lead, soa, response):
+        if self.trials > 0:
+            if soa not in self.codes:
+                self.codes[soa] = len(self.soas)
+                self.soas.append(soa)
+                self.counts = np.concatenate([self.counts, np.zeros((len(LEADS), 1, 3), dtype=np.int64)], axis=1)
+            outcome = SYNC if response == 1 else ASYNC if response == -1 else OTHER
+            self.counts[LEAD_CODES[self.prev_lead], self.codes[soa], outcome] += 1
+        self.prev_lead = lead
+        self.trials += 1
+
+        if self.trials >= self.min_trials and (self.trials - self.min_trials) % self.every == 0:
+            self.refit()
+        return self.done
+
+    # TR of the trials so far, with a bootstrap interval; records the estimate
+    def refit(self):
+        order = np.argsort(self.soas)
+        soas = np.asarray(self.soas)[order]
+        counts = self.counts[:, order]
+        pairs = counts.sum()
+
+        draws = self.rng.multinomial(pairs, counts.ravel() / pairs, size=self.resamples)
+        counts = np.concatenate([counts[None], draws.reshape((self.resamples,) + counts.shape)])
+        tr = synchrony_tr(soas, counts[..., SYNC], counts[..., ASYNC], counts.sum(axis=(1, 3)))
+
+        samples = tr[1:][np.isfinite(tr[1:])]
+        tail = 100 * (1 - self.level) / 2
+        low, high = np.percentile(samples, [tail, 100 - tail]) if len(samples) else (np.nan, np.nan)
+        self.estimates.append({"trials": self.trials, "tr": tr[0], "low": low, "high": high})
+        self.done = bool(high - low < self.width)
+
+    # Called by the experiment with the step its session ended at
+    def finish(self, end):
+        self.end = int(end)
+
+    # Latest estimate, with the simulated time used and saved by ending early (ms)
+    def report(self):
+        estimate = self.estimates[-1] if self.estimates else {"trials": self.trials, "tr": np.nan, "low": np.nan, "high": np.nan}
+        return dict(estimate, done=self.done, end=self.end, saved=self.duration - self.end)
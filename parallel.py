@@ -0,0 +1,71 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+""" Process-pool execution of independent simulation tasks """
+
+# One repetition of a multisensory experiment
+Task = namedtuple("Task", ["fA", "num_min", "run_index", "seed"])
+
+
+# Result of a task that could not be completed
+class TaskFailure:
+    def __init__(self, task, error):
+        self.task = task
+        self.error = error
+
+    def __repr__(self):
+        return f"TaskFailure({self.task}, {self.error!r})"
+
+
+# Builds one task per (fA, run), each with its own child stream of SeedSequence(seed)
+def make_tasks(freqs, num_min, runs, seed=None):
+    seeds = np.random.SeedSequence(seed).spawn(len(freqs) * runs)
+    tasks = []
+    for f, fA in enumerate(freqs):
+        for run in range(runs):
+            tasks.append(Task(fA, num_min, run, seeds[f * runs + run]))
+    return tasks
+
+
+# Splits tasks into consecutive chunks of at most chunksize tasks
+def chunked(tasks, chunksize):
+    return [tasks[i : i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+
+# Runs func on chunks of tasks across worker processes
+# func(chunk) must return one result per task; returns all results in task order
+# workers: number of processes (None for one per core, 1 to run in this process)
+# chunksize: tasks sent to a worker at once (None to split tasks evenly over workers)
+def run_parallel(func, tasks, workers=None, chunksize=None):
+    tasks = list(tasks)
+    if len(tasks) == 0:
+        return []
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    if chunksize is None:
+        chunksize = -(-len(tasks) // workers)
+    chunks = chunked(tasks, chunksize)
+
+    if workers == 1:
+        return [result for chunk in chunks for result in run_chunk(func, chunk)]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(func, chunk) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.extend(future.result())
+            except Exception as error:
+                results.extend(TaskFailure(task, error) for task in chunk)
+    return results
+
+
+# Runs func on one chunk in this process, marking every task failed if it raises
+def run_chunk(func, chunk):
+    try:
+        return func(chunk)
+    except Exception as error:
+        return [TaskFailure(task, error) for task in chunk]
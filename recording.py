@@ -0,0 +1,93 @@
+import numpy as np
+
+""" Recording specifications: which series an experiment keeps, and at what resolution """
+
+# With a Recording set, Experiment runs through Experiment.stream and hands every chunk
+# to the Recording, which keeps only the requested series, reduced to one value per
+# window of decimate steps. Memory then depends on the chunk size and the kept series,
+# not on the session duration.
+
+STATS = {
+    "min": np.minimum.reduceat,
+    "max": np.maximum.reduceat,
+    "mean": lambda values, starts: np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values))),
+}
+
+
+# Stands in for a series that is not kept: it takes no memory, and writes to it are dropped
+class Discard:
+    def __setitem__(self, key, value):
+        pass
+
+    def __getitem__(self, key):
+        return self
+
+    def __iadd__(self, other):
+        return self
+
+
+DISCARD = Discard()
+
+
+class Recording:
+    # series: names of the series to keep (None for all); trials are always kept
+    # decimate: keep one value per window of this many steps
+    # stat: summary of each window: None (its first value), "min", "max" or "mean"
+    # tail: also keep the last tail steps of each kept series at full resolution
+    # chunk: steps simulated at a time (rounded up to a multiple of decimate)
+    def __init__(self, series=None, decimate=1, stat=None, tail=None, chunk=10000):
+        assert stat is None or stat in STATS, f"Unknown statistic {stat}"
+        self.series = series
+        self.decimate = decimate
+        self.stat = stat
+        self.tail = tail
+        self.chunk = -(-chunk // decimate) * decimate
+        self.kept = {}
+        self.tails = {}
+        self.finished = False
+
+    def wants(self, name):
+        return self.series is None or name in self.series
+
+    # Names of the series to keep, as Experiment.stream takes them (None for all)
+    def names(self):
+        return None if self.series is None else list(self.series)
+
+    # Keeps the requested series of one chunk yielded by Experiment.stream
+    def add(self, chunk):
+        if self.finished:
+            self.tails = {}
+            self.finished = False
+        for name, values in chunk.items():
+            if name in ["start", "stop", "trials", "time"] or not self.wants(name):
+                continue
+            self.kept.setdefault(name, []).append(self.reduce(values))
+            if self.tail:
+                recent = np.concatenate((self.tails.get(name, np.zeros(0)), values))
+                self.tails[name] = recent[-self.tail :]
+        self.kept.setdefault("time", []).append(chunk["time"][:: self.decimate])
+        if self.tail:
+            recent = np.concatenate((self.tails.get("time", np.zeros(0)), chunk["time"]))
+            self.tails["time"] = recent[-self.tail :]
+
+    # One value per window of decimate steps
+    def reduce(self, values):
+        if self.decimate == 1:
+            return np.array(values, dtype=float)
+        if self.stat is None:
+            return np.array(values[:: self.decimate], dtype=float)
+        starts = np.arange(0, len(values), self.decimate)
+        return STATS[self.stat](np.asarray(values, dtype=float), starts)
+
+    # Adds the kept series to results, time first
+    # The tails stay readable until the next run with this Recording begins
+    def finish(self, results):
+        results.add(np.concatenate(self.kept.pop("time")), "time")
+        for name, parts in self.kept.items():
+            results.add(np.concatenate(parts), name)
+        self.kept = {}
+        self.finished = True
+
+    # Last tail steps of each kept series at full resolution, and their times
+    def get_tails(self):
+        return self.tails
@@ -0,0 +1,182 @@
+import os
+import copy
+import pickle
+import hashlib
+import numpy as np
+from experiments import *
+from ensemble import *
+from warmstart import code_fingerprint, MODEL_SOURCES
+
+""" Content-addressed cache of finished runs on disk """
+
+# An entry is keyed by a hash of everything that determines a run: the stimulus (and so the
+# seed it was drawn from), the trial schedule, the modules' state before the run and a
+# fingerprint of the model code. It holds the trial table, the series selected when the
+# cache was made and the modules' final state, as one compressed .npz file. Skip-ahead and
+# compiled runs give the same results as plain ones, so they share entries.
+
+# Code that determines a run, from the stimuli drawn for a seed to the trials it produces
+CACHE_SOURCES = MODEL_SOURCES + ["inputs", "sparse", "ensemble", "trialtable"]
+
+# Module state saved and restored with each kind of run
+STATE = {
+    "entrainment": ["m0", "m1", "m2", "costs"],
+    "multisensory": ["audio", "visual", "integrator", "last_a", "last_v"],
+}
+
+
+class RunCache:
+    # directory: where entries are stored
+    # max_bytes: total size of entries kept; the least recently used are removed beyond it
+    # series: names of the series kept in each entry (all of them if None)
+    def __init__(self, directory, max_bytes=2**30, series=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.series = None if series is None else list(series)
+        self.fingerprint = code_fingerprint(CACHE_SOURCES)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # Hash of the given parts of a configuration, with the cache's own settings and code version
+    def key(self, *parts):
+        digest = hashlib.sha256()
+        digest.update(repr((self.fingerprint, self.series, waveforms.mode, waveforms.resolution)).encode())
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(repr((part.dtype.str, part.shape)).encode())
+                digest.update(np.ascontiguousarray(part).tobytes())
+            elif isinstance(part, bytes):
+                digest.update(part)
+            else:
+                digest.update(repr(part).encode())
+        return digest.hexdigest()
+
+    # Key of the run exp is about to make (after start_entrainment or start_multisensory)
+    def run_key(self, exp, kind):
+        parts = [kind, exp.duration, getattr(exp, "end_time", None)]
+        stimuli = [exp.stim] if kind == "entrainment" else list(exp.stim)
+        for stim in stimuli:
+            parts.extend(stimulus_content(stim))
+        if kind == "multisensory":
+            parts.extend([np.asarray(exp.trial_start), np.asarray(exp.trial_end), exp.leads, exp.soas])
+        modules = [getattr(exp, name) for name in STATE[kind] if name != "costs"]
+        parts.append(pickle.dumps(modules))
+        return self.key(*parts)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    # Entry contents as a dict of arrays, or None on a miss
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        with np.load(path) as data:
+            entry = {name: data[name] for name in data.files}
+        os.utime(path)  # most recently used
+        self.hits += 1
+        return entry
+
+    # Stores the arrays of an entry, then removes least recently used entries beyond max_bytes
+    def save(self, key, entry):
+        path = self.path(key)
+        with open(path + ".tmp", "wb") as file:
+            np.savez_compressed(file, **entry)
+        os.replace(path + ".tmp", path)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self.evictions += 1
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit rate": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+            "bytes": self.size(),
+        }
+
+    # Stores the finished run of exp under key
+    # stimuli: names of the stimulus series, which are inputs of the run and not stored
+    def store(self, exp, key, kind, stimuli):
+        names = [name for name in exp.result.list_results() if name not in stimuli and name != "time"]
+        if self.series is not None:
+            names = [name for name in names if name in self.series]
+        entry = {"names": np.array(names, dtype=str)}
+        for i, name in enumerate(names):
+            entry[f"series_{i}"] = np.asarray(exp.result.get(name))
+        if kind == "multisensory":
+            trials = exp.trials
+            entry.update(lead=trials["lead"], soa=trials["soa"], response=trials["response"])
+
+        state = {name: getattr(exp, name) for name in STATE[kind]}
+        if "costs" in state:
+            # The per-step costs are stored as series, if selected
+            state["costs"] = copy.copy(state["costs"])
+            state["costs"].record_into(np.zeros(0), np.zeros(0), 0)
+        entry["state"] = np.frombuffer(pickle.dumps(state), dtype=np.uint8)
+        self.save(key, entry)
+
+    # Gives exp the results and final state of a cached run; returns False on a miss
+    def restore(self, exp, key, kind, stimuli):
+        entry = self.load(key)
+        if entry is None:
+            return False
+
+        for name, stim in stimuli.items():
+            exp.result.add(stim, name)
+        for i, name in enumerate(entry["names"]):
+            exp.result.add(entry[f"series_{i}"], str(name))
+        if kind == "multisensory":
+            exp.trials = TrialTable.from_columns(entry["lead"], entry["soa"], entry["response"])
+            exp.result.add_trials(exp.trials)
+
+        for name, value in pickle.loads(entry["state"].tobytes()).items():
+            setattr(exp, name, value)
+        if kind == "entrainment":
+            names = list(entry["names"])
+            if "cost" in names and "total cost" in names:
+                exp.costs.record_into(entry[f"series_{names.index('cost')}"], entry[f"series_{names.index('total cost')}"], 0)
+        return True
+
+    # Trial tables of run_experiments tasks, simulating only those not in the cache
+    # simulate(tasks) returns a TrialTable or TaskFailure per task (see analysis.simulate_trials)
+    def task_trials(self, tasks, simulate):
+        keys = [self.key("task", task.fA, task.num_min, task.seed.entropy, task.seed.spawn_key) for task in tasks]
+        tables = [None] * len(tasks)
+        for t, key in enumerate(keys):
+            entry = self.load(key)
+            if entry is not None:
+                tables[t] = TrialTable.from_columns(entry["lead"], entry["soa"], entry["response"])
+
+        missing = [t for t, table in enumerate(tables) if table is None]
+        for t, table in zip(missing, simulate([tasks[t] for t in missing])):
+            tables[t] = table
+            if isinstance(table, TrialTable):
+                self.save(keys[t], {"lead": table["lead"], "soa": table["soa"], "response": table["response"]})
+        return tables
+
+
+# Onset steps and values of a stimulus series, the same whether it is dense or sparse
+def stimulus_content(stim):
+    if isinstance(stim, SparseSeries):
+        return [stim.duration, stim.onsets.astype(np.int64), np.ones(len(stim.onsets))]
+    stim = np.asarray(stim)
+    onsets = np.flatnonzero(stim)
+    return [len(stim), onsets.astype(np.int64), stim[onsets].astype(float)]
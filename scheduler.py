@@ -0,0 +1,80 @@
+import numpy as np
+from sparse import SparseSeries
+
+""" Event schedules: sorted queues of experiment events with O(1) lookup of the next event """
+
+# Event kinds
+STIMULUS = 0
+TRIAL_START = 1
+TRIAL_END = 2
+
+
+class Schedule:
+    def __init__(self, duration):
+        self.duration = duration
+        self.events = []  # (time, kind, trial) sorted by time, insertion order within a step
+        self.cursor = 0
+        self.leads = []
+        self.soas = []
+
+    # Adds events of one kind; trials: index of the trial each event belongs to
+    def add(self, times, kind, trials=None):
+        if trials is None:
+            trials = [None] * len(times)
+        self.events += [(int(t), kind, trial) for t, trial in zip(times, trials)]
+        self.events.sort(key=lambda event: event[0])
+        self.rewind()
+
+    # Adds the start and end events of each trial and keeps its lead and SOA for lookup
+    def add_trials(self, trial_start, trial_end, leads, soas):
+        first = len(self.leads)
+        trials = range(first, first + len(leads))
+        self.leads += list(leads)
+        self.soas += list(soas)
+        self.add(trial_start, TRIAL_START, trials)
+        self.add(trial_end, TRIAL_END, trials)
+
+    # Drops events of the given kind at or after time start
+    def remove(self, kind, start=0):
+        self.events = [e for e in self.events if e[1] != kind or e[0] < start]
+        self.rewind()
+
+    def rewind(self):
+        self.cursor = 0
+
+    def get_trial(self, trial):
+        return self.leads[trial], self.soas[trial]
+
+    def num_trials(self):
+        return len(self.leads)
+
+    # Time steps of all events of one kind
+    def times(self, kind):
+        return np.array([e[0] for e in self.events if e[1] == kind], dtype=int)
+
+    # Time of the first event at or after step i (duration if there is none)
+    # Steps must be visited in increasing order; earlier events are passed over
+    def next_time(self, i):
+        while self.cursor < len(self.events) and self.events[self.cursor][0] < i:
+            self.cursor += 1
+        if self.cursor == len(self.events):
+            return self.duration
+        return self.events[self.cursor][0]
+
+    # Returns the (kind, trial) pairs scheduled at step i and moves past them
+    def pop(self, i):
+        found = []
+        if self.next_time(i) == i:
+            while self.cursor < len(self.events) and self.events[self.cursor][0] == i:
+                found.append(self.events[self.cursor][1:])
+                self.cursor += 1
+        return found
+
+
+# Schedule of stimulus onsets in one or more stimulus series, dense or SparseSeries
+def stimulus_schedule(duration, *stimuli):
+    schedule = Schedule(duration)
+    for stim in stimuli:
+        onsets = stim.onsets if isinstance(stim, SparseSeries) else np.flatnonzero(stim)
+        schedule.add(onsets, STIMULUS)
+    return schedule
@@ -0,0 +1,213 @@
+import numpy as np
+from modules import *
+
+""" Event-driven simulation: jump over the quiet steps between events in closed form """
+
+# Between events every oscillator only adds freq_hertz to its angle, so a run of quiet
+# steps can be filled with one vectorized sin evaluation. Events are stimulus onsets,
+# trial ends, the 270 degree minima of M0/subM1, Sensory burst-phase entries and slot
+# rollovers, M2 pattern boundaries and the end of an integrator recalibration pulse;
+# each event step is still taken by the regular Experiment step methods. Stimulus
+# onsets and trial ends come from the experiment's Schedule (see scheduler.py).
+
+
+# Angles an oscillator moves through over the next steps, exactly as repeated (angle + freq) % 360
+def advance_angles(angle, freq, steps):
+    if float(angle).is_integer() and float(freq).is_integer():
+        return (angle + freq * np.arange(1, steps + 1)) % 360
+
+    # Sequential sums match repeated addition until the angle wraps past 360
+    angles = np.empty(steps)
+    done = 0
+    while done < steps:
+        run = min(steps - done, int((360 - angle) // freq) + 1)
+        sums = np.cumsum(np.concatenate(([angle], np.full(run, freq))))[1:]
+        wrap = np.flatnonzero(sums >= 360)
+        if len(wrap) > 0:
+            run = wrap[0] + 1
+            sums[wrap[0]] %= 360
+        angles[done : done + run] = sums[:run]
+        angle = sums[run - 1]
+        done += run
+    return angles
+
+
+# Rectified sine output of an oscillator at each of the given angles
+def waveform(angles, amplitude):
+    return waveforms.rectified(angles, amplitude)
+
+
+# Angles held by an oscillator at the start of each step, given the angles after each step
+def angles_before(angle, angles):
+    return np.concatenate(([angle], angles[:-1]))
+
+
+# Index of the first True in condition, or default if there is none
+def first(condition, default):
+    hits = np.flatnonzero(condition)
+    return hits[0] if len(hits) > 0 else default
+
+
+# Advance an oscillator over quiet steps, as repeated Module.pulse; returns its output at each step
+def skip_module(module, steps, angles=None):
+    if angles is None:
+        angles = advance_angles(module.angle, module.freq_hertz, steps)
+    y = waveform(angles_before(module.angle, angles), module.amplitude)
+    module.angle = float(angles[-1])
+    module.inhibition = y[-1]
+    return y
+
+
+# Advance a bursting M1/M2 over quiet steps; returns the burst added to the first n steps
+def skip_bursts(module, steps):
+    if not module.bursting:
+        return np.zeros(0)
+
+    n = min(steps, module.burst_duration - module.burst_pos)
+    b_y = skip_module(module.burster, n) - (module.burster.amplitude / 2)
+    module.burst_pos += n
+
+    if module.burst_pos >= module.burst_duration:
+        module.burst_pos = 0
+        module.bursting = False
+    return b_y
+
+
+######## Temporal recalibration (Experiment.run_multisensory) ########
+
+
+# Steps until a Sensory module enters bursting mode or rolls over to the next slot
+def sensory_quiet_steps(mod, angles):
+    if mod.bursting:
+        return int(mod.burst_duration - mod.current_burst)
+    return first(np.round(angles) == mod.burst_phase, len(angles))
+
+
+# Cheap scalar check for a burst-phase entry or slot rollover on the current step
+def sensory_event_now(mod):
+    if mod.bursting:
+        return mod.current_burst == mod.burst_duration
+    return round((mod.angle + mod.freq_hertz) % 360) == mod.burst_phase
+
+
+def skip_sensory(mod, steps, angles):
+    y = skip_module(mod, steps, angles)
+    if mod.bursting:
+        b_y = skip_module(mod.burster, steps)
+        y = y + (b_y - mod.burster.get_amplitude() / 2)
+        mod.current_burst += steps
+    return y
+
+
+def skip_integrator(mod, steps, angles):
+    y = skip_module(mod, steps, angles)
+    y = y - mod.amplitude / 2
+    if mod.calibrating:
+        y = y * abs(mod.recal)
+    return y
+
+
+# Jump over the quiet steps starting at i; returns the number of steps skipped
+def skip_multisensory(exp, i, series):
+    y_a, y_v, y_i, recal, sync, cost = series
+    k = i - exp.offset
+
+    steps = min(exp.schedule.next_time(i), exp.stop) - i
+    if steps == 0 or any(sensory_event_now(mod) for mod in [exp.audio, exp.visual]):
+        return 0
+
+    trajectories = {}
+    for mod in [exp.audio, exp.visual]:
+        trajectories[mod] = advance_angles(mod.angle, mod.freq_hertz, steps)
+        steps = min(steps, sensory_quiet_steps(mod, trajectories[mod]))
+
+    integrator = exp.integrator
+    trajectories[integrator] = advance_angles(integrator.angle, integrator.freq_hertz, steps)
+    if integrator.calibrating:
+        end = np.round(trajectories[integrator]) == integrator.calibBegin
+        steps = min(steps, first(end, steps))
+
+    if steps == 0:
+        return 0
+
+    y_a[k : k + steps] = skip_sensory(exp.audio, steps, trajectories[exp.audio][:steps])
+    y_v[k : k + steps] = skip_sensory(exp.visual, steps, trajectories[exp.visual][:steps])
+    y_i[k : k + steps] = skip_integrator(integrator, steps, trajectories[integrator][:steps])
+    return steps
+
+
+######## Neural entrainment (Experiment.run) ########
+
+
+def skip_m0(m0, steps, angles):
+    y = waveform(angles_before(m0.angle, angles), m0.amplitude)
+    m0.angle = float(angles[-1])
+
+    if isinstance(m0, (M0_nested, M0_nested_phasemod)):
+        b_y = skip_module(m0.nested, steps) - (m0.nested.amplitude / 2)
+        if isinstance(m0, M0_nested_phasemod):
+            scale = 1 - (np.abs(m0.pref_phase - angles) / 180)
+            y = y - np.abs(b_y * scale)
+        else:
+            y = y + b_y
+        m0.burst_pos += steps
+    return y
+
+
+# Cheap scalar check for an event on the current step, before building trajectories
+def entrainment_event_now(exp):
+    m0, m2 = exp.m0, exp.m2
+    return (
+        exp.m1.subm1a.is_min()
+        or exp.m1.subm1b.is_min()
+        or round((m0.angle + m0.freq_hertz) % 360) == 270
+        or m2.angle + m2.freq_hertz > round(m2.time[m2.i])
+    )
+
+
+# Jump over the quiet steps starting at i; returns the number of steps skipped
+def skip_entrainment(exp, i, series):
+    x, cost, total_cost, y, ym1, ym1a, ym1b, ym2 = series
+    m0, m1, m2 = exp.m0, exp.m1, exp.m2
+    subs = [m1.subm1a, m1.subm1b]
+    k = i - exp.offset
+
+    steps = min(exp.schedule.next_time(i), exp.stop) - i
+    if steps == 0 or entrainment_event_now(exp):
+        return 0
+
+    # subM1 minima are read by M2 at the start of a step
+    sub_angles = []
+    for sub in subs:
+        angles = advance_angles(sub.angle, sub.freq_hertz, steps)
+        steps = min(steps, first(np.round(angles_before(sub.angle, angles)) == 270, steps))
+        sub_angles.append(angles)
+
+    # M0 minimum after its pulse: expectation unmet
+    m0_angles = advance_angles(m0.angle, m0.freq_hertz, steps)
+    steps = min(steps, first(np.round(m0_angles) == 270, steps))
+
+    # M2 moves on to the next element of its pattern
+    m2_angles = np.cumsum(np.concatenate(([m2.angle], np.full(steps, m2.freq_hertz))))[1:]
+    steps = min(steps, first(m2_angles > round(m2.time[m2.i]), steps))
+
+    if steps == 0:
+        return 0
+    quiet = slice(k, k + steps)
+
+    y[quiet] = skip_m0(m0, steps, m0_angles[:steps])
+    x[quiet] = m0_angles[:steps]
+
+    ym1[quiet] = skip_module(m1, steps)
+    b_y = skip_bursts(m1, steps)
+    ym1[k : k + len(b_y)] += b_y
+
+    m2.value = m2.pattern[m2.i]
+    m2.angle = float(m2_angles[steps - 1])
+    ym2[quiet] = m2.value
+    b_y = skip_bursts(m2, steps)
+    ym2[k : k + len(b_y)] += b_y
+
+    ym1a[quiet] = skip_module(subs[0], steps, sub_angles[0][:steps])
+    ym1b[quiet] = skip_module(subs[1], steps, sub_angles[1][:steps])
+    return steps
@@ -0,0 +1,123 @@
+import numpy as np
+from inputs import *
+
+""" Sparse stimuli: sorted onset steps instead of one value per time step """
+
+# A dense stimulus of a 10 minute session holds 600,000 values for a few hundred onsets.
+# SparseSeries keeps only the onset steps of one modality and answers "is there a stimulus
+# at step i" in O(1) with a cursor, as steps are visited in increasing order. np.asarray
+# (and so matplotlib) sees the dense series, built only when it is asked for.
+
+
+class SparseSeries:
+    # onsets: steps at which a stimulus occurs
+    def __init__(self, duration, onsets):
+        self.duration = duration
+        self.onsets = np.unique(np.asarray(onsets, dtype=int))
+        self.cursor = 0
+
+    @classmethod
+    def from_dense(cls, stim):
+        return cls(len(stim), np.flatnonzero(stim))
+
+    def __len__(self):
+        return self.duration
+
+    # Stimulus value at step i, or the dense values over a slice
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.duration)
+            if step != 1:
+                return self.dense()[i]
+            window = SparseSeries(max(stop - start, 0), [])
+            lo, hi = np.searchsorted(self.onsets, [start, stop])
+            window.onsets = self.onsets[lo:hi] - start
+            return window.dense()
+        if i < 0:
+            i += self.duration
+
+        # Steps visited out of order move the cursor by binary search
+        if self.cursor > 0 and self.onsets[self.cursor - 1] >= i:
+            self.cursor = int(np.searchsorted(self.onsets, i))
+        while self.cursor < len(self.onsets) and self.onsets[self.cursor] < i:
+            self.cursor += 1
+        if self.cursor < len(self.onsets) and self.onsets[self.cursor] == i:
+            return 1.0
+        return 0.0
+
+    def __array__(self, dtype=None, copy=None):
+        return self.dense(dtype or float)
+
+    def dense(self, dtype=float):
+        stim = np.zeros(self.duration, dtype=dtype)
+        stim[self.onsets] = 1
+        return stim
+
+    # Removes all stimuli at or after step end_time
+    def end(self, end_time):
+        self.onsets = self.onsets[self.onsets < end_time]
+        self.rewind()
+
+    def rewind(self):
+        self.cursor = 0
+
+
+class SparseStimulus:
+    # onsets: one list of onset steps per modality
+    # trial_start, trial_end, leads, soas: trial metadata of multisensory sessions, if any
+    def __init__(self, duration, onsets, trial_start=None, trial_end=None, leads=None, soas=None):
+        self.duration = duration
+        self.series = [SparseSeries(duration, modality) for modality in onsets]
+        self.trial_start = trial_start
+        self.trial_end = trial_end
+        self.leads = leads
+        self.soas = soas
+
+    @classmethod
+    def from_dense(cls, stimuli, *trials):
+        return cls(np.shape(stimuli)[-1], [np.flatnonzero(stim) for stim in stimuli], *trials)
+
+    def has_trials(self):
+        return self.leads is not None
+
+    # Series of one modality
+    def __getitem__(self, modality):
+        return self.series[modality]
+
+    def __iter__(self):
+        return iter(self.series)
+
+    def __len__(self):
+        return len(self.series)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.dense(dtype or float)
+
+    # Dense stimuli of shape (modalities, duration)
+    def dense(self, dtype=float):
+        return np.array([series.dense(dtype) for series in self.series])
+
+    def end(self, end_time):
+        for series in self.series:
+            series.end(end_time)
+
+    def rewind(self):
+        for series in self.series:
+            series.rewind()
+
+
+# Sparse counterpart of inputs.pattern; draws the same stimuli from rng
+def sparse_pattern(duration, intervals, rng=None):
+    rng = np.random.default_rng(rng)
+    stim_time = int(rng.integers(0, intervals[0], endpoint=True))
+    times, _ = pattern_onsets(duration, intervals, stim_time)
+    return SparseSeries(duration, times)
+
+
+# Sparse counterpart of inputs.multisensory_stimuli; draws the same trials from rng
+def sparse_multisensory(duration, modalities, rng=None, jitter=0, interval=720, asynchronies=None):
+    rng = np.random.default_rng(rng)
+    times, soas = multisensory_onsets(duration, rng, jitter, interval, asynchronies)
+    onsets = multisensory_onset_lists(duration, modalities, times, soas)
+    trials, trial_end, leads = multisensory_trials(times, soas)
+    return SparseStimulus(duration, onsets, trials, trial_end, leads, list(soas))
@@ -0,0 +1,132 @@
+import copy
+import pickle
+import hashlib
+import numpy as np
+from sparse import SparseSeries
+
+""" Steady-state detection for entrainment runs with periodic inputs """
+
+# With a strictly periodic stimulus, M0/M1/M2 settle into a limit cycle: the state of the
+# modules at some stimulus onset recurs exactly at a later onset, and from then on every
+# step repeats the one `period` steps before it. The run is simulated onset by onset until
+# the state recurs, after which the recorded cycle is tiled forward and only the last steps
+# of the run are simulated again (to leave the modules, the cost window and the final
+# partial cycle exactly as a full run would).
+#
+# M2 keeps a list of its pattern that grows by one element per onset, so its state never
+# recurs as a whole. It only ever reads the first elements of the list between two onsets,
+# though, so states are compared without the list, and a recurrence is accepted once it is
+# certain that nothing of the list beyond what both states share can be read in a cycle.
+
+
+# Steps of the stimulus onsets, dense or sparse
+def stimulus_onsets(stim):
+    if isinstance(stim, SparseSeries):
+        return stim.onsets
+    return np.flatnonzero(np.asarray(stim))
+
+
+# Digest of the module state of exp, leaving out M2's pattern lists (of which only
+# whether they hold any -1 is kept)
+def state_key(exp):
+    m2 = copy.copy(exp.m2)
+    m2.pattern = m2.time = m2.duration = None
+    m2.negatives = m2.negatives > 0
+    return hashlib.sha256(pickle.dumps((exp.m0, exp.m1, m2))).digest()
+
+
+# What is needed of M2's pattern lists at an onset to check a later recurrence
+def pattern_snapshot(m2):
+    return m2.pattern, m2.time, len(m2.pattern), m2.duration
+
+
+# True if the stimulus from step start + period on repeats the one from start on
+def stimulus_repeats(stim, start, period):
+    duration = len(stim)
+    if isinstance(stim, SparseSeries):
+        onsets = stim.onsets
+        earlier = onsets[(onsets >= start) & (onsets < duration - period)] + period
+        return np.array_equal(earlier, onsets[onsets >= start + period])
+    stim = np.asarray(stim)
+    return np.array_equal(stim[start + period :], stim[start : duration - period])
+
+
+# True if M2, back in the state it had `period` steps ago (snapshot), cannot read anything
+# of its pattern lists in the next cycle that differs from what it read in the last one
+def pattern_repeats(m2, period, snapshot):
+    pattern, time, length, duration = snapshot
+    # Lists replaced by a reset in between: the new ones must be the same as the old ones
+    # were (elements are only ever added, so the first `length` are as they were then)
+    if m2.pattern is not pattern or m2.time is not time:
+        return m2.pattern == pattern[:length] and m2.time == time[:length] and m2.duration == duration
+    # Nothing added: the whole state recurred
+    if len(pattern) == length:
+        return True
+
+    # Largest angle M2 can reach in a cycle; the angle wraps around the pattern duration
+    # beyond it, and the pattern index only moves on past elements ending before it
+    reach = m2.angle + m2.freq_hertz * period
+    if reach >= duration:
+        return False
+    last = 0
+    while last < length and round(time[last]) < reach:
+        last += 1
+    return max(last, m2.i) < length
+
+
+# Advances exp (after start_entrainment) over its whole run, tiling the limit cycle once
+# the state of the modules recurs; series as given by Experiment.entrainment_series
+# Returns the detected cycle: period, lock step (the onset at which the state recurred),
+# cycle start (lock step - period) and the number of steps actually simulated;
+# the period and steps are None if the state never recurred
+def run_steady_state(exp, series, skip_ahead=False):
+    seen = {}
+    step = 0
+    for onset in stimulus_onsets(exp.stim):
+        exp.advance(step, onset, [values[step:] for values in series], skip_ahead)
+        step = int(onset)
+
+        key = state_key(exp)
+        if key in seen:
+            start, snapshot, totals = seen[key]
+            period = step - start
+            if pattern_repeats(exp.m2, period, snapshot) and stimulus_repeats(exp.stim, start, period):
+                simulated = extrapolate(exp, series, start, step, snapshot, totals, skip_ahead)
+                return {"period": period, "lock step": step, "cycle start": start, "simulated": simulated}
+        seen[key] = (step, pattern_snapshot(exp.m2), exp.costs.totals.copy())
+
+    exp.advance(step, exp.duration, [values[step:] for values in series], skip_ahead)
+    return {"period": None, "lock step": None, "cycle start": None, "simulated": exp.duration}
+
+
+# Repeats the cycle over steps start, ..., lock - 1 up to the end of the run, simulating
+# whatever the repeats leave over; returns the number of steps simulated overall
+def extrapolate(exp, series, start, lock, snapshot, totals, skip_ahead=False):
+    x, cost, total_cost, y, ym1, ym1a, ym1b, ym2 = series
+    period = lock - start
+    remaining = exp.duration - lock
+
+    # Simulated steps at the end: the partial cycle, and whole cycles until they cover the
+    # cost window, so that rolling cost statistics come out of simulated steps
+    tail = remaining % period
+    while tail <= exp.costs.window and tail + period <= remaining:
+        tail += period
+    cycles = (remaining - tail) // period
+    end = lock + cycles * period
+
+    if cycles > 0:
+        for values in (x, y, ym1, ym1a, ym1b, ym2):
+            values[lock:end] = np.tile(values[start:lock], cycles)
+        exp.costs.repeat(lock, end, period, exp.costs.totals - totals)
+        extend_pattern(exp.m2, snapshot[2], cycles)
+
+    exp.advance(end, exp.duration, [values[end:] for values in series], skip_ahead)
+    return lock + tail
+
+
+# Adds to M2's pattern what a cycle adds to it, `cycles` times over, as M2 would
+def extend_pattern(m2, length, cycles):
+    added = m2.pattern[length:]
+    for _ in range(cycles):
+        for value in added:
+            m2.append(value, m2.Aduration if value == 1 else m2.Bduration)
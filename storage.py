@@ -0,0 +1,142 @@
+import os
+import json
+import weakref
+import numpy as np
+from experiments import Results
+from sparse import SparseSeries
+from trialtable import TrialTable
+
+""" Results stored on disk as memory-mapped series, for long sessions and many runs """
+
+# A results directory holds one .npy file per series and a small manifest.json listing
+# them in the order they were added, along with the trials of multisensory runs.
+# Reading a finished run maps the files instead of loading them, so only the parts
+# that are actually used (e.g. plotted or sliced) are read from disk. The series of a run
+# are filled in memory-mapped float64 buffer files as it runs, so that they do not have
+# to fit in memory either; a buffer added as a float64 series becomes its file, and
+# buffers that are not added are removed once no longer used.
+
+MANIFEST = "manifest.json"
+
+
+class DiskResults(Results):
+    # directory: results directory, created if needed
+    # dtype: storage type of float series (e.g. np.float32 to halve their size)
+    # mode: "w" to store a new run, in a directory that holds none; "overwrite" to replace
+    # the run stored in the directory; "r" to read a stored run (see open_results)
+    def __init__(self, directory, dtype=np.float64, mode="w"):
+        assert mode in ["w", "overwrite", "r"], "Mode must be 'w', 'overwrite' or 'r'"
+        super().__init__()
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest = {"series": {}, "trials": None}
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as file:
+                stored = json.load(file)
+            if mode == "r":
+                self.manifest = stored
+            elif mode == "w" and (stored["series"] or stored["trials"] is not None):
+                raise FileExistsError(f"{directory} already holds a run; use mode='overwrite' to replace it")
+            else:
+                # The stored run is removed before the new one is written
+                for entry in stored["series"].values():
+                    os.remove(os.path.join(directory, entry["file"]))
+                self.save_manifest()
+        elif mode == "r":
+            raise FileNotFoundError(f"No results in {directory}")
+        self.buffers = 0
+
+    # Zeroed float64 series mapped to a buffer file in the directory
+    def buffer(self, duration):
+        assert self.mode != "r", "Results opened for reading"
+        path = os.path.abspath(os.path.join(self.directory, f"buffer-{os.getpid()}-{self.buffers}.npy"))
+        self.buffers += 1
+        series = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(duration,))
+        weakref.finalize(series, remove_file, path)
+        return series
+
+    def add(self, result, result_name):
+        assert self.mode != "r", "Results opened for reading"
+        if result_name in self.manifest["series"]:
+            return
+        entry = {"file": f"{len(self.manifest['series'])}.npy"}
+        path = os.path.join(self.directory, entry["file"])
+
+        # Sparse stimuli keep only their onsets
+        if isinstance(result, SparseSeries):
+            entry["kind"] = "sparse"
+            entry["duration"] = result.duration
+            data = result.onsets
+        else:
+            entry["kind"] = "dense"
+            data = result
+
+        buffer = self.buffer_file(data)
+        if buffer is not None and self.dtype == np.float64:
+            data.flush()
+            os.replace(buffer, path)
+        else:
+            data = np.asarray(data)
+            if np.issubdtype(data.dtype, np.floating):
+                data = data.astype(self.dtype, copy=False)
+            series = np.lib.format.open_memmap(path, mode="w+", dtype=data.dtype, shape=data.shape)
+            series[:] = data
+            series.flush()
+            del series
+
+        self.manifest["series"][result_name] = entry
+        self.save_manifest()
+
+    # Buffer file of a series from buffer, or None for other series
+    def buffer_file(self, series):
+        if not isinstance(series, np.memmap) or series.filename is None:
+            return None
+        directory = os.path.dirname(series.filename)
+        name = os.path.basename(series.filename)
+        if directory != os.path.abspath(self.directory) or not name.startswith("buffer-"):
+            return None
+        return series.filename
+
+    # Series as a read-only memory map (or SparseSeries over mapped onsets)
+    def get(self, result_name):
+        if result_name not in self.results:
+            entry = self.manifest["series"][result_name]
+            data = np.load(os.path.join(self.directory, entry["file"]), mmap_mode="r")
+            if entry["kind"] == "sparse":
+                data = SparseSeries(entry["duration"], data)
+            self.results[result_name] = data
+        return self.results[result_name]
+
+    def list_results(self):
+        return self.manifest["series"].keys()
+
+    # Trials of a multisensory run (TrialTable)
+    def add_trials(self, trials):
+        assert self.mode != "r", "Results opened for reading"
+        self.manifest["trials"] = [
+            {"lead": t["lead"], "soa": int(t["soa"]), "response": float(t["response"])}
+            for t in trials
+        ]
+        self.save_manifest()
+
+    # Empty for entrainment runs, which have no trials
+    def get_trials(self):
+        return TrialTable.from_records(self.manifest["trials"] or [])
+
+    def save_manifest(self):
+        with open(os.path.join(self.directory, MANIFEST), "w") as file:
+            json.dump(self.manifest, file)
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# Opens the results of a finished run
+def open_results(directory):
+    return DiskResults(directory, mode="r")
@@ -0,0 +1,194 @@
+import os
+import numpy as np
+from itertools import product
+from collections import namedtuple
+from analysis import *
+
+""" Grid sweeps over model and stimulus parameters of the temporal recalibration experiment """
+
+# Parameters a sweep can vary, with their defaults
+# asynchronies: (start, stop, step) of the SOAs trials draw from, as for np.arange
+DEFAULTS = {
+    "fA": 12,
+    "low_freq": 1,
+    "max_slots": 5,
+    "threshold": 3,
+    "asynchronies": (-100, 125, 5),
+    "interval": 720,
+    "num_min": 10,
+}
+
+# One cell of the grid
+Config = namedtuple("Config", list(DEFAULTS))
+
+# One replicate of a configuration, simulated as one lane of an EnsembleExperiment
+SweepTask = namedtuple("SweepTask", ["config", "replicate", "seed"])
+
+# M2 takes no part in temporal recalibration: cells differing only in its parameters
+# are the same simulation and are run once
+UNUSED = {"threshold": DEFAULTS["threshold"]}
+
+# Results of analysis.recalibration kept for every run
+FIT_COLUMNS = [
+    "tr", "a_mode", "v_mode", "a_amp", "a_mu", "a_sigma", "v_amp", "v_mu", "v_sigma",
+    "a_residual", "v_residual", "trials",
+]
+
+# Most lanes simulated together in one task
+MAX_LANES = 32
+
+
+# Every combination of the given parameter values; a list gives the values to sweep,
+# anything else a single value. Parameters left out keep their defaults
+def grid(**params):
+    unknown = set(params) - set(DEFAULTS)
+    assert not unknown, f"Unknown sweep parameters: {sorted(unknown)}"
+
+    axes = []
+    for name, default in DEFAULTS.items():
+        values = params.get(name, default)
+        axes.append(values if isinstance(values, list) else [values])
+    return [Config(*values) for values in product(*axes)]
+
+
+# The configuration that is actually simulated for a cell
+def effective(config):
+    return config._replace(**UNUSED)
+
+
+# Stimuli depend on these parameters, so lanes simulated together must share them
+def stimulus_key(config):
+    return config.num_min, config.interval, config.asynchronies
+
+
+# Splits tasks into lanes of EnsembleExperiments, longest simulations first
+def schedule(tasks, workers=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    lanes = max(1, min(MAX_LANES, -(-len(tasks) // workers)))
+
+    groups = {}
+    for task in tasks:
+        groups.setdefault(stimulus_key(task.config), []).append(task)
+
+    chunks = [group[i : i + lanes] for group in groups.values() for i in range(0, len(group), lanes)]
+    chunks.sort(key=lambda chunk: chunk[0].config.num_min * len(chunk), reverse=True)
+    return chunks
+
+
+# Simulates one chunk of tasks as the lanes of one EnsembleExperiment
+# Returns the recalibration fit of each task, or a TaskFailure if its fit did not converge
+def simulate_lanes(chunk):
+    config = chunk[0].config
+    exp = EnsembleExperiment(
+        duration=config.num_min * 60 * 1000, n=len(chunk), seeds=[task.seed for task in chunk]
+    )
+    exp.create_multisensory_stim(
+        interval=config.interval, asynchronies=np.arange(*config.asynchronies)
+    )
+    exp.initialize_multisensory(
+        low_freq=[task.config.low_freq for task in chunk],
+        high_freq=[task.config.fA for task in chunk],
+        max_slots=[task.config.max_slots for task in chunk],
+    )
+    exp.run_multisensory(record=False)
+
+    fits = recalibrations([exp.get_trials(lane) for lane in range(len(chunk))])
+    return [fit if fit["converged"] else TaskFailure(task, fit_error(fit)) for task, fit in zip(chunk, fits)]
+
+
+# Worker entry point: simulates each chunk it is given
+def simulate_chunks(chunks):
+    return [simulate_lanes(chunk) for chunk in chunks]
+
+
+# Runs replicates of every configuration across worker processes (see parallel.py)
+# Identical configurations are simulated once; each simulation gets its own child stream
+# of SeedSequence(seed). Returns a SweepTable with one row per (configuration, replicate)
+def run_sweep(configs, replicates=5, seed=None, workers=None):
+    configs = list(configs)
+    unique = list(dict.fromkeys(effective(config) for config in configs))
+    seeds = np.random.SeedSequence(seed).spawn(len(unique) * replicates)
+    tasks = [
+        SweepTask(config, run, seeds[u * replicates + run])
+        for u, config in enumerate(unique)
+        for run in range(replicates)
+    ]
+
+    chunks = schedule(tasks, workers)
+    fits = {}
+    for chunk, result in zip(chunks, run_parallel(simulate_chunks, chunks, workers, chunksize=1)):
+        if isinstance(result, TaskFailure):
+            result = [TaskFailure(task, result.error) for task in chunk]
+        for task, fit in zip(chunk, result):
+            fits[task.config, task.replicate] = fit
+
+    rows = [(config, run, fits[effective(config), run]) for config in configs for run in range(replicates)]
+    return SweepTable.from_rows(rows)
+
+
+# Tidy table of sweep results: one array per column, one row per run
+class SweepTable:
+    def __init__(self, columns):
+        self.columns = {name: np.asarray(values) for name, values in columns.items()}
+
+    @classmethod
+    def from_rows(cls, rows):
+        columns = {name: [] for name in list(DEFAULTS) + ["replicate"] + FIT_COLUMNS + ["error"]}
+        for config, run, fit in rows:
+            for name, value in config._asdict().items():
+                columns[name].append(value)
+            columns["replicate"].append(run)
+            failed = isinstance(fit, TaskFailure)
+            for name in FIT_COLUMNS:
+                columns[name].append(np.nan if failed else fit[name])
+            columns["error"].append(repr(fit.error) if failed else "")
+
+        # Keep asynchronies as one (start, stop, step) tuple per row
+        asynchronies = np.empty(len(rows), dtype=object)
+        asynchronies[:] = columns["asynchronies"]
+        columns["asynchronies"] = asynchronies
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns["replicate"])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def names(self):
+        return list(self.columns)
+
+    # Rows whose columns equal the given values, e.g. select(fA=15, low_freq=1)
+    def select(self, **conditions):
+        keep = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            keep &= np.array([entry == value for entry in self.columns[name]], dtype=bool)
+        return SweepTable({name: values[keep] for name, values in self.columns.items()})
+
+    def failed(self):
+        return self.columns["error"] != ""
+
+    # Mean, standard deviation and number of completed runs of column, per combination of by
+    def summary(self, by, column="tr"):
+        done = ~self.failed()
+        keys = list(zip(*[self.columns[name][done] for name in by]))
+        values = self.columns[column][done]
+
+        groups = {}
+        for key, value in zip(keys, values):
+            groups.setdefault(key, []).append(value)
+
+        summary = {name: [key[b] for key in groups] for b, name in enumerate(by)}
+        summary["mean"] = [np.mean(group) for group in groups.values()]
+        summary["sd"] = [np.std(group) for group in groups.values()]
+        summary["n"] = [len(group) for group in groups.values()]
+        return summary
+
+    def save(self, path):
+        np.savez_compressed(path, **self.columns)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as data:
+            return cls({name: data[name] for name in data.files})
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from experiments import Experiment
+from checkpoint import Checkpoint, run_checkpointed
+
+
+def entrainment(seed, duration=6000):
+    exp = Experiment(duration, seed=seed)
+    exp.create_stimuli([330, 200])
+    exp.initialize_modules()
+    return exp
+
+
+def multisensory(seed, duration=10000):
+    exp = Experiment(duration, seed=seed)
+    exp.initialize_multisensory()
+    return exp
+
+
+def test_resumed_run_equals_full_run(tmp_path):
+    path = str(tmp_path / "run.pkl.gz")
+    full = entrainment(1)
+    full.run()
+
+    # Interrupted after the first checkpoint, then resumed by a new call
+    checkpoint = Checkpoint.start(entrainment(1))
+    checkpoint.advance(2500)
+    checkpoint.save(path)
+    resumed = run_checkpointed(entrainment(1), path, every=2500)
+    for name in full.result.list_results():
+        assert np.array_equal(np.asarray(full.result.get(name)), np.asarray(resumed.result.get(name)))
+
+
+@pytest.mark.parametrize(
+    "other",
+    [lambda: entrainment(2), lambda: entrainment(1, duration=7000), lambda: multisensory(1)],
+)
+def test_checkpoint_of_another_run_is_refused(tmp_path, other):
+    path = str(tmp_path / "run.pkl.gz")
+    run_checkpointed(entrainment(1), path, every=2500)
+    exp = other()
+    with pytest.raises(ValueError):
+        run_checkpointed(exp, path, every=2500, multisensory=not hasattr(exp, "m0"))
@@ -0,0 +1,37 @@
+import numpy as np
+from experiments import Experiment
+from ensemble import EnsembleExperiment
+
+
+def assert_lane_equals(ensemble, lane, exp):
+    expected = exp.get_results()
+    actual = ensemble.get_results(lane)
+    for name in expected.list_results():
+        assert np.array_equal(np.asarray(expected.get(name)), np.asarray(actual.get(name))), (lane, name)
+
+
+def test_multisensory_lanes_equal_experiments():
+    frequencies = [12, 20]
+    ensemble = EnsembleExperiment(20000, len(frequencies), seeds=[50, 51])
+    ensemble.initialize_multisensory(high_freq=frequencies)
+    ensemble.run_multisensory()
+    for lane, frequency in enumerate(frequencies):
+        exp = Experiment(20000, seed=50 + lane)
+        exp.initialize_multisensory(high_freq=frequency)
+        exp.run_multisensory()
+        assert_lane_equals(ensemble, lane, exp)
+        assert exp.get_trials() == ensemble.get_trials(lane)
+
+
+def test_entrainment_lanes_equal_experiments():
+    patterns = [[330], [300, 300, 450]]
+    ensemble = EnsembleExperiment(8000, len(patterns), seeds=[1, 2])
+    ensemble.create_stimuli(patterns)
+    ensemble.initialize_modules()
+    ensemble.run()
+    for lane, pattern in enumerate(patterns):
+        exp = Experiment(8000, seed=1 + lane)
+        exp.create_stimuli(pattern)
+        exp.initialize_modules()
+        exp.run()
+        assert_lane_equals(ensemble, lane, exp)
@@ -0,0 +1,24 @@
+import numpy as np
+from scipy.optimize import curve_fit
+from analysis import gauss
+from gaussfit import fit_gaussians
+from inputs import ASYNCHRONIES
+
+
+# On well-conditioned curves (a clear peak inside the SOA range, little noise) the batched
+# fit finds the same optimum as curve_fit
+def test_fit_agrees_with_curve_fit_on_well_conditioned_curves():
+    rng = np.random.default_rng(0)
+    x = ASYNCHRONIES.astype(float)
+    truth = [(0.9, -20, 40), (0.6, 15, 60), (0.8, 40, 30), (0.5, -5, 80)]
+    y = np.array([gauss(x, *params) + rng.normal(0, 0.01, len(x)) for params in truth])
+    mask = np.ones(y.shape, dtype=bool)
+    mask[1, ::3] = False
+
+    fit = fit_gaussians(x, y, mask)
+    assert fit.converged.all()
+    for curve, params in enumerate(truth):
+        expected, _ = curve_fit(gauss, x[mask[curve]], y[curve, mask[curve]], p0=params)
+        expected[2] = abs(expected[2])
+        actual = [fit.amp[curve], fit.mu[curve], fit.sigma[curve]]
+        assert np.allclose(actual, expected, rtol=1e-5, atol=1e-6), curve
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from inputs import multisensory_onsets, multisensory_trials
+
+
+def test_large_jitter_keeps_trials_apart():
+    rng = np.random.default_rng(0)
+    times, soas = multisensory_onsets(200000, rng, jitter=499, interval=720)
+    trials, trial_end, _ = multisensory_trials(times, soas)
+    assert np.all(trials[1:] > trial_end[:-1])
+    assert np.all(np.diff(trial_end) > 0)
+
+
+@pytest.mark.parametrize("jitter", [-1, 500, 720])
+def test_jitter_that_lets_trials_overlap_is_refused(jitter):
+    with pytest.raises(ValueError):
+        multisensory_onsets(10000, np.random.default_rng(0), jitter=jitter, interval=720)
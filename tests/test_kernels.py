@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import kernels
+from experiments import Experiment
+
+
+def results(exp):
+    return {name: np.asarray(exp.result.get(name)) for name in exp.result.list_results()}
+
+
+def entrainment(seed, pattern):
+    exp = Experiment(8000, seed=seed)
+    exp.create_stimuli(pattern)
+    exp.initialize_modules()
+    return exp
+
+
+def multisensory(seed):
+    exp = Experiment(20000, seed=seed)
+    exp.initialize_multisensory()
+    return exp
+
+
+def assert_same_results(expected, actual):
+    assert expected.keys() == actual.keys()
+    for name in expected:
+        assert np.array_equal(expected[name], actual[name]), name
+
+
+# The kernels run as plain Python when Numba is not used, so they can be checked anywhere
+@pytest.fixture
+def uncompiled(monkeypatch):
+    supports_entrainment, supports_multisensory = kernels.supports_entrainment, kernels.supports_multisensory
+    monkeypatch.setattr(kernels, "supports_entrainment", lambda exp: supports_entrainment(exp, compiled=False))
+    monkeypatch.setattr(kernels, "supports_multisensory", lambda exp: supports_multisensory(exp, compiled=False))
+
+
+@pytest.mark.parametrize("seed, pattern", [(1, [330]), (3, [300, 300, 450])])
+def test_uncompiled_entrainment_kernel_equals_run(uncompiled, seed, pattern):
+    expected = entrainment(seed, pattern)
+    expected.run()
+    exp = entrainment(seed, pattern)
+    assert kernels.supports_entrainment(exp)
+    exp.run(compiled=True)
+    assert_same_results(results(expected), results(exp))
+    assert np.array_equal(expected.costs.totals, exp.costs.totals)
+
+
+def test_uncompiled_multisensory_kernel_equals_run(uncompiled):
+    expected = multisensory(2)
+    expected.run_multisensory()
+    exp = multisensory(2)
+    assert kernels.supports_multisensory(exp)
+    exp.run_multisensory(compiled=True)
+    assert_same_results(results(expected), results(exp))
+    assert expected.get_trials() == exp.get_trials()
+
+
+def test_compiled_kernels_equal_run():
+    pytest.importorskip("numba")
+    expected = entrainment(1, [330])
+    expected.run()
+    exp = entrainment(1, [330])
+    assert kernels.supports_entrainment(exp)
+    exp.run(compiled=True)
+    assert_same_results(results(expected), results(exp))
+
+    expected = multisensory(2)
+    expected.run_multisensory()
+    exp = multisensory(2)
+    assert kernels.supports_multisensory(exp)
+    exp.run_multisensory(compiled=True)
+    assert_same_results(results(expected), results(exp))
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from experiments import Experiment, Recording
+
+
+def entrainment_run(duration, recording):
+    exp = Experiment(duration, seed=1, recording=recording)
+    exp.create_stimuli([330], sparse=True)
+    exp.initialize_modules()
+    exp.run()
+    return exp
+
+
+def test_reused_recording_keeps_tails_of_one_run():
+    recording = Recording(["m0"], decimate=10, tail=500, chunk=1000)
+    entrainment_run(20000, recording)
+    first = {name: tail.copy() for name, tail in recording.get_tails().items()}
+
+    # Shorter than the tail: nothing of the first run may be left in it
+    entrainment_run(300, recording)
+    tails = recording.get_tails()
+    assert np.array_equal(tails["time"], np.arange(300))
+    assert len(tails["m0"]) == 300
+    assert not np.array_equal(tails["time"], first["time"][-300:])
+
+    alone = Recording(["m0"], decimate=10, tail=500, chunk=1000)
+    entrainment_run(300, alone)
+    assert np.array_equal(tails["m0"], alone.get_tails()["m0"])
+
+
+def test_compiled_run_with_recording_is_refused():
+    recording = Recording(["m0"], decimate=10, tail=500, chunk=1000)
+    exp = Experiment(1000, seed=1, recording=recording)
+    exp.create_stimuli([330])
+    exp.initialize_modules()
+    with pytest.raises(AssertionError):
+        exp.run(compiled=True)
+
+    exp = Experiment(1000, seed=1, recording=recording)
+    exp.initialize_multisensory()
+    with pytest.raises(AssertionError):
+        exp.run_multisensory(compiled=True)
@@ -0,0 +1,20 @@
+import numpy as np
+from experiments import Experiment
+from scheduler import STIMULUS, TRIAL_START, TRIAL_END
+
+
+# Popping every step of a session finds what a scan of the stimuli and trials at each step
+# would find
+def test_schedule_finds_events_of_every_step():
+    exp = Experiment(20000, seed=4)
+    exp.initialize_multisensory()
+    exp.start_multisensory()
+    audio, visual = (np.asarray(stim) for stim in exp.stim)
+
+    for i in range(exp.duration):
+        events = exp.schedule.pop(i)
+        stimuli = [trial for kind, trial in events if kind == STIMULUS]
+        assert len(stimuli) == int(audio[i] != 0) + int(visual[i] != 0), i
+        assert [trial for kind, trial in events if kind == TRIAL_START] == list(np.flatnonzero(exp.trial_start == i))
+        assert [trial for kind, trial in events if kind == TRIAL_END] == list(np.flatnonzero(exp.trial_end == i))
+    assert exp.schedule.next_time(exp.duration) == exp.duration
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from experiments import Experiment
+from modules import M0, M0_nested
+
+
+def assert_same_results(expected, actual):
+    for name in expected.get_results().list_results():
+        assert np.array_equal(np.asarray(expected.get_results().get(name)), np.asarray(actual.get_results().get(name))), name
+
+
+@pytest.mark.parametrize("m0_class", [M0, M0_nested])
+def test_skip_ahead_entrainment_equals_run(m0_class):
+    runs = []
+    for skip_ahead in [False, True]:
+        exp = Experiment(8000, seed=3)
+        exp.create_stimuli([300, 300, 450])
+        exp.initialize_modules(m0_class)
+        exp.run(skip_ahead=skip_ahead)
+        runs.append(exp)
+    assert_same_results(*runs)
+
+
+def test_skip_ahead_multisensory_equals_run():
+    runs = []
+    for skip_ahead in [False, True]:
+        exp = Experiment(30000, seed=2)
+        exp.initialize_multisensory(high_freq=15)
+        exp.run_multisensory(skip_ahead=skip_ahead)
+        runs.append(exp)
+    assert_same_results(*runs)
+    assert runs[0].get_trials() == runs[1].get_trials()
@@ -0,0 +1,24 @@
+import numpy as np
+from experiments import Experiment
+
+
+def entrainment(intervals, duration):
+    exp = Experiment(duration, seed=3)
+    exp.create_stimuli(intervals)
+    exp.initialize_modules()
+    return exp
+
+
+def test_steady_state_run_equals_run():
+    expected = entrainment([330], 40000)
+    expected.run()
+    exp = entrainment([330], 40000)
+    exp.run(steady_state=True)
+
+    # The cycle must actually have been tiled for the comparison to mean anything
+    assert exp.steady_state["period"] is not None
+    assert exp.steady_state["simulated"] < exp.duration
+    for name in expected.result.list_results():
+        assert np.array_equal(np.asarray(expected.result.get(name)), np.asarray(exp.result.get(name))), name
+    assert expected.costs.totals[0] == exp.costs.totals[0]
+    assert np.allclose(expected.costs.totals, exp.costs.totals, rtol=1e-12)
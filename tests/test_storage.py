@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from experiments import Experiment
+from storage import DiskResults, open_results
+
+
+def multisensory_run(seed, results):
+    exp = Experiment(20000, seed=seed, results=results)
+    exp.create_multisensory_stim()
+    exp.initialize_multisensory()
+    exp.run_multisensory()
+    return exp
+
+
+def test_directory_with_a_run_is_not_reused(tmp_path):
+    multisensory_run(1, DiskResults(tmp_path))
+    with pytest.raises(FileExistsError):
+        DiskResults(tmp_path)
+
+
+def test_overwrite_replaces_the_run(tmp_path):
+    multisensory_run(1, DiskResults(tmp_path))
+    multisensory_run(2, DiskResults(tmp_path, mode="overwrite"))
+    expected = multisensory_run(2, None)
+
+    stored = open_results(tmp_path)
+    assert stored.get_trials() == expected.trials
+    for name in ["audio module", "visual module", "recalibration", "synchrony"]:
+        assert np.array_equal(stored.get(name), expected.result.get(name))
+
+
+def test_entrainment_run_has_no_trials(tmp_path):
+    exp = Experiment(2000, seed=1, results=DiskResults(tmp_path))
+    exp.create_stimuli([330])
+    exp.initialize_modules()
+    exp.run()
+    assert len(open_results(tmp_path).get_trials()) == 0
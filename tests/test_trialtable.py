@@ -0,0 +1,23 @@
+import pytest
+from trialtable import TrialTable
+
+
+def test_int_index_out_of_range():
+    with pytest.raises(IndexError):
+        TrialTable()[0]
+
+    table = TrialTable.from_records(
+        [{"lead": "audio", "soa": -100, "response": 1.0}, {"lead": None, "soa": 0, "response": -1.0}]
+    )
+    for key in [2, 5, -3]:
+        with pytest.raises(IndexError):
+            table[key]
+
+
+def test_negative_index():
+    table = TrialTable.from_records(
+        [{"lead": "audio", "soa": -100, "response": 1.0}, {"lead": "visual", "soa": 200, "response": -1.0}]
+    )
+    assert table[-1] == table[1] == {"lead": "visual", "soa": 200, "response": -1.0}
+    assert table[-2]["lead"] == "audio"
+    assert list(table) == [table[0], table[1]]
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from modules import WaveformTable
+
+
+def test_switching_resolution_back_and_forth():
+    table = WaveformTable("table", 1)
+    first = table.rectified(45.5, 1)
+    table.set_mode("table", 0.5)
+    table.rectified(45.5, 1)
+    table.set_mode("table", 1)
+    assert table.rectified(45.5, 1) == first
+    assert table.rectified(np.array([45.5]), 1)[0] == first
+
+
+def test_resolution_must_divide_360():
+    with pytest.raises(ValueError):
+        WaveformTable("table", 0.7)
+    with pytest.raises(ValueError):
+        WaveformTable("table", 0)
+
+
+@pytest.mark.parametrize("resolution", [0.1, 0.25, 1, 7.5])
+def test_lookup_up_to_360(resolution):
+    table = WaveformTable("table", resolution)
+    exact = WaveformTable("exact")
+    for angle in [359.99, 360 - resolution / 3, 0]:
+        assert abs(table.rectified(angle, 1) - exact.rectified(angle, 1)) <= table.max_error() + 1e-12
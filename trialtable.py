@@ -0,0 +1,102 @@
+import numpy as np
+
+""" Trial records of multisensory experiments, stored column by column """
+
+# Leading modality of a trial, stored as a small integer code
+LEADS = [None, "audio", "visual"]
+NO_LEAD, AUDIO, VISUAL = range(3)
+LEAD_CODES = {lead: code for code, lead in enumerate(LEADS)}
+
+COLUMNS = {"lead": np.int8, "soa": np.int64, "response": np.float64, "run": np.int32}
+
+
+class TrialTable:
+    # capacity: trials there is room for before the columns grow
+    def __init__(self, capacity=64):
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.length = 0
+
+    @classmethod
+    def from_columns(cls, lead, soa, response, run=None):
+        table = cls(0)
+        table.columns = {
+            "lead": np.asarray(lead, dtype=np.int8),
+            "soa": np.asarray(soa, dtype=np.int64),
+            "response": np.asarray(response, dtype=np.float64),
+            "run": np.zeros(len(lead), dtype=np.int32) if run is None else np.asarray(run, dtype=np.int32),
+        }
+        table.length = len(lead)
+        return table
+
+    # Table of trials given as a list of {"lead", "soa", "response"} dicts
+    @classmethod
+    def from_records(cls, records):
+        return cls.from_columns(
+            [LEAD_CODES[t["lead"]] for t in records],
+            [t["soa"] for t in records],
+            [t["response"] for t in records],
+        )
+
+    # Trials of several runs, one after the other; the run column gives the index of each table
+    @classmethod
+    def concatenate(cls, tables):
+        tables = [as_table(table) for table in tables]
+        columns = {
+            name: np.concatenate([table[name] for table in tables]) for name in ["lead", "soa", "response"]
+        }
+        run = np.repeat(np.arange(len(tables), dtype=np.int32), [len(table) for table in tables])
+        return cls.from_columns(run=run, **columns)
+
+    def append(self, lead, soa, response):
+        if self.length == len(self.columns["lead"]):
+            self.grow()
+        i = self.length
+        self.columns["lead"][i] = LEAD_CODES[lead]
+        self.columns["soa"][i] = soa
+        self.columns["response"][i] = response
+        self.length += 1
+
+    def grow(self):
+        capacity = max(64, 2 * len(self.columns["lead"]))
+        for name, values in self.columns.items():
+            grown = np.zeros(capacity, dtype=values.dtype)
+            grown[: self.length] = values[: self.length]
+            self.columns[name] = grown
+
+    def __len__(self):
+        return self.length
+
+    # Column as a view (e.g. table["soa"]), a trial as a dict, or a slice of trials as a table view
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key][: self.length]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            return TrialTable.from_columns(**{name: self[name][start:stop:step] for name in COLUMNS})
+        if not -self.length <= key < self.length:
+            raise IndexError(f"Trial {key} out of range for {self.length} trials")
+        if key < 0:
+            key += self.length
+        return {
+            "lead": LEADS[self.columns["lead"][key]],
+            "soa": self.columns["soa"][key],
+            "response": self.columns["response"][key],
+        }
+
+    def __iter__(self):
+        return (self[i] for i in range(self.length))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    # Lead of every trial as a string (or None)
+    def leads(self):
+        return np.array(LEADS, dtype=object)[self["lead"]]
+
+    def runs(self):
+        return int(self["run"].max()) + 1 if self.length else 0
+
+
+# Trials as a TrialTable, given a table or a list of trial dicts
+def as_table(trials):
+    return trials if isinstance(trials, TrialTable) else TrialTable.from_records(trials)
@@ -9,6 +9,7 @@ from random import randint
 import numpy as np
 from experiments import *
 from experiments import Results
+from storage import open_results
 
 global pause
 pause = False
@@ -26,6 +27,11 @@ class Display:
             if result_name != "time":
                 self.add_source(results.get(result_name), result_name)
 
+    # Display the results of a finished run saved in a results directory (see storage.py)
+    @classmethod
+    def open(cls, directory, title=""):
+        return cls(open_results(directory), title)
+
     def add_source(self, series, source_name="", source_color="black", source_lim=[-0.2, 1.2]):
         new_source = {
             "source": series,
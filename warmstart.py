@@ -0,0 +1,118 @@
+import os
+import sys
+import gzip
+import pickle
+import hashlib
+import inspect
+import warnings
+from experiments import *
+
+""" Persistent cache of module states already entrained to a stimulus pattern """
+
+# Entrainment always begins the same way for a given pattern: M0/M1/M2 start from fixed
+# initial states and see the pattern repeat from its first onset. The cache simulates
+# `cycles` repetitions of the pattern once and keeps the module state `lead` steps before
+# the next repetition would begin, lead being the pattern's first interval (the latest a
+# session created by create_stimuli starts). A session whose first stimulus comes s steps
+# in replays only the last lead - s steps, so it continues exactly as if the whole warm-up
+# had been simulated right before it.
+
+# Modules whose code determines the simulated dynamics
+MODEL_SOURCES = ["modules", "experiments", "skipahead", "scheduler", "cost", "kernels"]
+
+
+# Hash of the model code, so that results simulated by older code are not reused
+def code_fingerprint(sources=MODEL_SOURCES):
+    digest = hashlib.sha256()
+    for name in sources:
+        digest.update(inspect.getsource(sys.modules[name]).encode())
+    return digest.hexdigest()
+
+
+# Advances M0/M1/M2 (fresh ones of m0_class if None) over steps begin, ..., stop - 1 of
+# the pattern repeating from step 0
+def warm_up(modules, intervals, begin, stop, m0_class=M0):
+    exp = Experiment(stop - begin)
+    if modules is None:
+        exp.initialize_modules(m0_class)
+    else:
+        exp.m0, exp.m1, exp.m2 = modules
+    if stop <= begin:
+        return exp.m0, exp.m1, exp.m2
+
+    onsets, _ = pattern_onsets(stop, intervals, 0)
+    exp.set_stimulus(SparseSeries(stop - begin, onsets[onsets >= begin] - begin))
+    exp.run(compiled=True)
+    return exp.m0, exp.m1, exp.m2
+
+
+class WarmStartCache:
+    # directory: where entries are stored, one file per (modules, frequencies, pattern)
+    # cycles: repetitions of the pattern simulated to entrain the modules
+    # verify: resimulate the warm-up on every use and rebuild entries that no longer match;
+    # entries written by a different version of the model code are always rebuilt
+    def __init__(self, directory, cycles=20, verify=False):
+        self.directory = directory
+        self.cycles = cycles
+        self.verify = verify
+        self.fingerprint = code_fingerprint()
+        os.makedirs(directory, exist_ok=True)
+
+    # Identifies the warm-up of exp's modules on exp's stimulus pattern
+    def key(self, exp):
+        modules = [exp.m0, exp.m1, exp.m2]
+        return (
+            tuple(type(mod).__name__ for mod in modules),
+            tuple(mod.initial_freq for mod in modules),
+            tuple(int(interval) for interval in exp.stim_intervals),
+            self.cycles,
+            (waveforms.mode, waveforms.resolution),
+        )
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl.gz")
+
+    # Pickled modules of an entry, or None if there is no valid entry
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path) as file:
+            entry = pickle.load(file)
+        if entry["key"] != key or entry["fingerprint"] != self.fingerprint:
+            return None
+        return entry["modules"]
+
+    def save(self, key, modules):
+        path = self.path(key)
+        with gzip.open(path + ".tmp", "wb") as file:
+            pickle.dump({"key": key, "fingerprint": self.fingerprint, "modules": modules}, file)
+        os.replace(path + ".tmp", path)
+
+    # Modules entrained by the warm-up, lead steps before the pattern starts over
+    def simulate(self, exp):
+        intervals = exp.stim_intervals
+        stop = self.cycles * sum(intervals) - int(intervals[0])
+        return pickle.dumps(warm_up(None, intervals, 0, stop, type(exp.m0)))
+
+    # Replaces exp's fresh modules by modules entrained to its stimulus pattern
+    # Called by Experiment.initialize_modules, after create_stimuli
+    def entrain(self, exp):
+        assert hasattr(exp, "stim_intervals"), "Create stimuli before warm-starting modules"
+        key = self.key(exp)
+        modules = self.load(key)
+        if modules is None or self.verify:
+            simulated = self.simulate(exp)
+            if modules is not None and modules != simulated:
+                warnings.warn(f"Warm-start entry {key} no longer matches the model; rebuilt")
+            modules = simulated
+            self.save(key, modules)
+
+        # Steps of the warm-up left before this session's first stimulus
+        intervals = exp.stim_intervals
+        lead = int(intervals[0])
+        onsets = exp.stim.onsets if isinstance(exp.stim, SparseSeries) else np.flatnonzero(exp.stim)
+        first = min(int(onsets[0]), lead) if len(onsets) else lead
+
+        begin = self.cycles * sum(intervals) - lead
+        exp.m0, exp.m1, exp.m2 = warm_up(pickle.loads(modules), intervals, begin, begin + lead - first)